@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+import argparse
+import json
+import multiprocessing as mp
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import sample_protocol
+from message_bus import CONSUMER_ADDRESS, PRODUCER_ADDRESS
+
+FORMATS = ["json", "float64", "float32"]
+# float64 samples read from the sample ring of the message bus
+RING = "ring"
+
+
+def make_samples(n, sensors):
+    """ Samples like the ones myo_client.py sends """
+    samples = []
+    for i in range(n):
+        samples.append({'id': sensors[i % len(sensors)],
+                        'quat': [0.7071067811865476, 0.0, 0.7071067811865476 * (i % 7) / 7, 0.1],
+                        'acc': [-2048.0 * (i % 13), 4096.0, 10240.0],
+                        'gyr': [16.0 * (i % 5), -32.0, 48.0],
+                        'timestamp': 1500000000.0 + i / 50.0})
+    return samples
+
+
+def encode(samples, fmt, sensor_indexes):
+    if fmt == "json":
+        return [json.dumps(sample).encode('utf-8') for sample in samples]
+    return [sample_protocol.encode_sample(sensor_indexes[sample['id']], sample, float64=fmt == "float64")
+            for sample in samples]
+
+
+def decode(payloads, sensor_names):
+    return [sample_protocol.decode_sample(payload, sensor_names) if sample_protocol.is_binary(payload)
+            else json.loads(payload.decode('utf-8')) for payload in payloads]
+
+
+def benchmark_codec(samples, sensors):
+    """ :returns: List of (format, bytes per frame, seconds to encode and seconds to decode all samples) """
+    sensor_indexes = {name: i for i, name in enumerate(sensors)}
+    sensor_names = {i: name for i, name in enumerate(sensors)}
+    results = []
+    for fmt in FORMATS:
+        start_time = time.perf_counter()
+        payloads = encode(samples, fmt, sensor_indexes)
+        encode_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        decode(payloads, sensor_names)
+        decode_seconds = time.perf_counter() - start_time
+        size = sample_protocol.FRAME_HEADER.size + sum(len(payload) for payload in payloads) / len(payloads)
+        results.append((fmt, size, encode_seconds, decode_seconds))
+    return results
+
+
+def consume(count, binary, ring, results):
+    """
+    Read count samples from the message bus and put the seconds and CPU seconds from the first to the last in results
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(CONSUMER_ADDRESS)
+    reader = sample_protocol.SampleReader(sock, binary=binary, ring=ring)
+    results.put("connected")
+    reader.read()
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    for _ in range(count - 1):
+        reader.read()
+    results.put((time.perf_counter() - start_time, time.process_time() - start_cpu))
+    sock.close()
+
+
+def benchmark_bus(samples, sensors, consumers=1, ring_slots=4096):
+    """
+    Send the samples through a message bus started for every format, from one producer to consumers asking for the
+    same format, and last to consumers reading float64 samples from the bus' sample ring.
+
+    :param ring_slots: Slots of the sample ring
+    :returns: List of (format, samples per second received by the slowest consumer, CPU microseconds per sample of
+    the bus and of the consumers on average)
+    """
+    results = []
+    for fmt in FORMATS + [RING]:
+        ring = fmt == RING
+        for address in [CONSUMER_ADDRESS, PRODUCER_ADDRESS]:
+            if os.path.exists(address):
+                os.unlink(address)
+        command = [sys.executable, "message_bus.py", "--queue-size", str(len(samples))]
+        if ring:
+            command += ["--ring-slots", str(ring_slots)]
+        bus = subprocess.Popen(command, stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        while not os.path.exists(CONSUMER_ADDRESS) or not os.path.exists(PRODUCER_ADDRESS):
+            time.sleep(0.05)
+        time.sleep(0.2)
+
+        queue = mp.Queue()
+        readers = [mp.Process(target=consume, args=(len(samples), fmt != "json", ring, queue))
+                   for _ in range(consumers)]
+        for reader in readers:
+            reader.start()
+        for _ in readers:
+            queue.get()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(PRODUCER_ADDRESS)
+        sensor_indexes = None
+        if fmt != "json":
+            sensor_indexes = sample_protocol.negotiate(sock, sensors)
+        # Encoded as they are sent, like myo_client.py does
+        for sample in samples:
+            sample_protocol.send_frame(sock, encode([sample], "float64" if ring else fmt, sensor_indexes)[0])
+
+        times = [queue.get() for _ in readers]
+        for reader in readers:
+            reader.join()
+        sock.close()
+        bus.send_signal(signal.SIGINT)
+        # Reaped with wait4 for the CPU time of the bus
+        _, status, usage = os.wait4(bus.pid, 0)
+        bus.returncode = os.waitstatus_to_exitcode(status)
+        results.append((fmt, (len(samples) - 1) / max(seconds for seconds, _ in times),
+                        1e6 * (usage.ru_utime + usage.ru_stime) / len(samples),
+                        1e6 * sum(cpu for _, cpu in times) / len(times) / (len(samples) - 1)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the size and speed of json messages and binary samples, "
+                                     "encoded and decoded in this process and sent through the message bus")
+    parser.add_argument('-n', '--samples', default=100000, type=int, help="Number of samples. Default is 100000")
+    parser.add_argument('-s', '--sensors', default=2, type=int, help="Number of sensors. Default is 2")
+    parser.add_argument('-c', '--consumers', default=1, type=int,
+                        help="Number of consumers of the message bus. Default is 1")
+    parser.add_argument('--ring-slots', default=4096, type=int,
+                        help="Slots of the sample ring of the message bus. Default is 4096")
+    parser.add_argument('--no-bus', action="store_true", default=False,
+                        help="Only measure encoding and decoding, without the message bus")
+    args = parser.parse_args()
+
+    sensors = ["myo{}".format(i) for i in range(args.sensors)]
+    samples = make_samples(args.samples, sensors)
+
+    print("{:<10}{:>16}{:>20}{:>20}".format("format", "bytes/frame", "encode samples/s", "decode samples/s"))
+    for fmt, size, encode_seconds, decode_seconds in benchmark_codec(samples, sensors):
+        print("{:<10}{:>16.1f}{:>20.0f}{:>20.0f}".format(fmt, size, len(samples) / encode_seconds,
+                                                         len(samples) / decode_seconds))
+
+    if not args.no_bus:
+        print("\n{:<10}{:>16}{:>20}{:>24}".format("format", "bus samples/s", "bus CPU us/sample",
+                                                 "consumer CPU us/sample"))
+        for fmt, rate, bus_cpu, consumer_cpu in benchmark_bus(samples, sensors, args.consumers, args.ring_slots):
+            print("{:<10}{:>16.0f}{:>20.2f}{:>24.2f}".format(fmt, rate, bus_cpu, consumer_cpu))
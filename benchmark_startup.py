@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# The modules every entry point imported before parsing its arguments, before they were deferred
+CALC_DTW_MODULES = ["numpy", "distance_cache", "dtw_engines", "exercise_recording_data", "master_utils",
+                    "sequence_store"]
+ENTRY_POINTS = {"calc_dtw.py": CALC_DTW_MODULES,
+                "merge_dtw_shards.py": CALC_DTW_MODULES,
+                "data_tester.py": ["create_confusion_matrix", "exercise_recording_data", "plotgrid"],
+                "reduce_prototypes.py": CALC_DTW_MODULES + ["create_confusion_matrix"],
+                "classify_motion_client.py": ["numpy", "create_confusion_matrix", "dtw_engines",
+                                              "exercise_recording_data"]}
+
+IMPORT_MODULES = """
+import importlib, sys
+for name in sys.argv[1:]:
+    try:
+        importlib.import_module(name)
+    except ImportError as e:
+        print(e.name)
+"""
+
+
+def time_command(command, repeat):
+    """
+    Run a command repeat times, each in a fresh interpreter.
+
+    :returns: Median wall time in seconds, and the output of the last run
+    """
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        seconds.append(time.perf_counter() - start_time)
+    return statistics.median(seconds), output.decode()
+
+
+def benchmark_startup(scripts, repeat=10):
+    """
+    Compare the cold start of every entry point with --help against the import of the modules it used to load before
+    parsing its arguments.
+
+    :returns: List of (script, seconds of --help, seconds of the eager imports, modules that could not be imported)
+    """
+    interpreter, _ = time_command([sys.executable, "-c", "pass"], repeat)
+    results = []
+    for script in scripts:
+        deferred, _ = time_command([sys.executable, script, "--help"], repeat)
+        eager, missing = time_command([sys.executable, "-c", IMPORT_MODULES] + ENTRY_POINTS[script], repeat)
+        results.append((script, deferred - interpreter, eager - interpreter, missing.split()))
+    return interpreter, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how long the entry points take to start with --help, "
+                                     "compared to importing the modules they used to import before parsing arguments")
+    parser.add_argument('scripts', nargs='*', default=sorted(ENTRY_POINTS),
+                        help="Entry points to measure, of {}. Default is all of them".format(", ".join(sorted(ENTRY_POINTS))))
+    parser.add_argument('-n', '--repeat', default=10, type=int, help="Runs of every command, the median is "
+                        "reported. Default is 10")
+    args = parser.parse_args()
+    unknown = [script for script in args.scripts if script not in ENTRY_POINTS]
+    if unknown:
+        parser.error("unknown entry points: {}".format(", ".join(unknown)))
+
+    interpreter, results = benchmark_startup(args.scripts, args.repeat)
+    print("Interpreter startup {:.1f} ms, subtracted below".format(1000 * interpreter))
+    print("{:<28}{:>12}{:>14}{:>10}".format("script", "--help ms", "imports ms", "saved"))
+    for script, deferred, eager, missing in results:
+        print("{:<28}{:>12.1f}{:>14.1f}{:>9.0f}%{}"
+              .format(script, 1000 * deferred, 1000 * eager, 100 * (1 - deferred / eager) if eager > 0 else 0,
+                      "  ({} not installed)".format(", ".join(missing)) if missing else ""))
@@ -0,0 +1,86 @@
+import os
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b"MCBC"
+VERSION = 1
+ALIGNMENT = 64
+
+# Magic, version and length of the pickled metadata
+HEADER = struct.Struct("<4sIQ")
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_container(filepath, metadata, arrays):
+    """
+    Write a container file: a small header, pickled metadata and the raw bytes of every array, aligned so they can
+    be memory mapped when reading.
+
+    :param metadata: Picklable object stored as is
+    :param arrays: Dict of numpy arrays by name
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = (array.dtype.str, array.shape, offset)
+        offset = _align(offset + array.nbytes)
+
+    header = pickle.dumps({"metadata": metadata, "layout": layout}, pickle.HIGHEST_PROTOCOL)
+    data_start = _align(HEADER.size + len(header))
+
+    # Write to a temporary file first so readers never see a partially written container
+    tmp_filepath = filepath + ".tmp{}".format(os.getpid())
+    with open(tmp_filepath, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][2])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(max(f.tell(), data_start))
+    os.replace(tmp_filepath, filepath)
+
+
+def read_container(filepath, names=None):
+    """
+    Read a container file written by write_container.
+
+    :param names: Names of the arrays to return. If None, return all.
+    :returns: Tuple (metadata, arrays), where arrays are read-only views of the memory mapped file.
+              None if the file is not a valid container.
+    """
+    with open(filepath, "rb") as f:
+        try:
+            magic, version, header_length = HEADER.unpack(f.read(HEADER.size))
+        except struct.error:
+            return None
+        if magic != MAGIC or version != VERSION:
+            return None
+        header = pickle.loads(f.read(header_length))
+        size = os.fstat(f.fileno()).st_size
+    data_start = _align(HEADER.size + header_length)
+
+    layout = header["layout"]
+    if names is not None:
+        layout = {name: layout[name] for name in names if name in layout}
+
+    # Empty files can't be memory mapped
+    region = np.memmap(filepath, dtype=np.uint8, mode='r', offset=data_start) if size > data_start else None
+
+    arrays = {}
+    for name, (dtype, shape, offset) in layout.items():
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        if data_start + offset + nbytes > size:
+            # Truncated file
+            return None
+        if nbytes == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.asarray(region[offset:offset+nbytes]).view(dtype).reshape(shape)
+    return header["metadata"], arrays
@@ -1,88 +1,355 @@
 #!/usr/bin/python3
 import argparse
+import atexit
+import collections
 import datetime
 import functools
+import heapq
 import multiprocessing as mp
-import numpy as np
 import os
 import pickle
 import re
 import sys
 import time
 
-from fastdtw import fastdtw
 
-from master_utils import (dprint,
-                          number_of_distances,
-                          show_progress,
-                          strftime_elapsed,
-                          readExerciseCSV,
-                          getParametersFromFilename)
-from exercise_recording_data import DataSequence, ExerciseRecording, ExerciseRecordingDataSet
+def parse_shard(value):
+    """ Parse a shard given as K/N on the command line into the tuple (K, N) """
+    match = re.match(r'^([0-9]+)/([0-9]+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("shard must be K/N with 1 <= K <= N, got '{}'".format(value))
+    return int(match.group(1)), int(match.group(2))
 
 
-def euclidean_distance(q,p):
-    if(q[0] == p[0] and
-       q[1] == p[1] and
-       q[2] == p[2] and
-       q[3] == p[3]):
-        return 0
+def get_argument_parser():
+    """ Command line arguments of calc_dtw.py """
+    parser = argparse.ArgumentParser(description='Calculate all distances between samples in the current directory')
+    parser.add_argument('-d', '--dist-type', choices=["quaternion", "euclidean"],
+                        default="quaternion", help="Either 'quaternion' (default) or 'euclidean'."
+                        "Note that the quaternion distance function will likely throw weird errors for anything but quaternions.")
 
-    return np.linalg.norm(q-p)
+    parser.add_argument('-e', '--dtw-engine', choices=["fastdtw", "exact", "banded"], default="fastdtw",
+                        help="Either 'fastdtw' (default) for approximate DTW, 'exact' for exact DTW computed over the "
+                        "whole local cost matrix of the two sequences using vectorized array operations or 'banded' "
+                        "for exact DTW constrained to a band around the diagonal")
 
+    parser.add_argument('-w', '--window', default=None, type=int,
+                        help="fastdtw radius (default 1) or Sakoe-Chiba radius in samples for the banded engine "
+                        "(default 10%% of the longest sequence)")
 
-def quaternion_distance(q,p):
-    if(q[0] == p[0] and
-       q[1] == p[1] and
-       q[2] == p[2] and
-       q[3] == p[3]):
-        return 0
-    i = 2 * ((np.inner(q,p))**2) - 1
-    if( i <= 1 and i >= -1):
-        return np.arccos(i)
-    else:
-        i = round(i,1)
-        if( i <= 1 and i >= -1):
-            return np.arccos(i)
-        else:
-            print("Unknown value error in distfunc for \nq={}\np={}\ni={}".format(q,p,i))
-            raise Exception
+    parser.add_argument('--band', choices=["sakoe-chiba", "itakura"], default="sakoe-chiba",
+                        help="Band shape used by the banded engine. Default is 'sakoe-chiba'")
+
+    parser.add_argument('--max-slope', default=2.0, type=float,
+                        help="Maximum slope of the Itakura parallelogram. Default is 2")
+
+    parser.add_argument('-k', '--knn', default=None, type=int,
+                        help="Only find the KNN nearest neighbours of every sample, skipping DTW computations whose "
+                        "lower bound shows they cannot be among them. The distances are still saved as a full distance "
+                        "matrix, with Inf for the pairs that were skipped. With a leave-me-out scheme, KNN must be "
+                        "larger than the number of samples left out")
+
+    parser.add_argument('--distance-dtype', choices=["float64", "float32"], default="float64",
+                        help="Precision of the stored distance matrices. Default is 'float64'")
+
+    parser.add_argument('--chunk-seconds', default=1.0, type=float,
+                        help="Target wall time in seconds of the chunks of DTW jobs sent to each worker process. "
+                        "Default is 1")
+
+    parser.add_argument('--cache', default=os.path.join("pickles", "dtw_distance_cache.pickle"),
+                        help="Persistent cache of computed distances, keyed by the content of the data sequences and "
+                        "the DTW parameters. Default is pickles/dtw_distance_cache.pickle")
+
+    parser.add_argument('--no-cache', action="store_true", default=False,
+                        help="Don't read or update the distance cache")
+
+    parser.add_argument('--cache-size', default=1000000, type=int,
+                        help="Maximum number of distances in the cache. The least recently used distances are evicted "
+                        "first. Default is 1000000")
+
+    parser.add_argument('--checkpoint', default=None,
+                        help="File computed distances are periodically appended to, so an interrupted run can be "
+                        "resumed. It is removed once the results are saved. Default is pickles/dtw_checkpoint.pickle, "
+                        "or pickles/dtw_checkpoint_shard_K_of_N.pickle with --shard")
+
+    parser.add_argument('--checkpoint-interval', default=60.0, type=float,
+                        help="Seconds between writes to the checkpoint. Default is 60")
+
+    parser.add_argument('--resume', action="store_true", default=False,
+                        help="Keep the distances in the checkpoint of an interrupted run and only compute the rest. "
+                        "Without it, an existing checkpoint is an error")
 
+    parser.add_argument('--shard', default=None, type=parse_shard,
+                        help="Only compute part K of N of the distances, given as K/N. The pairs are split by "
+                        "estimated cost, the same way on every machine. The result is saved as "
+                        "pickles/dtw_shard_K_of_N_*.pickle, combine all N of them with merge_dtw_shards.py")
+
+    parser.add_argument('--no-sidecar', action="store_true", default=False,
+                        help="Always parse the CSV files, instead of loading the binary <file>.csv.bin saved next to "
+                        "each file when it was last parsed")
+
+    parser.add_argument('-t', '--data-type', default="quat",
+                        help="Must be the same as the column label in the data files used (for example 'quat')")
+
+    parser.add_argument('-V', '--verbose', action="store_true", default=False, help="Be verbose")
+    parser.add_argument('-D', '--debug', action="store_true", default=False,
+                        help="After calculating all distances, print out the three closest distance for each sample")
+
+    parser.add_argument('-i', '--sensor-id', dest="sensor_id_category", default='id',
+                        help="The name of the csv column in the CSV input file containing the sensor id. Default is 'id'")
+
+    parser.add_argument('-r', '--required-sensors', dest="sensors_required", default=None, nargs='*',
+                        help="List of required sensors. If specified, will abort if a required sensor "
+                        "is missing from input data")
 
-def get_dtw_jobs(quat_sequences_by_sensor, distfunc):
-    """ Generate DTW jobs consumed by compute_dtw_job """
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help="Number of jobs to run concurrently")
+    return parser
+
+
+def make_dtw_function(dist_type, dtw_engine, window=None, band="sakoe-chiba", max_slope=2.0):
+    """
+    Return a function taking two sequences and returning their DTW distance.
+
+    :param dist_type: Either 'quaternion' or 'euclidean'
+    :param dtw_engine: Either 'fastdtw', 'exact' or 'banded'
+    :param window: fastdtw radius (default 1) or Sakoe-Chiba radius for the banded engine
+    :param band: Band shape of the banded engine, either 'sakoe-chiba' or 'itakura'
+    :param max_slope: Maximum slope of the Itakura parallelogram
+    """
+    from dtw_engines import COST_MATRIX_FUNCTIONS, DISTANCE_FUNCTIONS, banded_dtw, exact_dtw, fastdtw_distance
+
+    if dtw_engine == "fastdtw":
+        return functools.partial(fastdtw_distance,
+                                 distfunc=DISTANCE_FUNCTIONS[dist_type],
+                                 radius=1 if window is None else window)
+    elif dtw_engine == "exact":
+        return functools.partial(exact_dtw, cost_matrix_function=COST_MATRIX_FUNCTIONS[dist_type])
+    elif dtw_engine == "banded":
+        return functools.partial(banded_dtw,
+                                 cost_matrix_function=COST_MATRIX_FUNCTIONS[dist_type],
+                                 band=band,
+                                 window=window,
+                                 max_slope=max_slope)
+    raise ValueError("Unknown DTW engine {!r}".format(dtw_engine))
+
+
+def make_lower_bound_function(dist_type, dtw_engine, window=None, band="sakoe-chiba", max_slope=2.0):
+    """ Return a function taking two sequences and returning a lower bound of the distance computed by make_dtw_function """
+    from dtw_engines import lower_bound
+
+    if dtw_engine == "banded":
+        return functools.partial(lower_bound, dist_type=dist_type, band=band, window=window, max_slope=max_slope)
+    # fastdtw never returns less than exact DTW, so the unconstrained bound holds for both
+    return functools.partial(lower_bound, dist_type=dist_type)
+
+
+def estimate_pair_cost(n, m, dtw_engine, window=None, band="sakoe-chiba"):
+    """ Estimate the relative cost of comparing sequences of length n and m, proportional to the cells visited """
+    if dtw_engine == "fastdtw":
+        radius = 1 if window is None else window
+        return (n + m) * (2 * radius + 1)
+    elif dtw_engine == "banded" and band == "sakoe-chiba":
+        if window is None:
+            window = max(1, int(0.1 * max(n, m)))
+        return n * min(m, 2 * window + 1)
+    elif dtw_engine == "banded" and band == "itakura":
+        # A parallelogram with slope 2 covers about a third of the cost matrix
+        return n * m / 3
+    return n * m
+
+
+def schedule_dtw_jobs(jobs, costs, target_cost):
+    """
+    Order jobs by estimated cost, longest first, and group them into chunks of at least target_cost.
+    Expensive pairs are started first so they don't keep a single worker busy at the end of the run,
+    while cheap pairs are batched so they don't spend most of their time on inter-process communication.
+
+    :returns: List of chunks, each a list of jobs
+    """
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for n in sorted(range(len(jobs)), key=lambda n: costs[n], reverse=True):
+        chunk.append(jobs[n])
+        chunk_cost += costs[n]
+        if chunk_cost >= target_cost:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def shard_dtw_jobs(jobs, costs, shard, num_shards):
+    """
+    Deterministically split jobs into num_shards parts of about equal estimated cost, so every machine running
+    with the same input computes the same split.
+
+    :param shard: Index of the part to return, starting at 0
+    :returns: List of the jobs in that part
+    """
+    # Greedily give the most expensive job left to the least loaded shard
+    loads = [(0, k) for k in range(num_shards)]
+    selected = []
+    for n in sorted(range(len(jobs)), key=lambda n: (-costs[n], jobs[n])):
+        load, k = heapq.heappop(loads)
+        if k == shard:
+            selected.append(jobs[n])
+        heapq.heappush(loads, (load + costs[n], k))
+    return selected
+
+
+
+def get_dtw_jobs(num_sequences_by_sensor):
+    """ Generate DTW jobs (s, i, j) consumed by compute_dtw_job, comparing sequence i and j > i of sensor s """
     # For every sensor's sequence
-    for s,quat_sequence in enumerate(quat_sequences_by_sensor):
-        for i, sequence_1 in enumerate(quat_sequence):
+    for s, num_sequences in enumerate(num_sequences_by_sensor):
+        for i in range(num_sequences):
             # Compare it to every other sequence for this sensor
-            for j, sequence_2 in enumerate(quat_sequence[i+1:]):
-                yield {"s": s,
-                       "i": i,
-                       "j": j,
-                       "sequence_1": sequence_1,
-                       "sequence_2": sequence_2,
-                       "distfunc": distfunc}
+            for j in range(i+1, num_sequences):
+                yield (s, i, j)
+
+
+def init_dtw_worker(store_info, dtw, lower_bound_function=None, shared_costs_info=None,
+                    cached_costs=None, parameters_key=None, sequence_keys_by_sensor=None):
+    """ Attach a worker process to the sequence store and share the DTW functions and cached distances with it """
+    from sequence_store import SequenceStore
+
+    global worker_store, worker_dtw, worker_lower_bound, worker_shared_costs
+    global worker_cached_costs, worker_parameters_key, worker_sequence_keys_by_sensor
+    worker_store = SequenceStore.attach(*store_info)
+    worker_shared_costs = SequenceStore.attach(*shared_costs_info) if shared_costs_info is not None else None
+    worker_dtw = dtw
+    worker_lower_bound = lower_bound_function
+    worker_cached_costs = cached_costs
+    worker_parameters_key = parameters_key
+    worker_sequence_keys_by_sensor = sequence_keys_by_sensor
 
 
 def compute_dtw_job(job):
-    sequence_1 = job['sequence_1']
-    sequence_2 = job['sequence_2']
-    s = job['s']
-    i = job['i']
-    j = job['j']
-    distfunc = job["distfunc"]
-    dist,path = fastdtw(sequence_1.data, sequence_2.data, dist=distfunc)
+    """ Compute the distance between sequence i and j of sensor s, returning (s, i, j, cost) """
+    s, i, j = job
+    cost = worker_dtw(worker_store.get(s, i), worker_store.get(s, j))
+    return (s, i, j, cost)
+
+
+def compute_dtw_chunk(chunk):
+    """ Compute a chunk of DTW jobs, returning the results along with the worker's pid and the time spent """
+    start_time = time.time()
+    results = [compute_dtw_job(job) for job in chunk]
+    return {"pid": os.getpid(), "busy": time.time() - start_time, "results": results}
+
+
+def run_dtw_jobs(title, store, jobs, num_jobs, processes, function, job_count=None, **initargs):
+    """
+    Run jobs in a pool of worker processes attached to the sequence store, yielding results as they complete.
+
+    :param job_count: Function returning the number of jobs a result accounts for, if not one
+    """
+    from master_utils import show_progress
+
+    with mp.Pool(processes=processes,
+                 initializer=functools.partial(init_dtw_worker, **initargs),
+                 initargs=(store.attach_info(),)) as pool:
+        start_time = time.time()
+        done = 0
+        for result in pool.imap_unordered(function, jobs):
+            done += 1 if job_count is None else job_count(result)
+            show_progress(title, num_jobs, done, start_time)
+            yield result
+
+        pool.close()
+        pool.join()
+
+
+def get_pair_key(parameters_key, sequence_keys, i, j):
+    """ Distance cache key for sequences i and j, which are always compared in index order """
+    from distance_cache import DistanceCache
+
+    if i > j:
+        i, j = j, i
+    return DistanceCache.pair_key(parameters_key, sequence_keys[i], sequence_keys[j])
+
+
+def get_condensed_index(num_sequences, i, j):
+    """ Index of the distance between sequence i and j in a condensed matrix, like DistanceMatrix.condensed_index """
+    if i > j:
+        i, j = j, i
+    return num_sequences * i - i * (i + 1) // 2 + j - i - 1
+
+
+def get_knn_jobs(num_sequences_by_sensor):
+    """ Generate k-NN jobs (s, i) consumed by compute_knn_job, one for every sequence """
+    for s, num_sequences in enumerate(num_sequences_by_sensor):
+        for i in range(num_sequences):
+            yield (s, i)
+
+
+def compute_knn_job(job, k):
+    """
+    Find the k nearest neighbours of sequence i of sensor s. Candidates are visited in order of their lower bound,
+    and DTW is only computed for candidates whose lower bound is below the k-th best distance found so far.
+
+    Sequences are always compared in index order, like in compute_dtw_job, since DTW with a band isn't symmetric. So
+    the distance of a pair is the same for the queries of both its sequences, and the workers share the distances
+    they compute or find in the cache through the shared costs store, NaN where no worker has it yet. Only the query
+    that computed or looked up a distance returns it.
+
+    The k nearest neighbours are always among the distances returned, so they are not returned separately. The caller
+    stores the distances in the distance matrix, where the pairs that were skipped stay Inf.
+    """
+    import numpy as np
+
+    s, i = job
+    store = worker_store
+    num_sequences = store.num_sequences(s)
+    shared_costs = worker_shared_costs.get(s, 0)[:, 0]
+
+    candidates = [(worker_lower_bound(store.get(s, min(i, j)), store.get(s, max(i, j))), j)
+                  for j in range(num_sequences) if j != i]
+    candidates.sort()
+
+    # Max-heap of the k best (negated) distances so far
+    best = []
+    distances = []
+    cache_hits = []
+    for bound, j in candidates:
+        if len(best) == k and bound >= -best[0]:
+            break
+
+        index = get_condensed_index(num_sequences, i, j)
+        cost = shared_costs[index]
+        if np.isnan(cost):
+            cost = None
+            if worker_cached_costs is not None:
+                cost = worker_cached_costs.get(get_pair_key(worker_parameters_key, worker_sequence_keys_by_sensor[s],
+                                                            i, j))
+            if cost is None:
+                cost = worker_dtw(store.get(s, min(i, j)), store.get(s, max(i, j)))
+                distances.append((j, cost))
+            else:
+                cache_hits.append((j, cost))
+            shared_costs[index] = cost
+
+        if len(best) < k:
+            heapq.heappush(best, -cost)
+        elif cost < -best[0]:
+            heapq.heapreplace(best, -cost)
 
     result = {}
     result['s'] = s
     result['i'] = i
-    result['j'] = j
-    result['cost'] = dist
+    result['distances'] = distances
+    result['cache_hits'] = cache_hits
 
     return result
 
 
 def save_parsed_exercise_recording(parsed_er, verbose=False, sensors_required=None):
+        from exercise_recording_data import ExerciseRecording
+        from master_utils import dprint
+
         tsID = parsed_er["tsID"]
         exercise_name = parsed_er["exercise_name"]
         mode = parsed_er["mode"]
@@ -102,8 +369,63 @@ def save_parsed_exercise_recording(parsed_er, verbose=False, sensors_required=No
         return exercise_object
 
 
+def get_data_sequences_by_sensor(exercise_recording_data_set, data_type):
+    """
+    Return a list of the data sequences of every sensor that has data_type. Sensors and data sequences are sorted
+    by name, so every run over the same files numbers the sequences the same way.
+    """
+    data_sequences_by_sensor = []
+    for sensor in sorted(exercise_recording_data_set.get_sensors()):
+        data_sequences = exercise_recording_data_set.get_data_sequences(data_types=[data_type], sensors=[sensor])
+        if len(data_sequences) == 0:
+            print("Sensor {} is missing data type '{}', skipping".format(sensor, data_type))
+            continue
+        data_sequences.sort()
+        data_sequences_by_sensor.append(data_sequences)
+    return data_sequences_by_sensor
+
+
+def save_exercise_recording_data_set(exercise_recording_data_set, dist_type, pickledir="pickles"):
+    """ Save a complete exercise structure and return the name of the data set file """
+    from master_utils import dprint
+
+    if not os.path.exists(pickledir):
+        os.makedirs(pickledir)
+
+    isotime = datetime.datetime.now().isoformat()
+    exercise_recordings_file = pickledir + '/exercise_recording_data_set_' + dist_type + "_" + isotime + '.dataset'
+    exercise_recording_data_set.save(exercise_recordings_file)
+    dprint("Saved {}".format(exercise_recordings_file), verbose=True)
+    return exercise_recordings_file
+
+
+def save_dtw_shard(exercise_recording_data_set, shard, sequence_keys_by_sensor, pickledir="pickles"):
+    """
+    Save the exercise structure of one shard, with only the distances of that shard filled in, for merge_dtw_shards.py.
+
+    :param shard: Tuple (K, N)
+    """
+    from master_utils import dprint
+
+    if not os.path.exists(pickledir):
+        os.makedirs(pickledir)
+
+    isotime = datetime.datetime.now().isoformat()
+    dist_type = exercise_recording_data_set.dtw_parameters["dist_type"]
+    shard_file = "{}/dtw_shard_{}_of_{}_{}_{}.pickle".format(pickledir, shard[0], shard[1], dist_type, isotime)
+    with open(shard_file, "wb") as pf:
+        pickle.dump({"shard": shard,
+                     "sequence_keys_by_sensor": sequence_keys_by_sensor,
+                     "exercise_recording_data_set": exercise_recording_data_set},
+                    pf, pickle.HIGHEST_PROTOCOL)
+    dprint("Saved {}".format(shard_file), verbose=True)
+    return shard_file
+
+
 def traverse_data_files(verbose=False):
     """ Scan this directory for directories names tsX, where X is a number. """
+    from master_utils import dprint, getParametersFromFilename
+
     files = []
     cwd = os.getcwd()
     dprint("\nScanning for valid sensor data CSV files recursively from {}".format(cwd), verbose=verbose)
@@ -147,28 +469,24 @@ def traverse_data_files(verbose=False):
     return files
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Calculate all distances between samples in the current directory')
-    parser.add_argument('-d', '--dist-type', choices=["quaternion", "euclidean"],
-                        default="quaternion", help="Either 'quaternion' (default) or 'euclidean'."
-                        "Note that the quaternion distance function will likely throw weird errors for anything but quaternions.")
-
-    parser.add_argument('-t', '--data-type', default="quat",
-                        help="Must be the same as the column label in the data files used (for example 'quat')")
-
-    parser.add_argument('-V', '--verbose', action="store_true", default=False, help="Be verbose")
-    parser.add_argument('-D', '--debug', action="store_true", default=False,
-                        help="After calculating all distances, print out the three closest distance for each sample")
-
-    parser.add_argument('-i', '--sensor-id', dest="sensor_id_category", default='id',
-                        help="The name of the csv column in the CSV input file containing the sensor id. Default is 'id'")
-
-    parser.add_argument('-r', '--required-sensors', dest="sensors_required", default=None, nargs='*',
-                        help="List of required sensors. If specified, will abort if a required sensor "
-                        "is missing from input data")
-
-    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help="Number of jobs to run concurrently")
+def main():
+    parser = get_argument_parser()
     args = parser.parse_args()
+    if args.shard and args.knn:
+        parser.error("--shard can't be combined with --knn")
+
+    # Only imported once the arguments are parsed, so --help and usage errors don't wait for numpy, fastdtw and the
+    # data modules
+    import numpy as np
+
+    from distance_cache import DistanceCache, DistanceCheckpoint
+    from exercise_recording_data import DistanceMatrix, ExerciseRecordingDataSet
+    from master_utils import (dprint,
+                              number_of_distances,
+                              show_progress,
+                              strftime_elapsed,
+                              readExerciseCSV)
+    from sequence_store import SequenceStore
 
     if args.sensors_required:
         sensors_required = args.sensors_required
@@ -176,18 +494,29 @@ if __name__ == "__main__":
     else:
         dprint("Using all available sensors", verbose=args.verbose)
 
-    if args.dist_type == "quaternion":
-        distfunc = quaternion_distance
-        dprint("Using quaternion distance function", verbose=args.verbose)
-    elif args.dist_type == "euclidean":
-        dprint("Using euclidean distance function", verbose=args.verbose)
-        distfunc = euclidean_distance
+    dprint("Using {} distance function".format(args.dist_type), verbose=args.verbose)
+
+    dtw_parameters = {"dist_type": args.dist_type,
+                      "data_type": args.data_type,
+                      "dtw_engine": args.dtw_engine,
+                      "window": args.window}
+    if args.dtw_engine == "banded":
+        dtw_parameters["band"] = args.band
+        if args.band == "itakura":
+            dtw_parameters["max_slope"] = args.max_slope
+    if args.knn:
+        dtw_parameters["knn"] = args.knn
+
+    dtw = make_dtw_function(args.dist_type, args.dtw_engine,
+                            window=args.window, band=args.band, max_slope=args.max_slope)
+    dprint("Using DTW engine {}".format(args.dtw_engine), verbose=args.verbose)
 
     np.seterr(all='raise')
     dprint("Using {} processes.".format(args.jobs), verbose=args.verbose)
 
     # Contains all sensor data for all exercise recordings
     exercise_recording_data_set = ExerciseRecordingDataSet()
+    exercise_recording_data_set.dtw_parameters = dtw_parameters
 
     # Find files to parse
     files = traverse_data_files(verbose=args.verbose)
@@ -203,6 +532,7 @@ if __name__ == "__main__":
         start_time = time.time()
         short_func = functools.partial(readExerciseCSV,
                                        sensor_id_category=args.sensor_id_category,
+                                       use_sidecar=not args.no_sidecar,
                                        verbose=args.verbose)
         parsed_it = pool.imap_unordered(short_func, files)
 
@@ -242,16 +572,7 @@ if __name__ == "__main__":
         pool.join()
 
     # Aggregate data we're interested in computing distances for for each sensor
-    data_sequences_by_sensor = []
-    sensors = exercise_recording_data_set.get_sensors()
-    for sensor in sensors:
-        data_sequences = exercise_recording_data_set.get_data_sequences(data_types=[args.data_type], sensors=[sensor])
-        if len(data_sequences) == 0:
-            print("Sensor {} is missing data type '{}', skipping".format(sensor, args.data_type))
-            continue
-        data_sequences_by_sensor.append(data_sequences)
-        # FIXME Slow?
-        [ds.prepare_cost_array(len(data_sequences) - 1) for ds in data_sequences]
+    data_sequences_by_sensor = get_data_sequences_by_sensor(exercise_recording_data_set, args.data_type)
 
     if len(data_sequences_by_sensor) == 0:
         print("No data found for type {} for sensors {}".format(args.data_type, ", ".join(args.sensors_required)))
@@ -263,68 +584,199 @@ if __name__ == "__main__":
            .format(args.data_type, sum([len(dss) for dss in data_sequences_by_sensor])), verbose=args.verbose)
     dprint("Jobs generated: {}\n".format(num_jobs), verbose=args.verbose)
 
-    # Prepare efficient arrays for jobs and results?
-    job_dt = np.dtype( {'names': ["s", "i", "j", "sequence_1", "sequence_2", "distfunc"],
-                        'formats': ['int', 'int', 'int', DataSequence, DataSequence, 'object_']} )
-    jobs_all = np.full(num_jobs, float('Inf'), dtype=job_dt)
-
-    for i, job in enumerate(get_dtw_jobs(data_sequences_by_sensor, distfunc)):
-        for name in job_dt.names:
-            jobs_all[i][name] = job[name]
-
-    result_dt = np.dtype( {'names': ["s", "i", "j", "cost"],
-                           'formats': ['int', 'int', 'int', 'float64']} )
-
-    start_time = time.time()
-    end_time = 0
-    results_all = []
-    with mp.Pool(processes=args.jobs) as pool:
-        results_it = pool.imap_unordered(compute_dtw_job, jobs_all)
-        for i, res in enumerate(results_it):
-            results_all.append(res)
-            show_progress("DTW", num_jobs, i+1, start_time)
-
-        end_time = time.time()
-        pool.close()
-        pool.join()
-
-    print("Done with DTW after {} at {}"
-          .format(strftime_elapsed(end_time - start_time), time.strftime("%H:%M:%S", time.localtime(time.time()))))
-
-    # Handle results: populate cost array for every DataSequence
-    for result in results_all:
-            # result = resultQueue.get()
-            s = result["s"]
-            i = result["i"]
-            j = result["j"]
-            cost = result["cost"]
-
-            sequence_1 = data_sequences_by_sensor[s][i]
-            sequence_2 = data_sequences_by_sensor[s][i+j+1]
-
-            # Set distance for both sequences
-            sequence_1.costs[i+j][0] = cost
-            sequence_1.costs[i+j][1] = sequence_2
-
-            sequence_2.costs[i][0] = cost
-            sequence_2.costs[i][1] = sequence_1
-
-    for data_sequences in data_sequences_by_sensor:
-        for data_sequence in data_sequences:
-            data_sequence.order_costs()
-            data_sequence.index_cost_by_data_sequence_object()
-
-    # Save complete exercise structure
-    pickledir = "pickles"
-    if not os.path.exists(pickledir):
-        os.makedirs(pickledir)
+    parameters_key = DistanceCache.parameters_key(dtw_parameters)
+    sequence_keys_by_sensor = [[DistanceCache.sequence_key(ds) for ds in data_sequences]
+                               for data_sequences in data_sequences_by_sensor]
+
+    cache = None
+    if not args.no_cache:
+        cache = DistanceCache(args.cache, max_entries=args.cache_size, verbose=args.verbose)
+
+    # Distances computed so far are appended to the checkpoint, write out the last ones even if interrupted
+    if args.checkpoint is None:
+        args.checkpoint = os.path.join("pickles", "dtw_checkpoint.pickle")
+        if args.shard:
+            args.checkpoint = os.path.join("pickles", "dtw_checkpoint_shard_{}_of_{}.pickle".format(*args.shard))
+    try:
+        checkpoint = DistanceCheckpoint(args.checkpoint, resume=args.resume, interval=args.checkpoint_interval,
+                                        verbose=args.verbose)
+    except FileExistsError:
+        print("Found the checkpoint {} of an interrupted run. Run again with --resume to keep its distances, or "
+              "delete it to start over.".format(args.checkpoint))
+        sys.exit(1)
+    atexit.register(checkpoint.flush)
+
+    known_costs = checkpoint.entries
+    if cache is not None:
+        known_costs = collections.ChainMap(cache.entries, checkpoint.entries)
+
+    def get_known_cost(s, i, j):
+        """ Return the distance from the cache or the resumed checkpoint, or None """
+        key = get_pair_key(parameters_key, sequence_keys_by_sensor[s], i, j)
+        cost = cache.get(key) if cache is not None else None
+        if cost is None:
+            cost = checkpoint.entries.get(key)
+            if cost is not None and cache is not None:
+                cache.add(key, cost)
+        return cost
+
+    def add_known_cost(s, i, j, cost):
+        """ Count a distance a worker found in its copy of the cache or the resumed checkpoint, keeping it cached """
+        if cache is not None:
+            cache.hits += 1
+            cache.add(get_pair_key(parameters_key, sequence_keys_by_sensor[s], i, j), cost)
+
+    def add_computed_cost(s, i, j, cost):
+        key = get_pair_key(parameters_key, sequence_keys_by_sensor[s], i, j)
+        checkpoint.add(key, cost)
+        if cache is not None:
+            cache.add(key, cost)
+
+    # Pack all sequences into shared memory once, so jobs only need to refer to them by index
+    store = SequenceStore.create([[ds.data for ds in data_sequences] for data_sequences in data_sequences_by_sensor])
+    num_sequences_by_sensor = [len(data_sequences) for data_sequences in data_sequences_by_sensor]
+
+    # One condensed distance matrix per sensor
+    distance_matrices = [DistanceMatrix(data_sequences[0].sensor, args.data_type, data_sequences,
+                                        dtype=args.distance_dtype)
+                         for data_sequences in data_sequences_by_sensor]
+
+    # Free the shared memory even if the run is interrupted
+    shared_costs = None
+    try:
+        if args.knn:
+            lower_bound_function = make_lower_bound_function(args.dist_type, args.dtw_engine, window=args.window,
+                                                             band=args.band, max_slope=args.max_slope)
+            # Distances of the pairs any worker has computed or found in the cache so far, NaN for the others, stored
+            # like a sequence per sensor
+            shared_costs = SequenceStore.create([[np.full(num_sequences * (num_sequences - 1) // 2, np.nan)]
+                                                 for num_sequences in num_sequences_by_sensor])
+            initargs = {"dtw": dtw, "lower_bound_function": lower_bound_function,
+                        "shared_costs_info": shared_costs.attach_info(),
+                        "cached_costs": known_costs,
+                        "parameters_key": parameters_key,
+                        "sequence_keys_by_sensor": sequence_keys_by_sensor}
+
+            start_time = time.time()
+            computed = 0
+            for result in run_dtw_jobs("k-NN", store, get_knn_jobs(num_sequences_by_sensor),
+                                       sum(num_sequences_by_sensor), args.jobs,
+                                       functools.partial(compute_knn_job, k=args.knn), **initargs):
+                # Keep every distance computed on the way, the k nearest neighbours are always among them
+                distance_matrix = distance_matrices[result["s"]]
+                for j, cost in result["distances"]:
+                    distance_matrix.set(result["i"], j, cost)
+                computed += len(result["distances"])
+
+                # The costs of cache hits come from the worker, as the parent's cache may have evicted them since
+                for j, cost in result["cache_hits"]:
+                    distance_matrix.set(result["i"], j, cost)
+                    add_known_cost(result["s"], result["i"], j, cost)
+                for j, cost in result["distances"]:
+                    add_computed_cost(result["s"], result["i"], j, cost)
+                if cache is not None:
+                    cache.misses += len(result["distances"])
+            end_time = time.time()
+
+            print("Done with k-NN after {} at {}, computed {} DTW distances ({:.1f}% of all pairs)"
+                  .format(strftime_elapsed(end_time - start_time),
+                          time.strftime("%H:%M:%S", time.localtime(time.time())),
+                          computed, 100 * computed / num_jobs))
+        else:
+            jobs = get_dtw_jobs(num_sequences_by_sensor)
+            if args.shard:
+                jobs = list(jobs)
+                costs = [estimate_pair_cost(store.length(s, i), store.length(s, j), args.dtw_engine, args.window,
+                                            args.band)
+                         for s, i, j in jobs]
+                jobs = shard_dtw_jobs(jobs, costs, args.shard[0] - 1, args.shard[1])
+                dprint("Shard {}/{} has {} of {} jobs".format(args.shard[0], args.shard[1], len(jobs), num_jobs),
+                       verbose=args.verbose)
+
+            # Only compute distances missing from the cache and the resumed checkpoint
+            jobs_all = []
+            results_all = []
+            for s, i, j in jobs:
+                cost = get_known_cost(s, i, j)
+                if cost is None:
+                    jobs_all.append((s, i, j))
+                else:
+                    results_all.append((s, i, j, cost))
+
+            dprint("Found {} distances in cache or checkpoint, computing {}".format(len(results_all), len(jobs_all)),
+                   verbose=args.verbose)
+
+            start_time = time.time()
+
+            # Calibrate the time per unit of estimated cost on a few jobs spread over the range of costs
+            costs = [estimate_pair_cost(store.length(s, i), store.length(s, j), args.dtw_engine, args.window, args.band)
+                     for s, i, j in jobs_all]
+            order = sorted(range(len(jobs_all)), key=lambda n: costs[n])
+            calibration_jobs = sorted(set(order[int(q * (len(order) - 1))] for q in (0.25, 0.5, 0.75))) if order else []
+            calibration_cost = sum(costs[n] for n in calibration_jobs)
+            for n in calibration_jobs:
+                s, i, j = jobs_all[n]
+                cost = dtw(store.get(s, i), store.get(s, j))
+                results_all.append((s, i, j, cost))
+                add_computed_cost(s, i, j, cost)
+            seconds_per_cost = (time.time() - start_time) / calibration_cost if calibration_cost else 0
+
+            jobs_left = [job for n, job in enumerate(jobs_all) if n not in calibration_jobs]
+            costs_left = [cost for n, cost in enumerate(costs) if n not in calibration_jobs]
+            # Keep enough chunks per worker to balance the load even if the estimate is off
+            target_cost = sum(costs_left) / (4 * args.jobs) if costs_left else 0
+            if seconds_per_cost > 0:
+                target_cost = min(target_cost, args.chunk_seconds / seconds_per_cost)
+            chunks = schedule_dtw_jobs(jobs_left, costs_left, target_cost)
+            dprint("Scheduled {} jobs in {} chunks".format(len(jobs_left), len(chunks)), verbose=args.verbose)
+
+            busy_by_worker = {}
+            pool_start_time = time.time()
+            for chunk_result in run_dtw_jobs("DTW", store, chunks, len(jobs_left), args.jobs, compute_dtw_chunk,
+                                             job_count=lambda chunk_result: len(chunk_result["results"]), dtw=dtw):
+                busy_by_worker[chunk_result["pid"]] = busy_by_worker.get(chunk_result["pid"], 0) + chunk_result["busy"]
+                results_all.extend(chunk_result["results"])
+                for s, i, j, cost in chunk_result["results"]:
+                    add_computed_cost(s, i, j, cost)
+            end_time = time.time()
+
+            print("Done with DTW after {} at {}"
+                  .format(strftime_elapsed(end_time - start_time),
+                          time.strftime("%H:%M:%S", time.localtime(time.time()))))
+
+            if busy_by_worker:
+                pool_time = end_time - pool_start_time
+                print("Worker utilization: {}".format(", ".join("{}: {:.1f}%".format(pid, 100 * busy / pool_time)
+                                                               for pid, busy in sorted(busy_by_worker.items()))))
+
+            # Handle results: fill in the distance matrix of every sensor
+            if results_all:
+                results = np.array(results_all)
+                sensor_indices = results[:, 0].astype(int)
+                for s, distance_matrix in enumerate(distance_matrices):
+                    mask = sensor_indices == s
+                    distance_matrix.set(results[mask, 1].astype(int), results[mask, 2].astype(int), results[mask, 3])
+    finally:
+        for shared_store in [store, shared_costs]:
+            if shared_store is not None:
+                shared_store.close()
+                shared_store.unlink()
+
+    for distance_matrix in distance_matrices:
+        exercise_recording_data_set.add_distance_matrix(distance_matrix)
+
+    if cache is not None:
+        cache.save()
+        print(cache.stats())
+
+    # Save complete exercise structure, or this shard's part of it
+    if args.shard:
+        save_dtw_shard(exercise_recording_data_set, args.shard, sequence_keys_by_sensor)
+    else:
+        save_exercise_recording_data_set(exercise_recording_data_set, args.dist_type)
 
-    isotime = datetime.datetime.now().isoformat()
-    exercise_recordings_file = pickledir + '/exercise_recording_data_set_' + args.dist_type + "_" + isotime + '.pickle'
-    with open(exercise_recordings_file, "wb") as pf:
-            # Pickle the 'data' dictionary using the highest protocol available.
-            pickle.dump(exercise_recording_data_set, pf, pickle.HIGHEST_PROTOCOL)
-            dprint("Saved {}".format(exercise_recordings_file), verbose=True)
+    # The results are safely stored, so the checkpoint is no longer needed
+    checkpoint.remove()
 
     if args.debug:
         print("\First three closest distances for each sample ::")
@@ -334,7 +786,7 @@ if __name__ == "__main__":
                 print('{:<25}->'.format(quat_sequence.full_name), end='')
                 # print first 3 costs
                 # for cost in qs.costs:
-                for i in range(3):
+                for i in range(min(3, len(quat_sequence.costs))):
                     cost = quat_sequence.costs[i]
                     try:
                         formatted = '{:>10} ({:>6.2f})'.format(cost[1].full_name, cost[0])
@@ -342,3 +794,7 @@ if __name__ == "__main__":
                     except:
                         print("Error on: {}".format(cost), end='')
                 print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,11 @@
 #!/usr/bin/python3
 import argparse
-import json
 import os
 import socket
-import struct
 import sys
 
 from motion_logger import MotionLogger
+from sample_protocol import SampleReader
 
 
 if __name__ == "__main__":
@@ -16,6 +15,12 @@ if __name__ == "__main__":
     parser.add_argument("-m","--mode", help="Mode code number representing an execution type "
                         "(for instance an error type or correct)", required=True)
     parser.add_argument("-n","--num", help="Sample number", required=True)
+    parser.add_argument("-s", "--sensors", nargs='+', default=None,
+                        help="Only record the sensors whose ids match these patterns, like 'myo*'. Default is all")
+    parser.add_argument("--json", action="store_true", help="Receive json messages from the message bus instead of "
+                        "binary samples")
+    parser.add_argument("--ring", action="store_true", help="Read the samples from the sample ring of a message bus "
+                        "started with --ring-slots, in shared memory instead of the socket")
     args = parser.parse_args()
 
     ts_dir = "ts" + args.ts_id
@@ -32,8 +37,6 @@ if __name__ == "__main__":
     server_address = '/tmp/sensor_consumer'
     print("Connecting to message bus at {}".format( server_address ) )
 
-    header_length = struct.calcsize("!l")
-
     try:
         sock.connect(server_address)
     except socket.error:
@@ -43,25 +46,14 @@ if __name__ == "__main__":
         print("Connected to message bus")
 
     logger = MotionLogger(filepath)
+    reader = SampleReader(sock, binary=not args.json, sensors=args.sensors, ring=args.ring)
     try:
         while True:
-            data = None
-            tmp_sz = sock.recv( header_length )
-            if len(tmp_sz) == 0:
+            deserialized_data = reader.read()
+            if deserialized_data is None:
                 print("Connection dropped! Exiting")
                 sys.exit(1)
 
-            size = int(struct.unpack("!l", tmp_sz)[0])
-            data = sock.recv( size )
-            while size-len(data) > 0:
-                tmp = sock.recv(size-len(data))
-                if len(tmp) > 0:
-                    data += tmp
-                else:
-                    print("Connection dropped!")
-                    sys.exit(1)
-
-            deserialized_data = json.loads(data.decode('utf-8'))
             logger.addData(deserialized_data)
 
     except KeyboardInterrupt:
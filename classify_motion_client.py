@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+import argparse
+import json
+import socket
+import struct
+import sys
+import time
+
+
+def get_argument_parser():
+    """ Command line arguments of classify_motion_client.py """
+    parser = argparse.ArgumentParser(description="Connect to message bus and classify the motion data in real time by "
+                                     "matching it against the exercise recordings of a data set with subsequence DTW")
+    parser.add_argument('library', help="Data set file generated by calc_dtw.py, or pickle containing an "
+                        "ExerciseRecordingDataSet, used as reference library")
+    parser.add_argument('-s', '--sensors', nargs='*', default=[],
+                        help="Sensors to classify. If not specified, use all sensors in the library")
+    parser.add_argument('-t', '--data-type', default="quat", help="Data type to use")
+    parser.add_argument('-d', '--dist-type', choices=["quaternion", "euclidean"], default=None,
+                        help="Distance function. Default is the one the library was computed with")
+    parser.add_argument('--threshold-scale', default=1.0, type=float,
+                        help="A match must be closer than the distance from the reference to its nearest neighbour of "
+                        "the same exercise and mode, times this. Default is 1")
+    parser.add_argument('--threshold', default=None, type=float,
+                        help="Fixed distance threshold for all references, instead of one from the library")
+    parser.add_argument('--max-slope', default=2.0, type=float,
+                        help="A match must be at least 1/MAX_SLOPE as long as the reference. Default is 2")
+    parser.add_argument('-i', '--sensor-id', dest="sensor_id_category", default='id',
+                        help="The name of the message field containing the sensor id. Default is 'id'")
+    return parser
+
+
+def get_thresholds(distance_matrix, scale):
+    """
+    Match threshold of every reference sequence of a distance matrix: the distance to its nearest neighbour of the
+    same exercise and mode, times scale. NaN distances are ignored. References without one get the median of the
+    others.
+    """
+    import numpy as np
+
+    thresholds = np.full(len(distance_matrix), np.inf)
+    for i, ds in enumerate(distance_matrix.data_sequences):
+        row = distance_matrix.row(i)
+        same = row[[j for j, other in enumerate(distance_matrix.data_sequences)
+                    if other.exercise == ds.exercise and other.mode == ds.mode]]
+        if np.isnan(same).all():
+            continue
+        thresholds[i] = np.nanmin(same) * scale
+    known = np.isfinite(thresholds)
+    if not known.any():
+        return None
+    thresholds[~known] = np.median(thresholds[known])
+    return thresholds
+
+
+class StreamClassifier:
+    """
+    Matches the stream of one sensor against every reference sequence of that sensor at once.
+
+    The local costs between a new sample and all references are computed in one call on the concatenated references,
+    then every reference's SubsequenceMatcher is updated with its part of them.
+    """
+    def __init__(self, sensor, data_sequences, thresholds, dist_type="quaternion", max_slope=2.0):
+        import numpy as np
+
+        from dtw_engines import COST_MATRIX_FUNCTIONS, SubsequenceMatcher
+
+        self.sensor = sensor
+        self.data_sequences = data_sequences
+        self.cost_matrix_function = COST_MATRIX_FUNCTIONS[dist_type]
+        self.references = np.concatenate([np.asarray(ds.data, dtype=np.float64) for ds in data_sequences])
+        self.offsets = np.cumsum([0] + [len(ds.data) for ds in data_sequences])
+        self.matchers = [SubsequenceMatcher(len(ds.data), threshold, min_length=int(np.ceil(len(ds.data) / max_slope)))
+                         for ds, threshold in zip(data_sequences, thresholds)]
+
+        # End of the last reported match, to suppress overlapping matches of other references
+        self.last_end = -1
+
+        self.samples = 0
+        self.update_seconds = 0.0
+
+    def update(self, sample, arrival_time):
+        """ Add a sample and return a list of (data sequence, (distance, start, end, arrival time of end)) matches """
+        import numpy as np
+
+        start_time = time.time()
+        cost_row = self.cost_matrix_function(np.asarray(sample, dtype=np.float64).reshape(1, -1), self.references)[0]
+        matches = []
+        for n, matcher in enumerate(self.matchers):
+            match = matcher.update(cost_row[self.offsets[n]:self.offsets[n+1]], arrival_time)
+            if match is not None:
+                matches.append((match[0] / max(matcher.threshold, np.finfo(np.float64).tiny), n, match))
+
+        # Of the matches reported at once, the one closest relative to its threshold goes first
+        reported = []
+        for _, n, match in sorted(matches):
+            if match[1] > self.last_end:
+                reported.append((self.data_sequences[n], match))
+                self.last_end = match[2]
+
+        self.samples += 1
+        self.update_seconds += time.time() - start_time
+        return reported
+
+
+def receive(sock, size):
+    data = b''
+    while len(data) < size:
+        tmp = sock.recv(size - len(data))
+        if len(tmp) == 0:
+            return None
+        data += tmp
+    return data
+
+
+def main():
+    args = get_argument_parser().parse_args()
+
+    # Only imported once the arguments are parsed, so --help and usage errors don't wait for numpy and the data modules
+    from create_confusion_matrix import get_distance_matrices
+    from exercise_recording_data import ExerciseRecordingDataSet
+
+    library = ExerciseRecordingDataSet.load(args.library, sensors=args.sensors, data_types=[args.data_type])
+    dist_type = args.dist_type or getattr(library, "dtw_parameters", {}).get("dist_type", "quaternion")
+
+    sensors = args.sensors if len(args.sensors) > 0 else sorted(library.get_sensors())
+    classifiers = {}
+    for sensor in sensors:
+        data_sequences = sorted(library.get_data_sequences(sensors=[sensor], data_types=[args.data_type]))
+        if len(data_sequences) == 0:
+            print("Sensor {} has no '{}' data in the library, skipping".format(sensor, args.data_type))
+            continue
+        if args.threshold is not None:
+            thresholds = [args.threshold] * len(data_sequences)
+        else:
+            distance_matrix = get_distance_matrices(library, [sensor], args.data_type)[0]
+            thresholds = get_thresholds(distance_matrix, args.threshold_scale)
+            if thresholds is None:
+                print("The library has no distances for sensor {}, use --threshold".format(sensor))
+                sys.exit(1)
+            # The distance matrix only has the references with costs
+            data_sequences = distance_matrix.data_sequences
+        classifiers[sensor] = StreamClassifier(sensor, data_sequences, thresholds, dist_type=dist_type,
+                                                max_slope=args.max_slope)
+        print("Sensor {}: {} references".format(sensor, len(data_sequences)))
+
+    # Create UDS socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    server_address = '/tmp/sensor_consumer'
+    print("Connecting to message bus at {}".format( server_address ) )
+
+    header_length = struct.calcsize("!l")
+
+    try:
+        sock.connect(server_address)
+    except socket.error:
+        print(socket.error)
+        sys.exit(1)
+    else:
+        print("Connected to message bus")
+
+    try:
+        while True:
+            tmp_sz = receive(sock, header_length)
+            if tmp_sz is None:
+                print("Connection dropped! Exiting")
+                sys.exit(1)
+            data = receive(sock, int(struct.unpack("!l", tmp_sz)[0]))
+            if data is None:
+                print("Connection dropped! Exiting")
+                sys.exit(1)
+            arrival_time = time.time()
+
+            message = json.loads(data.decode('utf-8'))
+            sensor = str(message.get(args.sensor_id_category))
+            # LPMS sensors send their data in a nested 'data' field
+            sample = message.get(args.data_type, message.get("data", {}).get(args.data_type))
+            if sensor not in classifiers or sample is None:
+                continue
+
+            for ds, (distance, start, end, end_time) in classifiers[sensor].update(sample, arrival_time):
+                print("{}: exercise {} mode {} (reference {}, distance {:.3f}, samples {}-{}), detected {:.1f} ms "
+                      "after its last sample"
+                      .format(sensor, ds.exercise, ds.mode, ds.full_name, distance, start, end,
+                              1000 * (time.time() - end_time)))
+
+    except KeyboardInterrupt:
+        print("\nExiting...")
+        sock.close()
+        for classifier in classifiers.values():
+            if classifier.samples > 0:
+                print("Sensor {}: {} samples, {:.3f} ms per sample"
+                      .format(classifier.sensor, classifier.samples,
+                              1000 * classifier.update_seconds / classifier.samples))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
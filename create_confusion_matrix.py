@@ -1,85 +1,166 @@
 #!/usr/bin/python3
-from master_utils import dprint
+from exercise_recording_data import DistanceMatrix
+from master_utils import dprint, show_progress
 
+import itertools
+import multiprocessing as mp
 import numpy as np
-import sys
+import time
 
 
-def nearest_neighbour(sample, classify_by=None, data_type="quat", sensors=[], k_neighbours=1, leave_me_out=None):
-    """ Classify an exercise recording using k-NN """
-    choices = set()
+# Rows of the distance matrices processed at once, to bound memory use
+ROW_BLOCK_SIZE = 1024
+
+
+def get_distance_matrices(exercise_recording_data_set, sensors, data_type):
+    """
+    Return the DistanceMatrix of every sensor for data_type. Data sets saved before distance matrices have their
+    matrices built from the data sequences' cost arrays.
+    """
+    distance_matrices = []
     for sensor in sensors:
+        if (sensor, data_type) in exercise_recording_data_set.distance_matrices:
+            distance_matrices.append(exercise_recording_data_set.distance_matrices[(sensor, data_type)])
+            continue
+
+        data_sequences = sorted(exercise_recording_data_set.get_data_sequences(sensors=[sensor],
+                                                                               data_types=[data_type],
+                                                                               has_costs=True))
+        distance_matrix = DistanceMatrix(sensor, data_type, data_sequences)
+        index = {id(ds): i for i, ds in enumerate(data_sequences)}
+        for i, ds in enumerate(data_sequences):
+            others = [(index[id(entry[1])], entry[0]) for entry in ds.costs if id(entry[1]) in index]
+            if others:
+                j, cost = zip(*others)
+                distance_matrix.set(np.full(len(j), i), np.array(j), np.array(cost))
+        distance_matrices.append(distance_matrix)
+    return distance_matrices
+
+
+def nearest_neighbours(samples, distance_matrices, classify_by, leave_me_out=None, k_values=[1], weighting="majority"):
+    """
+    Classify every sample using k-NN on the distance matrices of the sensors, for every k in k_values.
+
+    Each sensor finds the k nearest exercise recordings of its own data sequences, and all sensors' neighbours vote for
+    their class. Candidates excluded by the leave_me_out scheme are masked out: 'all' excludes every recording of the
+    sample's tsID, 'exact' only the ones that also have the same class. Ties go to the class of the neighbour with the
+    smallest cost summed over all sensors. The neighbours are found once, for the largest k.
+
+    :param weighting: 'majority' for one vote per neighbour, 'distance' for votes weighted by inverse distance. If any
+                      neighbour is an exact match, only the exact matches vote.
+    :returns: Dict of the list of the predicted class of every sample by k, None where there were no neighbours
+    """
+    if min(k_values) < 1:
+        raise ValueError("k must be at least 1, got {}".format(min(k_values)))
+
+    # Every exercise recording in any of the matrices, numbered
+    exercise_recordings = list(samples)
+    er_ids = {er: n for n, er in enumerate(exercise_recordings)}
+    for distance_matrix in distance_matrices:
+        for ds in distance_matrix.data_sequences:
+            if ds.exercise_recording not in er_ids:
+                er_ids[ds.exercise_recording] = len(exercise_recordings)
+                exercise_recordings.append(ds.exercise_recording)
+
+    er_tsIDs = np.unique(np.array([er.tsID for er in exercise_recordings], dtype=str), return_inverse=True)[1]
+    classes, er_classes = np.unique(np.array([getattr(er, classify_by) for er in exercise_recordings], dtype=str),
+                                    return_inverse=True)
+    er_tsIDs = er_tsIDs.reshape(-1)
+    er_classes = er_classes.reshape(-1)
+
+    # Matrix index of every exercise recording in every sensor's matrix, -1 if missing
+    er_indices = np.full((len(distance_matrices), len(exercise_recordings)), -1, dtype=np.int64)
+    matrix_er_ids = []
+    for s, distance_matrix in enumerate(distance_matrices):
+        ids = np.array([er_ids[ds.exercise_recording] for ds in distance_matrix.data_sequences], dtype=np.int64)
+        er_indices[s, ids] = np.arange(len(ids))
+        matrix_er_ids.append(ids)
+
+    # The k_max nearest neighbours of every sample for every sensor, nearest first, -1 if there are fewer
+    num_samples = len(samples)
+    k_max = max(k_values)
+    neighbours = np.full((num_samples, len(distance_matrices), k_max), -1, dtype=np.int64)
+    neighbour_costs = np.full(neighbours.shape, float('Inf'))
+    for start in range(0, num_samples, ROW_BLOCK_SIZE):
+        block = np.arange(start, min(start + ROW_BLOCK_SIZE, num_samples))
+        for s, distance_matrix in enumerate(distance_matrices):
+            rows = distance_matrix.rows(er_indices[s, block])
+            ids = matrix_er_ids[s]
+            if leave_me_out:
+                excluded = er_tsIDs[block][:, None] == er_tsIDs[ids][None, :]
+                if leave_me_out != "all":
+                    excluded &= er_classes[block][:, None] == er_classes[ids][None, :]
+                rows[excluded] = float('Inf')
 
-        # We only look for quat sequences, one per sensor
-        data_sequence = sample.sensors[sensor][data_type]
-        costs = data_sequence.costs
-
-        votes = {}
-        sub_winner = None
-        sub_score = 0
-
-        # Find the winner for this sensor's data sequence
-        i = 0
-        for entry in costs:
-            other_sample = entry[1]
-            # Crown winner if done
-            if i+1 > k_neighbours:
-                for candidate in votes:
-                    if votes[candidate] > sub_score:
-                        sub_winner = candidate
-                        sub_score = votes[candidate]
-
-                if sub_winner and sub_winner not in choices:
-                    choices.add(sub_winner.exercise_recording)
-                break
-
-            # Only consider this candidate if not excluded due to leave_me_out options
-            if not leave_me_out:
-                # print("Valid!")
-                i += 1
-            elif leave_me_out and other_sample.tsID == data_sequence.tsID:
-                # print("Checking legality of {}".format(other_sample))
-                if ((leave_me_out == "all") or
-                   (classify_by == "exercise" and other_sample.exercise == data_sequence.exercise) or
-                   (classify_by == "mode" and other_sample.mode == data_sequence.mode)):
-                    continue
-                else:
-                    i += 1
-
-            # Add one of the k-closest candiates
-            if other_sample not in votes:
-                votes[other_sample] = 1
+            k = min(k_max, rows.shape[1])
+            if k < rows.shape[1]:
+                nearest = np.argpartition(rows, k - 1, axis=1)[:, :k]
             else:
-                votes[other_sample] += 1
+                nearest = np.broadcast_to(np.arange(k), (len(block), k))
+            costs = np.take_along_axis(rows, nearest, axis=1)
+            # Equal costs ordered by matrix index, like a stable sort of the whole row
+            order = np.lexsort((nearest, costs))
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            costs = np.take_along_axis(costs, order, axis=1)
+            found = np.isfinite(costs)
+            neighbours[block, s, :k] = np.where(found, ids[nearest], -1)
+            neighbour_costs[block, s, :k] = costs
 
-    if len(choices) == 1:
-        return choices.pop()
-    elif len(choices) == 0:
-        return None
+    # Every sensor's neighbours as candidates, with their cost summed over all sensors
+    candidates = neighbours.reshape(num_samples, -1)
+    candidate_costs = neighbour_costs.reshape(num_samples, -1)
+    candidate_ranks = np.tile(np.arange(k_max), len(distance_matrices))
+    valid = candidates >= 0
+    summed_costs = np.zeros(candidates.shape)
+    for s, distance_matrix in enumerate(distance_matrices):
+        rows = np.broadcast_to(er_indices[s, np.arange(num_samples)][:, None], candidates.shape)
+        columns = er_indices[s, candidates]
+        known = valid & (columns >= 0)
+        cost = np.full(candidates.shape, float('Inf'))
+        cost[known] = distance_matrix.condensed[distance_matrix.condensed_index(rows[known], columns[known])]
+        summed_costs += cost
 
-    cost = None
-    winner = 0
-    for choice in choices:
-        sub_cost = 0
-        for sensor in sensors:
-            sub_cost += sample.sensors[sensor][data_type].get_cost(choice.sensors[sensor][data_type])
-        if cost is None or sub_cost < cost:
-            cost = sub_cost
-            winner = choice
-        elif sub_cost < cost:
-            cost = sub_cost
-            winner = choice
+    # Tie-break order of the candidates: summed cost, then sensor and rank
+    tie_order = np.lexsort((np.broadcast_to(np.arange(candidates.shape[1]), candidates.shape), summed_costs))
+    tie_ranks = np.empty_like(tie_order)
+    np.put_along_axis(tie_ranks, tie_order, np.arange(candidates.shape[1]), axis=1)
 
-    return winner
+    candidate_classes = er_classes[np.where(valid, candidates, 0)]
+    sample_indices = np.broadcast_to(np.arange(num_samples)[:, None], candidates.shape)
 
+    predictions = {}
+    for k in k_values:
+        voting = valid & (candidate_ranks < k)[None, :]
+        if weighting == "distance":
+            # Inverse distances relative to the nearest neighbour's, which rank the same but stay within (0, 1] and
+            # can't overflow when summed. With a nearest distance of 0, the exact matches get all the weight.
+            nearest = np.where(voting, candidate_costs, float('Inf')).min(axis=1)[:, None]
+            weights = np.zeros(candidates.shape)
+            np.divide(np.broadcast_to(nearest, candidates.shape), candidate_costs, out=weights,
+                      where=voting & (nearest > 0))
+            weights[voting & (nearest == 0) & (candidate_costs == 0)] = 1.0
+        else:
+            weights = np.ones(candidates.shape)
+        votes = np.zeros((num_samples, len(classes)))
+        np.add.at(votes, (sample_indices[voting], candidate_classes[voting]), weights[voting])
+        best_tie_ranks = np.full(votes.shape, candidates.shape[1])
+        np.minimum.at(best_tie_ranks, (sample_indices[voting], candidate_classes[voting]), tie_ranks[voting])
 
-def create_confusion_matrix(exercise_recording_data_set,
-                            sensors=[],
-                            classify_by='exercise',
-                            data_type='quat',
-                            k_neighbours=1,
-                            leave_me_out=None,
-                            verbose=False):
+        tied = (votes == votes.max(axis=1)[:, None]) & (votes > 0)
+        winners = np.argmin(np.where(tied, best_tie_ranks, candidates.shape[1] + 1), axis=1)
+        predictions[k] = [classes[winner] if voted else None for winner, voted in zip(winners, tied.any(axis=1))]
+    return predictions
+
+
+def create_confusion_matrices(exercise_recording_data_set,
+                              sensors=[],
+                              classify_by='exercise',
+                              data_type='quat',
+                              k_values=[1],
+                              leave_me_out=None,
+                              weighting="majority",
+                              verbose=False):
+    """ Classify every sample with k-NN for every k in k_values and return the confusion matrices by k """
 
     if classify_by == "exercise":
         m_classes = exercise_recording_data_set.get_exercises()
@@ -95,7 +176,6 @@ def create_confusion_matrix(exercise_recording_data_set,
         sensors = exercise_recording_data_set.get_sensors()
 
     dimensions = { 'x': len(m_classes) + 2, 'y': len(m_classes) + 1 }
-    confusion_matrix = np.zeros((dimensions['y'], dimensions['x']))
 
     samples = exercise_recording_data_set.get_exercise_recordings(sensors=sensors, data_types=[data_type], has_costs=True)
 
@@ -105,62 +185,136 @@ def create_confusion_matrix(exercise_recording_data_set,
            "Classify by [{}]\n"
            "Data type   [{}]\n"
            "k-paramter  [{}]\n"
+           "Weighting   [{}]\n"
            "Validation  [{}]\n"
            "Samples     [{}]\n"
-           .format(classify_by, data_type, k_neighbours, validation, len(samples)), verbose=verbose)
+           .format(classify_by, data_type, ", ".join(str(k) for k in k_values), weighting, validation, len(samples)),
+           verbose=verbose)
 
     if len(samples) < 3:
         print("Error: Too few samples to run k-NN. Have {} samples.".format(len(samples)))
         return None
+    if max(k_values) > len(samples) - 1:
+        print("Error: k={} is larger than the {} other samples every sample can be compared to."
+              .format(max(k_values), len(samples) - 1))
+        return None
 
     # Classify every sample
-    for sample in samples:
-        # Majority vote on top n samples
-        sample.predicted = nearest_neighbour(sample,
-                                             data_type=data_type,
-                                             classify_by=classify_by,
-                                             leave_me_out=leave_me_out,
-                                             sensors=sensors,
-                                             k_neighbours=1)
-
-        if not sample.predicted:
-            print("Failed to classify {} - check validation scheme and dataset".format(sample.full_name))
-            continue
+    distance_matrices = get_distance_matrices(exercise_recording_data_set, sensors, data_type)
+    predictions = nearest_neighbours(samples, distance_matrices, classify_by,
+                                     leave_me_out=leave_me_out, k_values=k_values, weighting=weighting)
 
-        if classify_by == "exercise":
-            actual = sample.exercise
-            predicted = sample.predicted.exercise
-        elif classify_by == "mode":
-            actual = sample.mode
-            predicted = sample.predicted.mode
-        else:
-            print("ERROR: INVALID classify_by {}".format(classify_by))
-            sys.exit(1)
+    confusion_matrices = {}
+    for k, predicted_classes in predictions.items():
+        confusion_matrix = np.zeros((dimensions['y'], dimensions['x']))
+        for sample, predicted in zip(samples, predicted_classes):
+            if predicted is None:
+                print("Failed to classify {} - check validation scheme and dataset".format(sample.full_name))
+                continue
 
-        actual_i = m_classes.index(actual)
-        predicted_i = m_classes.index(predicted)
+            actual = getattr(sample, classify_by)
+            actual_i = m_classes.index(actual)
+            predicted_i = m_classes.index(predicted)
 
-        # Count predicted
-        confusion_matrix[actual_i][predicted_i] += 1
-        confusion_matrix[-1][predicted_i] += 1
+            # Count predicted
+            confusion_matrix[actual_i][predicted_i] += 1
+            confusion_matrix[-1][predicted_i] += 1
 
-        # Count actual
-        confusion_matrix[actual_i][-2] += 1
+            # Count actual
+            confusion_matrix[actual_i][-2] += 1
 
-        # Count total
-        confusion_matrix[-1][-2] += 1
+            # Count total
+            confusion_matrix[-1][-2] += 1
 
-    # Calculate average accuracies
-    for i,m_class in enumerate(m_classes):
-        if confusion_matrix[i][-2] > 0:
-            avg_accuracy = confusion_matrix[i][i] / confusion_matrix[i][-2]
-        else:
-            avg_accuracy = 0
+        # Calculate average accuracies
+        for i,m_class in enumerate(m_classes):
+            if confusion_matrix[i][-2] > 0:
+                avg_accuracy = confusion_matrix[i][i] / confusion_matrix[i][-2]
+            else:
+                avg_accuracy = 0
+
+            confusion_matrix[i][-1] = avg_accuracy * 100
+        # Total average accuracy
+        a = sum([ confusion_matrix[i][-1] for i in range(dimensions['y']) ]) / len(m_classes)
+        confusion_matrix[-1][-1] = a
+
+        dprint("k={}\n{}".format(k, confusion_matrix), verbose=verbose)
+        confusion_matrices[k] = confusion_matrix
+    return confusion_matrices
+
+
+def create_confusion_matrix(exercise_recording_data_set,
+                            sensors=[],
+                            classify_by='exercise',
+                            data_type='quat',
+                            k_neighbours=1,
+                            leave_me_out=None,
+                            weighting="majority",
+                            verbose=False):
+    """ Classify every sample with k-NN and return the confusion matrix """
+    confusion_matrices = create_confusion_matrices(exercise_recording_data_set,
+                                                   sensors=sensors,
+                                                   classify_by=classify_by,
+                                                   data_type=data_type,
+                                                   k_values=[k_neighbours],
+                                                   leave_me_out=leave_me_out,
+                                                   weighting=weighting,
+                                                   verbose=verbose)
+    if confusion_matrices is None:
+        return None
+    return confusion_matrices[k_neighbours]
+
+
+def get_sweep_configurations(sensors, k_values, data_type='quat', weighting="majority"):
+    """
+    Generate every combination of sensor subset, class type and validation scheme, as tuples
+    (sensors, classify_by, leave_me_out, k_values, data_type, weighting) consumed by run_sweep_configuration.
+    All k values are evaluated in the same configuration.
+    """
+    for size in range(1, len(sensors) + 1):
+        for subset in itertools.combinations(sorted(sensors), size):
+            for classify_by in ("exercise", "mode"):
+                for leave_me_out in (None, "exact", "all"):
+                    yield (subset, classify_by, leave_me_out, tuple(k_values), data_type, weighting)
+
+
+def init_sweep_worker(exercise_recording_data_set):
+    # With fork, the data set and its memory mapped distance matrices are shared with the parent, not copied
+    global worker_data_set
+    worker_data_set = exercise_recording_data_set
+
+
+def run_sweep_configuration(configuration):
+    """ Create the confusion matrices of one configuration, returning them with the time it took """
+    sensors, classify_by, leave_me_out, k_values, data_type, weighting = configuration
+    start_time = time.time()
+    confusion_matrices = create_confusion_matrices(worker_data_set,
+                                                   sensors=list(sensors),
+                                                   classify_by=classify_by,
+                                                   data_type=data_type,
+                                                   k_values=list(k_values),
+                                                   leave_me_out=leave_me_out,
+                                                   weighting=weighting)
+    return configuration, confusion_matrices, time.time() - start_time
+
+
+def sweep_confusion_matrices(exercise_recording_data_set, configurations, processes=None, verbose=False):
+    """
+    Run the configurations from get_sweep_configurations in a pool of worker processes sharing the data set.
 
-        confusion_matrix[i][-1] = avg_accuracy * 100
-    # Total average accuracy
-    a = sum([ confusion_matrix[i][-1] for i in range(dimensions['y']) ]) / len(m_classes)
-    confusion_matrix[-1][-1] = a
+    :returns: List of (configuration, confusion matrices by k or None, seconds), in the order of configurations
+    """
+    configurations = list(configurations)
+    results = {}
+    with mp.Pool(processes=processes,
+                 initializer=init_sweep_worker,
+                 initargs=(exercise_recording_data_set,)) as pool:
+        start_time = time.time()
+        for configuration, confusion_matrices, seconds in pool.imap_unordered(run_sweep_configuration, configurations):
+            results[configuration] = (confusion_matrices, seconds)
+            if verbose:
+                show_progress("Sweep", len(configurations), len(results), start_time)
 
-    dprint("{}".format(confusion_matrix), verbose=verbose)
-    return confusion_matrix
+        pool.close()
+        pool.join()
+    return [(configuration,) + results[configuration] for configuration in configurations]
@@ -1,10 +1,7 @@
 #!/usr/bin/python3
-from create_confusion_matrix import create_confusion_matrix
-from exercise_recording_data import print_data_set_info
-from plotgrid import plotgrid
-
 import argparse
-import pickle
+import csv
+import os
 import re
 import sys
 
@@ -23,9 +20,35 @@ def get_m_classes(exercise_recording_data_set, classify_by):
         return None
 
 
-if __name__ == '__main__':
+def get_title(disttype, dtw_engine, class_type, k, weighting, sensors, leave_me_out):
+    return "confusion_matrix_{disttype}_{dtw_engine}_by_{class_type}_k={k}{weighting}_sensors_{sensors}_{validation}"\
+        .format(disttype=disttype,
+                dtw_engine=dtw_engine,
+                class_type=class_type,
+                k=k,
+                weighting="_distance_weighted" if weighting == "distance" else "",
+                sensors=sensors if len(sensors) > 0 else "all",
+                validation=("leave_me_out" if leave_me_out is None else leave_me_out))
+
+
+def save_sweep_results(filepath, results):
+    """ Write one row per configuration and k with the total count, accuracy and time of the configuration """
+    with open(filepath, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["sensors", "class_type", "validation", "k", "weighting", "data_type", "samples", "accuracy",
+                         "seconds"])
+        for (sensors, class_type, leave_me_out, k_values, data_type, weighting), confms, seconds in results:
+            for k in k_values:
+                samples, accuracy = (int(confms[k][-1][-2]), confms[k][-1][-1]) if confms is not None else ("", "")
+                writer.writerow(["+".join(sensors), class_type, leave_me_out or "leave-1-out", k, weighting, data_type,
+                                 samples, accuracy, "{:.3f}".format(seconds)])
+    print("Saved {}".format(filepath))
+
+
+def get_argument_parser():
+    """ Command line arguments of data_tester.py """
     parser = argparse.ArgumentParser(description='Generate confusion matrices and classify using k-NN')
-    parser.add_argument('inputfile', help="Pickle file generated by calc_all_dtw.py containing an ExerciseRecordingDataSet")
+    parser.add_argument('inputfile', help="Data set file generated by calc_dtw.py, or pickle containing an ExerciseRecordingDataSet")
 
     parser.add_argument('-s', '--sensors',
                         nargs='*',
@@ -34,8 +57,17 @@ if __name__ == '__main__':
                         " If not specified, combine all available.")
 
     parser.add_argument('-k', '--k-neighbors',
-                        default=3,
-                        help="Number of neighbors to use for majority voting matches (default 3)")
+                        nargs='+',
+                        type=int,
+                        default=[1],
+                        help="Number of neighbors to use for voting. Several values give one confusion matrix each"
+                        " (default 1)")
+
+    parser.add_argument('-w', '--weighting',
+                        default="majority",
+                        choices=['majority', 'distance'],
+                        help="'majority' for one vote per neighbor or 'distance' for votes weighted by inverse distance"
+                        " (default majority)")
 
     parser.add_argument('--class-type',
                         default="exercise",
@@ -56,55 +88,119 @@ if __name__ == '__main__':
     parser.add_argument('-V', '--verbose', default=False, action="store_true", help="enable verbose mode")
     parser.add_argument('--save', action="store_true", help="save figure to file")
     parser.add_argument('--show', action="store_true", help="show figure")
-
+    parser.add_argument('--sweep', action="store_true",
+                        help="evaluate every combination of sensor subset (of --sensors, or all sensors), class type,"
+                        " validation scheme and k, and save the accuracies to a results table. Figures are only made"
+                        " for the configuration given by the other options")
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int,
+                        help="Number of configurations to evaluate concurrently with --sweep")
+    parser.add_argument('--results', default=None,
+                        help="results table written by --sweep. Default is confusion_matrix_sweep_<distance>_<engine>.csv")
+    return parser
+
+
+def main():
+    parser = get_argument_parser()
     args = parser.parse_args()
+    if min(args.k_neighbors) < 1:
+        parser.error("-k/--k-neighbors must be at least 1")
+
+    # Only imported once the arguments are parsed, so --help and usage errors don't wait for numpy, and matplotlib
+    # is only imported to plot
+    from create_confusion_matrix import create_confusion_matrices, get_sweep_configurations, sweep_confusion_matrices
+    from exercise_recording_data import ExerciseRecordingDataSet, print_data_set_info
 
     exercise_recordings = None
 
-    with open(args.inputfile, 'rb') as f:
-        exercise_recording_data_set = pickle.load(f)
+    # Only the requested sensors and data type are read from the data set file
+    exercise_recording_data_set = ExerciseRecordingDataSet.load(args.inputfile,
+                                                                sensors=args.sensors,
+                                                                data_types=[args.data_type])
 
     # Detect distance function used
-    disttype = re.search('exercise_recording_data_set_([^\W\d_]*)_(.+).pickle', args.inputfile)
+    disttype = re.search(r'exercise_recording_data_set_([^\W\d_]*)_(.+)\.(pickle|dataset)', args.inputfile)
     disttype = disttype.groups()[0] if disttype else None
     if disttype is None:
         disttype = "unknown"
 
+    # Data sets saved before the DTW engine was recorded were all computed with fastdtw
+    dtw_parameters = getattr(exercise_recording_data_set, "dtw_parameters", {})
+    dtw_engine = dtw_parameters.get("dtw_engine", "fastdtw")
+    if dtw_parameters.get("window") is not None:
+        dtw_engine += "_w={}".format(dtw_parameters["window"])
+    if dtw_parameters.get("band") == "itakura":
+        dtw_engine += "_itakura"
+
     if args.verbose:
         print_data_set_info(exercise_recording_data_set)
 
-    confm = create_confusion_matrix(exercise_recording_data_set,
-                                    sensors=args.sensors,
-                                    classify_by=args.class_type,
-                                    data_type=args.data_type,
-                                    k_neighbours=1,
-                                    leave_me_out=args.leave_me_out,
-                                    verbose=args.verbose)
-    if confm is None:
+    if args.sweep:
+        sensors = args.sensors if len(args.sensors) > 0 else exercise_recording_data_set.get_sensors()
+        configurations = get_sweep_configurations(sensors, args.k_neighbors,
+                                                  data_type=args.data_type, weighting=args.weighting)
+        results = sweep_confusion_matrices(exercise_recording_data_set, configurations,
+                                           processes=args.jobs, verbose=args.verbose)
+
+        results_file = args.results
+        if results_file is None:
+            results_file = "confusion_matrix_sweep_{}_{}.csv".format(disttype, dtw_engine)
+        save_sweep_results(results_file, results)
+
+        if args.show or args.save:
+            from plotgrid import plotgrid
+
+            m_classes = get_m_classes(exercise_recording_data_set, args.class_type)
+            labels = [ [m_class for m_class in m_classes] + ["Total", "Accy."], [m_class for m_class in m_classes] + ["Total"]]
+            for (sensors, class_type, leave_me_out, k_values, data_type, weighting), confms, seconds in results:
+                if (confms is None or class_type != args.class_type or leave_me_out != args.leave_me_out or
+                        sorted(sensors) != sorted(args.sensors or exercise_recording_data_set.get_sensors())):
+                    continue
+                for k, confm in confms.items():
+                    plotgrid(confm,
+                             show=args.show,
+                             dpi=int(args.dpi),
+                             title=get_title(disttype, dtw_engine, class_type, k, weighting, args.sensors, leave_me_out),
+                             saveFigure=args.save,
+                             labels=labels,
+                             alpha=0.,
+                             normalized=False)
+        sys.exit(0)
+
+    confms = create_confusion_matrices(exercise_recording_data_set,
+                                       sensors=args.sensors,
+                                       classify_by=args.class_type,
+                                       data_type=args.data_type,
+                                       k_values=args.k_neighbors,
+                                       leave_me_out=args.leave_me_out,
+                                       weighting=args.weighting,
+                                       verbose=args.verbose)
+    if confms is None:
         print("Couldn't create confusion matrix. Check any errors and try running with the -V argument.")
         sys.exit(1)
 
-    title = "confusion_matrix_{disttype}_by_{class_type}_k={k}_sensors_{sensors}_{validation}"\
-        .format(disttype=disttype,
-                class_type=args.class_type,
-                k=args.k_neighbors,
-                sensors=args.sensors if len(args.sensors) > 0 else "all",
-                validation=("leave_me_out" if args.leave_me_out is None else args.leave_me_out))
-
     m_classes = get_m_classes(exercise_recording_data_set, args.class_type)
     labels = [ [m_class for m_class in m_classes] + ["Total", "Accy."], [m_class for m_class in m_classes] + ["Total"]]
 
-    if not args.show and not args.save:
-        sys.exit(0)
-    else:
-        plotgrid(confm,
-                 show=args.show,
-                 dpi=int(args.dpi),
-                 title=title,
-                 saveFigure=args.save,
-                 # saveFigure=False,
-                 labels=labels,
-                 alpha=0.,
-                 normalized=False)
+    if args.show or args.save:
+        from plotgrid import plotgrid
 
-        sys.exit(0)
+    for k, confm in confms.items():
+        title = get_title(disttype, dtw_engine, args.class_type, k, args.weighting, args.sensors, args.leave_me_out)
+        print("{}: {:.2f}% accuracy".format(title, confm[-1][-1]))
+
+        if args.show or args.save:
+            plotgrid(confm,
+                     show=args.show,
+                     dpi=int(args.dpi),
+                     title=title,
+                     saveFigure=args.save,
+                     # saveFigure=False,
+                     labels=labels,
+                     alpha=0.,
+                     normalized=False)
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
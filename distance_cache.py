@@ -0,0 +1,168 @@
+import collections
+import hashlib
+import os
+import pickle
+import time
+
+import numpy as np
+
+
+class DistanceCache:
+    """
+    Persistent cache of DTW distances.
+
+    Entries are keyed by a content hash of both data sequences and of the parameters the distance was computed with,
+    so a rerun only needs to compute the pairs involving new or changed recordings. The least recently used entries
+    are evicted once the cache holds more than max_entries distances.
+
+    :param filepath: Pickle file the cache is loaded from and saved to
+    :param max_entries: Maximum number of distances to keep. If None, never evict.
+    """
+    def __init__(self, filepath, max_entries=None, verbose=False):
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Distance by key, least recently used first
+        self.entries = collections.OrderedDict()
+
+        if os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                self.entries = pickle.load(f)
+            if verbose:
+                print("Loaded {} cached distances from {}".format(len(self.entries), filepath))
+            self._evict()
+
+    @staticmethod
+    def sequence_key(data_sequence):
+        """ Return a content hash of a DataSequence's sensor, data type and data """
+        data = np.ascontiguousarray(data_sequence.data, dtype=np.float64)
+        digest = hashlib.sha1()
+        digest.update("{}\0{}\0{}\0".format(data_sequence.sensor, data_sequence.data_type, data.shape).encode('utf-8'))
+        digest.update(data.tobytes())
+        return digest.digest()
+
+    @staticmethod
+    def parameters_key(dtw_parameters):
+        """ Return a hash of the parameters that affect the value of a distance """
+        relevant = sorted((name, value) for name, value in dtw_parameters.items() if name != "knn")
+        return hashlib.sha1(repr(relevant).encode('utf-8')).digest()
+
+    @staticmethod
+    def pair_key(parameters_key, sequence_key_1, sequence_key_2):
+        """ Return the key of the distance from the first to the second sequence """
+        return hashlib.sha1(parameters_key + sequence_key_1 + sequence_key_2).digest()
+
+    def get(self, key):
+        """ Return the cached distance for key, or None """
+        cost = self.entries.get(key)
+        if cost is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return cost
+
+    def add(self, key, cost):
+        self.entries[key] = cost
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """ Evict the least recently used distances until the cache is within its size limit """
+        if self.max_entries is None:
+            return
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def save(self):
+        directory = os.path.dirname(self.filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file first so an interrupted save doesn't corrupt the cache
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "wb") as f:
+            pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, self.filepath)
+
+    def stats(self):
+        return ("DTW distance cache: {} hits, {} misses, {} evictions, {} entries in {}"
+                .format(self.hits, self.misses, self.evictions, len(self.entries), self.filepath))
+
+
+class DistanceCheckpoint:
+    """
+    Append-only file of DTW distances computed during a run.
+
+    Distances are keyed like DistanceCache entries and written in batches at most every interval seconds, so an
+    interrupted run loses at most the last batch. A truncated batch at the end of the file is ignored when loading.
+
+    :param filepath: File the batches are appended to
+    :param resume: Keep the distances already in filepath. Otherwise filepath must not hold any distances yet, so the
+                   checkpoint of an interrupted run isn't lost by forgetting to resume it.
+    :param interval: Seconds between writes
+    :raises FileExistsError: If filepath isn't empty and resume is False
+    """
+    def __init__(self, filepath, resume=False, interval=60.0, verbose=False):
+        if not resume and os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            raise FileExistsError("Checkpoint {} already exists".format(filepath))
+
+        self.filepath = filepath
+        self.interval = interval
+        self.pending = []
+        self.last_flush = time.time()
+
+        self.entries = {}
+        if resume:
+            self.entries = self.load(filepath)
+            if verbose:
+                print("Resuming with {} distances from {}".format(len(self.entries), filepath))
+
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Rewrite the distances that were read so a truncated batch doesn't hide the ones appended after it
+        with open(filepath, "wb") as f:
+            if self.entries:
+                pickle.dump(list(self.entries.items()), f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filepath):
+        """ Return a dict of all distances in a checkpoint file """
+        entries = {}
+        if not os.path.exists(filepath):
+            return entries
+        with open(filepath, "rb") as f:
+            while True:
+                try:
+                    entries.update(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    break
+        return entries
+
+    def add(self, key, cost):
+        self.pending.append((key, cost))
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """ Append the pending distances to the file """
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        with open(self.filepath, "ab") as f:
+            pickle.dump(self.pending, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def remove(self):
+        """ Delete the checkpoint once the results are saved elsewhere """
+        self.pending = []
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
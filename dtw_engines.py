@@ -0,0 +1,333 @@
+import numpy as np
+
+from fastdtw import fastdtw
+
+
+def euclidean_distance(q,p):
+    if(q[0] == p[0] and
+       q[1] == p[1] and
+       q[2] == p[2] and
+       q[3] == p[3]):
+        return 0
+
+    return np.linalg.norm(q-p)
+
+
+def quaternion_distance(q,p):
+    if(q[0] == p[0] and
+       q[1] == p[1] and
+       q[2] == p[2] and
+       q[3] == p[3]):
+        return 0
+    i = 2 * ((np.inner(q,p))**2) - 1
+    if( i <= 1 and i >= -1):
+        return np.arccos(i)
+    else:
+        i = round(i,1)
+        if( i <= 1 and i >= -1):
+            return np.arccos(i)
+        else:
+            print("Unknown value error in distfunc for \nq={}\np={}\ni={}".format(q,p,i))
+            raise Exception
+
+
+DISTANCE_FUNCTIONS = {"quaternion": quaternion_distance,
+                      "euclidean": euclidean_distance}
+
+
+def quaternion_cost_matrix(x, y):
+    """ Quaternion distance between every sample in x and every sample in y, see quaternion_distance """
+    inner = np.dot(x, y.T)
+    # Rounding errors can push the argument slightly outside of [-1, 1]
+    return np.arccos(np.clip(2 * inner**2 - 1, -1, 1))
+
+
+def euclidean_cost_matrix(x, y):
+    """ Euclidean distance between every sample in x and every sample in y """
+    return np.linalg.norm(x[:, np.newaxis, :] - y[np.newaxis, :, :], axis=2)
+
+
+COST_MATRIX_FUNCTIONS = {"quaternion": quaternion_cost_matrix,
+                         "euclidean": euclidean_cost_matrix}
+
+
+def quaternion_box_distance(x, lower, upper):
+    """ Lower bound of the quaternion distance between every sample in x and any sample inside the box lower..upper """
+    low = x * lower
+    high = x * upper
+    # The inner product with any sample in the box lies between these two sums
+    inner = np.maximum(np.abs(np.minimum(low, high).sum(axis=1)), np.abs(np.maximum(low, high).sum(axis=1)))
+    return np.arccos(np.clip(2 * np.minimum(inner, 1)**2 - 1, -1, 1))
+
+
+def euclidean_box_distance(x, lower, upper):
+    """ Euclidean distance between every sample in x and the closest point inside the box lower..upper """
+    return np.linalg.norm(x - np.clip(x, lower, upper), axis=1)
+
+
+BOX_DISTANCE_FUNCTIONS = {"quaternion": quaternion_box_distance,
+                          "euclidean": euclidean_box_distance}
+
+
+def _window_values(values, values_lo, lo, hi):
+    """ Return values for the columns lo..hi-1 of a row stored from column values_lo, Inf outside of it """
+    window = np.full(hi - lo, np.inf)
+    start = max(lo, values_lo)
+    stop = min(hi, values_lo + len(values))
+    if start < stop:
+        window[start-lo:stop-lo] = values[start-values_lo:stop-values_lo]
+    return window
+
+
+def _accumulate_row(previous, previous_lo, cost_row, lo):
+    """
+    Accumulate one row of the DTW cost matrix.
+
+    D[i,j] = c[i,j] + min(D[i-1,j], D[i-1,j-1], D[i,j-1]). The two first terms only depend on the previous row.
+    Since all local costs are non-negative, the dependency on D[i,j-1] unrolls to a running minimum over the
+    cumulative sum of the row, so the whole row is computed without a Python loop.
+
+    :param previous: Accumulated costs of the previous row, starting at column previous_lo
+    :param cost_row: Local costs of this row, starting at column lo
+    :returns: Accumulated costs of this row, starting at column lo
+    """
+    hi = lo + len(cost_row)
+    step = cost_row + np.minimum(_window_values(previous, previous_lo, lo, hi),
+                                 _window_values(previous, previous_lo, lo - 1, hi - 1))
+    cumulative = np.cumsum(cost_row)
+    return cumulative + np.minimum.accumulate(step - cumulative)
+
+
+def accumulate_cost_matrix(cost_matrix):
+    """ Return the accumulated cost of the optimal warping path through a local cost matrix """
+    # Virtual start cell D[-1,-1] = 0
+    previous, previous_lo = np.zeros(1), -1
+    for cost_row in cost_matrix:
+        previous = _accumulate_row(previous, previous_lo, cost_row, 0)
+        previous_lo = 0
+    return previous[-1]
+
+
+def _connect_window(lo, hi, m):
+    """ Make sure a window has at least one column per row and contains a warping path from (0,0) to (n-1,m-1) """
+    lo = np.clip(lo, 0, m - 1)
+    hi = np.maximum.accumulate(np.clip(np.maximum(hi, lo + 1), 1, m))
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    lo[0] = 0
+    hi[-1] = m
+    return lo, hi
+
+
+def sakoe_chiba_window(n, m, window):
+    """
+    Sakoe-Chiba band of the given radius around the diagonal of a n x m cost matrix.
+
+    :returns: Tuple of arrays (lo, hi) where row i may only be matched with the columns lo[i]..hi[i]-1
+    """
+    center = np.arange(n) * ((m - 1) / (n - 1) if n > 1 else 0)
+    lo = np.ceil(center - window).astype(int)
+    hi = np.floor(center + window).astype(int) + 1
+    return _connect_window(lo, hi, m)
+
+
+def itakura_window(n, m, max_slope=2.0):
+    """
+    Itakura parallelogram with the given maximum slope in a n x m cost matrix. If the lengths differ by more
+    than the slope allows, the parallelogram is widened just enough to contain a warping path.
+
+    :returns: Tuple of arrays (lo, hi) where row i may only be matched with the columns lo[i]..hi[i]-1
+    """
+    i = np.arange(n)
+    lo = np.ceil(np.maximum(i / max_slope, (m - 1) - max_slope * (n - 1 - i))).astype(int)
+    hi = np.floor(np.minimum(max_slope * i, (m - 1) - (n - 1 - i) / max_slope)).astype(int) + 1
+    return _connect_window(lo, hi, m)
+
+
+def band_window(n, m, band="sakoe-chiba", window=None, max_slope=2.0):
+    """ Window of the banded engine for a n x m cost matrix, see banded_dtw """
+    if band == "sakoe-chiba":
+        if window is None:
+            window = max(1, int(0.1 * max(n, m)))
+        return sakoe_chiba_window(n, m, window)
+    elif band == "itakura":
+        return itakura_window(n, m, max_slope)
+    raise ValueError("Unknown band {!r}".format(band))
+
+
+def _envelope(y, lo, hi):
+    """ Lower and upper envelope of y over the columns lo[i]..hi[i]-1 for every row i """
+    # reduceat reduces over indices[k]..indices[k+1]-1, so interleave the window bounds and keep every other result
+    padded = np.concatenate([y, y[-1:]])
+    indices = np.empty(2 * len(lo), dtype=np.intp)
+    indices[0::2] = lo
+    indices[1::2] = hi
+    return (np.minimum.reduceat(padded, indices, axis=0)[0::2],
+            np.maximum.reduceat(padded, indices, axis=0)[0::2])
+
+
+def lb_kim(x, y, cost_matrix_function=quaternion_cost_matrix):
+    """ LB_Kim lower bound: every warping path starts in the first and ends in the last samples of both sequences """
+    first = cost_matrix_function(x[:1], y[:1])[0, 0]
+    if len(x) == 1 and len(y) == 1:
+        return first
+    return first + cost_matrix_function(x[-1:], y[-1:])[0, 0]
+
+
+def lb_keogh(x, y, box_distance_function=quaternion_box_distance, window=None):
+    """
+    LB_Keogh lower bound: every sample in x is matched with at least one sample of y inside its window, so it costs
+    at least the distance to the envelope of y over that window.
+
+    :param window: Tuple of arrays (lo, hi) as returned by band_window, or None for unconstrained DTW
+    """
+    if window is None:
+        lower, upper = y.min(axis=0), y.max(axis=0)
+    else:
+        lower, upper = _envelope(y, *window)
+    return box_distance_function(x, lower, upper).sum()
+
+
+def lower_bound(x, y, dist_type="quaternion", band=None, window=None, max_slope=2.0):
+    """
+    Lower bound of the DTW distance between x and y, valid for every DTW engine.
+
+    :param band: Band of the banded engine, or None for the unconstrained engines
+    """
+    cost_bound = lb_kim(x, y, COST_MATRIX_FUNCTIONS[dist_type])
+    if band is not None:
+        envelope_bound = lb_keogh(x, y, BOX_DISTANCE_FUNCTIONS[dist_type],
+                                  band_window(len(x), len(y), band, window, max_slope))
+    else:
+        envelope_bound = lb_keogh(x, y, BOX_DISTANCE_FUNCTIONS[dist_type])
+    return max(cost_bound, envelope_bound)
+
+
+def exact_dtw(x, y, cost_matrix_function=quaternion_cost_matrix):
+    """ Exact DTW distance between two sequences, computing the local cost matrix in one pass """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return accumulate_cost_matrix(cost_matrix_function(x, y))
+
+
+def dtw_path(x, y, cost_matrix_function=quaternion_cost_matrix):
+    """
+    Optimal warping path between two sequences, keeping the whole accumulated cost matrix to trace it back.
+
+    :returns: Tuple of arrays (i, j) of the matched samples of x and y, from (0, 0) to (n-1, m-1)
+    """
+    cost_matrix = cost_matrix_function(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    n, m = cost_matrix.shape
+    accumulated = np.empty((n, m))
+    previous, previous_lo = np.zeros(1), -1
+    for i, cost_row in enumerate(cost_matrix):
+        previous = _accumulate_row(previous, previous_lo, cost_row, 0)
+        previous_lo = 0
+        accumulated[i] = previous
+
+    i, j = n - 1, m - 1
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        if i == 0:
+            j -= 1
+        elif j == 0:
+            i -= 1
+        else:
+            step = np.argmin((accumulated[i-1, j-1], accumulated[i-1, j], accumulated[i, j-1]))
+            i, j = (i - 1, j - 1) if step == 0 else (i - 1, j) if step == 1 else (i, j - 1)
+        path.append((i, j))
+    path = np.array(path[::-1])
+    return path[:, 0], path[:, 1]
+
+
+def banded_dtw(x, y, cost_matrix_function=quaternion_cost_matrix, band="sakoe-chiba", window=None, max_slope=2.0):
+    """
+    Exact DTW distance constrained to a band around the diagonal. Only local costs inside the band are computed,
+    so the cost is O(n*w) instead of O(n*m).
+
+    :param band: Either 'sakoe-chiba' or 'itakura'
+    :param window: Sakoe-Chiba radius in samples. If None, use 10% of the longest sequence.
+    :param max_slope: Maximum slope of the Itakura parallelogram
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    lo, hi = band_window(n, len(y), band, window, max_slope)
+
+    previous, previous_lo = np.zeros(1), -1
+    for i in range(n):
+        cost_row = cost_matrix_function(x[i:i+1], y[lo[i]:hi[i]])[0]
+        previous = _accumulate_row(previous, previous_lo, cost_row, lo[i])
+        previous_lo = lo[i]
+    return previous[-1]
+
+
+def fastdtw_distance(x, y, distfunc, radius=1):
+    """ Approximate DTW distance using fastdtw with a per sample distance function """
+    dist, path = fastdtw(x, y, radius=radius, dist=distfunc)
+    return dist
+
+
+class SubsequenceMatcher:
+    """
+    Streaming subsequence DTW (SPRING, Sakurai et al. 2007) of one reference sequence against an unbounded stream.
+
+    Only the last column of accumulated costs and the stream position every path in it started at are kept, so memory
+    is bounded by the length of the reference. A match is only reported once no path through a later sample can
+    improve it, and overlapping matches are suppressed.
+
+    :param length: Number of samples in the reference sequence
+    :param threshold: Largest DTW distance reported as a match
+    :param min_length: Fewest stream samples in a match, so the whole reference can't be warped onto a few samples
+    """
+    def __init__(self, length, threshold, min_length=1):
+        self.threshold = threshold
+        self.min_length = min_length
+        self.costs = np.full(length, np.inf)
+        self.starts = np.zeros(length, dtype=np.int64)
+        self.t = -1
+
+        # Best match (distance, start, end, timestamp) not reported yet
+        self.candidate = None
+
+    def update(self, cost_row, timestamp=None):
+        """
+        Extend the matches with the next stream sample.
+
+        :param cost_row: Local costs between the new sample and every sample of the reference
+        :param timestamp: Stored with a match ending at this sample
+        :returns: Tuple (distance, start, end, timestamp) of a match that can't be improved anymore, or None
+        """
+        self.t += 1
+        t = self.t
+
+        # D[t,i] = c[t,i] + min(D[t-1,i-1], D[t-1,i], D[t,i-1]), where D[t,-1] = 0 lets a match start at any t.
+        # The two first terms only depend on the previous column, and D[t,i-1] unrolls to a running minimum over the
+        # cumulative sum like in _accumulate_row, with the start of each path following the running argmin.
+        previous = np.concatenate(([0.0], self.costs))
+        previous_starts = np.concatenate(([t], self.starts))
+        diagonal = previous[:-1] <= previous[1:]
+        step = cost_row + np.where(diagonal, previous[:-1], previous[1:])
+        step_starts = np.where(diagonal, previous_starts[:-1], previous_starts[1:])
+
+        cumulative = np.cumsum(cost_row)
+        entries = np.concatenate(([0.0], step - cumulative))
+        running = np.minimum.accumulate(entries)
+        argmin = np.maximum.accumulate(np.where(entries == running, np.arange(len(entries)), 0))
+        costs = cumulative + running[1:]
+        starts = np.concatenate(([t], step_starts))[argmin[1:]]
+
+        match = None
+        if self.candidate is not None:
+            distance, start, end, _ = self.candidate
+            if np.all((costs >= distance) | (starts > end)):
+                match = self.candidate
+                self.candidate = None
+                costs[starts <= end] = np.inf
+
+        if (costs[-1] <= self.threshold and t - starts[-1] + 1 >= self.min_length and
+                (self.candidate is None or costs[-1] < self.candidate[0])):
+            self.candidate = (float(costs[-1]), int(starts[-1]), t, timestamp)
+
+        self.costs = costs
+        self.starts = starts
+        return match
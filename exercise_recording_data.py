@@ -1,5 +1,9 @@
+import pickle
+
 import numpy as np
 
+from binary_container import read_container, write_container
+
 
 def print_data_set_info(data_set):
     sensors = data_set.get_sensors()
@@ -10,7 +14,8 @@ def print_data_set_info(data_set):
     print("tsIDs:                        {!r}".format(data_set.get_tsIDs()))
     print("Data sequences:               {!r}".format(len(data_set.get_data_sequences())))
     print("Sensors:                      {!r}".format(sensors))
-    print("Data types:                   {!r}\n".format(data_set.get_data_types()))
+    print("Data types:                   {!r}".format(data_set.get_data_types()))
+    print("DTW parameters:               {!r}\n".format(getattr(data_set, "dtw_parameters", None)))
     sensor_contents = {}
     for sensor in sensors:
         sensor_contents[sensor] = {}
@@ -20,7 +25,7 @@ def print_data_set_info(data_set):
                 sensor_contents[sensor][ds.data_type] = None
                 # Only say a sensor's data has cost if ALL of this sensor's data
                 # has costs set
-                if ds.costs is not None:
+                if ds.has_costs():
                     if sensor_contents[sensor][ds.data_type] is None:
                         sensor_contents[sensor][ds.data_type] = True
                     else:
@@ -36,7 +41,103 @@ def print_data_set_info(data_set):
     print("--------------------------------------------------------------------------------")
 
 
+class DistanceMatrix:
+    """
+    Condensed matrix of the distances between all data sequences of one sensor and data type.
+
+    Only the upper triangle is stored, as one flat array, in the same layout as scipy.spatial.distance.squareform.
+    Distances that haven't been computed are Inf.
+    """
+    # Incremented by set(), so data sequences know when the cost arrays they built from the matrix are outdated. A
+    # class attribute, for matrices pickled before it existed
+    version = 0
+
+    def __init__(self, sensor, data_type, data_sequences, dtype=np.float64, condensed=None):
+        self.sensor = sensor
+        self.data_type = data_type
+        self.data_sequences = list(data_sequences)
+        self.names = [ds.full_name for ds in self.data_sequences]
+        size = len(self.data_sequences)
+        if condensed is None:
+            condensed = np.full(size * (size - 1) // 2, float('Inf'), dtype=dtype)
+        self.condensed = condensed
+        self._data_sequence_array = None
+
+    def __len__(self):
+        return len(self.data_sequences)
+
+    def condensed_index(self, i, j):
+        """ Index into the condensed array of the distance between sequence i and j. Works on arrays of indices. """
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        return len(self) * i - i * (i + 1) // 2 + j - i - 1
+
+    def get(self, i, j):
+        if i == j:
+            return 0.0
+        return self.condensed[self.condensed_index(i, j)]
+
+    def set(self, i, j, cost):
+        """ Set the distance between sequence i and j. Works on arrays of indices and costs. """
+        self.condensed[self.condensed_index(i, j)] = cost
+        self.version += 1
+
+    def row(self, i):
+        """ Return the distances from sequence i to every sequence, with Inf for the sequence itself """
+        others = np.arange(len(self))
+        row = np.full(len(self), float('Inf'), dtype=self.condensed.dtype)
+        mask = others != i
+        row[mask] = self.condensed[self.condensed_index(i, others[mask])]
+        return row
+
+    def rows(self, indices):
+        """ Return the distances from each of the sequences in indices to every sequence, as a (len(indices), size) array """
+        indices = np.asarray(indices)[:, None]
+        others = np.arange(len(self))[None, :]
+        rows = np.full((indices.shape[0], len(self)), float('Inf'), dtype=self.condensed.dtype)
+        mask = indices != others
+        rows[mask] = self.condensed[self.condensed_index(indices, others)[mask]]
+        return rows
+
+    def square(self):
+        """ Return the full distance matrix with Inf on the diagonal """
+        size = len(self)
+        square = np.full((size, size), float('Inf'), dtype=self.condensed.dtype)
+        i, j = np.triu_indices(size, 1)
+        square[i, j] = self.condensed
+        square[j, i] = self.condensed
+        return square
+
+    def data_sequence_array(self):
+        """ Return the data sequences as a numpy object array, for fancy indexing """
+        if self._data_sequence_array is None:
+            self._data_sequence_array = np.empty(len(self), dtype=object)
+            self._data_sequence_array[:] = self.data_sequences
+        return self._data_sequence_array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data_sequence_array"] = None
+        return state
+
+    def __repr__(self):
+        return ("<DistanceMatrix Sensor: {!r}, Data type: {!r}, Sequences: {!r}, dtype: {}>"
+                .format(self.sensor, self.data_type, len(self), self.condensed.dtype))
+
+
 class DataSequence:
+    """
+    The data of one data type from one sensor in an exercise recording.
+
+    Uses __slots__ since a data set holds tens of thousands of data sequences. data is a contiguous (samples, dims)
+    float64 array, unless it can't be converted to one.
+    """
+    __slots__ = ("full_name", "exercise_recording", "tsID", "exercise", "mode", "sample_number", "sensor",
+                 "data_type", "data", "timestamp", "_costs", "_costs_by_data_sequence_object",
+                 "distance_matrix", "distance_index", "_row_costs", "_row_costs_version")
+
+    # Entries of the cost array, shared by all data sequences
+    COST_DT = np.dtype( {'names': ["cost", "data sequence object"], 'formats': ['float64', 'object_']} )
+
     def __init__(self, exercise_recording, tsID, exercise, mode, sample_number, sensor, data_type, timestamp, data):
 
         self.full_name = "_".join([tsID, exercise, mode, sample_number, sensor, data_type])
@@ -47,22 +148,130 @@ class DataSequence:
         self.sample_number = sample_number
         self.sensor = sensor
         self.data_type = data_type
-        self.data = data
+        self.data = self.as_data_array(data)
         self.timestamp = timestamp
 
-        self.cost_dt = np.dtype( {'names': ["cost", "data sequence object"], 'formats': ['float64', 'object_']} )
-        self.costs = None
-        self.costs_by_data_sequence_object = {}
-        self.num_costs = 0
+        self._costs = None
+        self._costs_by_data_sequence_object = None
+
+        # Set by ExerciseRecordingDataSet.add_distance_matrix()
+        self.distance_matrix = None
+        self.distance_index = None
+
+        # Cost array built from the distance matrix, and the version of the matrix it was built from
+        self._row_costs = None
+        self._row_costs_version = None
+
+    @staticmethod
+    def as_data_array(data):
+        """ Return data as a contiguous (samples, dims) float64 array, or unchanged if it isn't numeric """
+        try:
+            array = np.ascontiguousarray(data, dtype=np.float64)
+        except (ValueError, TypeError):
+            return data
+        if array.ndim == 1:
+            array = array.reshape(-1, 1)
+        return array
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+        state["_row_costs"] = None
+        state["_row_costs_version"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Data sequences pickled by older versions have a __dict__ with the cost array stored directly, a cost dtype
+        # per instance and the data as nested lists
+        if isinstance(state, tuple):
+            state = dict(state[1] or {}, **(state[0] or {}))
+        state = dict(state)
+        if "costs" in state:
+            state["_costs"] = state.pop("costs")
+        if "costs_by_data_sequence_object" in state:
+            state["_costs_by_data_sequence_object"] = state.pop("costs_by_data_sequence_object") or None
+        state.setdefault("_costs", None)
+        state.setdefault("_costs_by_data_sequence_object", None)
+        state.setdefault("distance_matrix", None)
+        state.setdefault("distance_index", None)
+        state.setdefault("_row_costs", None)
+        state.setdefault("_row_costs_version", None)
+        if "data" in state:
+            state["data"] = self.as_data_array(state["data"])
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+
+    @property
+    def cost_dt(self):
+        return self.COST_DT
+
+    @property
+    def costs_by_data_sequence_object(self):
+        """ Cost by data sequence object, built from the cost array on first use """
+        if self._costs_by_data_sequence_object is None:
+            self._costs_by_data_sequence_object = {}
+        return self._costs_by_data_sequence_object
+
+    @property
+    def costs(self):
+        """
+        Sorted array of (cost, data sequence object) for every other data sequence with a known distance.
+        If this sequence is part of a distance matrix, the array is built from its row of the matrix, and kept until the
+        matrix changes.
+        """
+        if self.distance_matrix is None:
+            return self._costs
+
+        if self._row_costs is None or self._row_costs_version != self.distance_matrix.version:
+            self._row_costs = self._build_row_costs()
+            self._row_costs_version = self.distance_matrix.version
+        return self._row_costs
+
+    def _build_row_costs(self):
+        row = self.distance_matrix.row(self.distance_index)
+        others = np.flatnonzero(np.isfinite(row))
+        # Stable sort, so equal costs stay ordered by name like when sorting the cost array
+        others = others[np.argsort(row[others], kind='stable')]
+        costs = np.empty(len(others), dtype=self.COST_DT)
+        costs['cost'] = row[others]
+        costs['data sequence object'] = self.distance_matrix.data_sequence_array()[others]
+        return costs
+
+    @costs.setter
+    def costs(self, costs):
+        self._costs = costs
+
+    def has_costs(self):
+        return self.distance_matrix is not None or self._costs is not None
 
     def order_costs(self):
-        np.ndarray.sort(self.costs, order='cost')
+        if self.distance_matrix is None:
+            np.ndarray.sort(self.costs, order='cost')
 
     def index_cost_by_data_sequence_object(self):
+        if self.distance_matrix is not None:
+            return
         for entry in self.costs:
             self.costs_by_data_sequence_object[entry[1]] = entry[0]
 
+    def _shares_distance_matrix(self, data_sequence_object):
+        return (self.distance_matrix is not None and
+                data_sequence_object.distance_matrix is self.distance_matrix)
+
+    def has_cost(self, data_sequence_object):
+        if self._shares_distance_matrix(data_sequence_object):
+            return bool(np.isfinite(self.distance_matrix.get(self.distance_index,
+                                                             data_sequence_object.distance_index)))
+
+        if not self.costs_by_data_sequence_object:
+            self.index_cost_by_data_sequence_object()
+
+        return data_sequence_object in self.costs_by_data_sequence_object
+
     def get_cost(self, data_sequence_object):
+        if self._shares_distance_matrix(data_sequence_object):
+            return self.distance_matrix.get(self.distance_index, data_sequence_object.distance_index)
+
         if not self.costs_by_data_sequence_object:
             self.index_cost_by_data_sequence_object()
 
@@ -96,7 +305,7 @@ class DataSequence:
 
     def prepare_cost_array(self, size, dt=None):
         if dt is None:
-            dt = self.cost_dt
+            dt = self.COST_DT
         self.costs = np.full(size, float('Inf'), dtype=dt)
 
     def __hash__(self):
@@ -123,6 +332,8 @@ class DataSequence:
 
 class ExerciseRecording:
     """ One sensor recording """
+    __slots__ = ("tsID", "exercise", "mode", "sample_number", "timestamp", "full_name", "sensors", "data_sequences")
+
     def __init__(self, tsID, exercise, mode, sample_number, timestamp, input_data):
         self.tsID = tsID
         self.exercise = exercise
@@ -133,26 +344,15 @@ class ExerciseRecording:
         # Every DataSequence object by sensor, then by data_type
         self.sensors = {}
 
-        # Every DataSequence object by data_type, then by sensor
-        self.data_types = {}
-
         # Every DataSequence() object
         self.data_sequences = []
 
         self.full_name = "_".join([tsID, exercise, mode, sample_number])
 
         for sensor in input_data:
-            if sensor not in self.sensors:
-                self.sensors[sensor] = {}
+            self.sensors[sensor] = {}
 
             for data_type in input_data[sensor]:
-                if data_type not in self.data_types:
-                    self.data_types[data_type] = {}
-                    if sensor not in self.data_types[data_type]:
-                        self.data_types[data_type][sensor] = None
-                    if data_type not in self.sensors[sensor]:
-                        self.sensors[sensor][data_type] = None
-
                 new_data_sequence = DataSequence(self,
                                                  tsID,
                                                  exercise,
@@ -163,9 +363,28 @@ class ExerciseRecording:
                                                  timestamp,
                                                  input_data[sensor][data_type])
                 self.data_sequences.append(new_data_sequence)
-                self.data_types[data_type][sensor] = new_data_sequence
                 self.sensors[sensor][data_type] = new_data_sequence
 
+    @property
+    def data_types(self):
+        """ Every DataSequence object by data_type, then by sensor """
+        data_types = {}
+        for sensor, data_sequences in self.sensors.items():
+            for data_type, data_sequence in data_sequences.items():
+                data_types.setdefault(data_type, {})[sensor] = data_sequence
+        return data_types
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        # Exercise recordings pickled by older versions have a __dict__ which also holds data_types
+        if isinstance(state, tuple):
+            state = dict(state[1] or {}, **(state[0] or {}))
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+
     def __hash__(self):
         return hash(self.full_name)
 
@@ -180,12 +399,160 @@ class ExerciseRecording:
 
 
 class ExerciseRecordingDataSet:
+    """
+    Exercise recordings indexed by tsID, exercise, mode, sensor and data type.
+
+    The indexes map every value to the recordings (or data sequences) having it, in the order they were added, so
+    filtered queries only touch the matching recordings. They are updated in add() and rebuilt when unpickled.
+    """
     def __init__(self, exercise_recordings=None):
         self.exercise_recordings = {}
+
+        # Parameters the costs were computed with (distance function, DTW engine, window, ...)
+        self.dtw_parameters = {}
+
+        # DistanceMatrix by (sensor, data type)
+        self.distance_matrices = {}
+
+        self._reset_indexes()
         if exercise_recordings is not None:
             for er in exercise_recordings:
                 self.add(er)
 
+    def _reset_indexes(self):
+        # Position of every exercise recording and data sequence in insertion order
+        self._exercise_recording_order = {}
+        self._data_sequence_order = {}
+
+        # Exercise recordings by attribute name, then value. The inner dicts are used as insertion ordered sets
+        self._exercise_recording_index = {"tsID": {}, "exercise": {}, "mode": {}, "sensor": {}, "data_type": {}}
+
+        # Data sequences by (sensor, data type)
+        self._data_sequence_index = {}
+
+    def _index(self, exercise_recording):
+        index = self._exercise_recording_index
+        self._exercise_recording_order[exercise_recording] = len(self._exercise_recording_order)
+        index["tsID"].setdefault(exercise_recording.tsID, {})[exercise_recording] = None
+        index["exercise"].setdefault(exercise_recording.exercise, {})[exercise_recording] = None
+        index["mode"].setdefault(exercise_recording.mode, {})[exercise_recording] = None
+        for ds in exercise_recording.data_sequences:
+            self._data_sequence_order[ds] = len(self._data_sequence_order)
+            index["sensor"].setdefault(ds.sensor, {})[exercise_recording] = None
+            index["data_type"].setdefault(ds.data_type, {})[exercise_recording] = None
+            self._data_sequence_index.setdefault((ds.sensor, ds.data_type), []).append(ds)
+
+    def __getstate__(self):
+        return {name: value for name, value in self.__dict__.items() if not name.startswith("_")}
+
+    def __setstate__(self, state):
+        # Defaults for data sets pickled by older versions
+        self.dtw_parameters = {}
+        self.distance_matrices = {}
+        self.__dict__.update(state)
+        self._reset_indexes()
+        for er in self.exercise_recordings:
+            self._index(er)
+
+    def save(self, filepath):
+        """
+        Save the data set to a container file (see binary_container.py). The data sequences of every sensor and data
+        type and every distance matrix are stored as separate arrays, so load() can memory map only the ones it needs.
+        Costs not stored in a distance matrix are not saved.
+        """
+        recordings = list(self.exercise_recordings)
+        recording_index = {er: n for n, er in enumerate(recordings)}
+        arrays = {}
+
+        groups = []
+        for (sensor, data_type), data_sequences in self._data_sequence_index.items():
+            group = {"sensor": sensor, "data_type": data_type, "recordings": [], "shapes": [], "objects": {},
+                     "array": "sequences/{}".format(len(groups))}
+            chunks = []
+            for ds in data_sequences:
+                group["recordings"].append(recording_index[ds.exercise_recording])
+                if isinstance(ds.data, np.ndarray) and ds.data.dtype == np.float64:
+                    group["shapes"].append(ds.data.shape)
+                    chunks.append(ds.data.ravel())
+                else:
+                    group["shapes"].append(None)
+                    group["objects"][len(group["shapes"]) - 1] = ds.data
+            arrays[group["array"]] = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float64)
+            groups.append(group)
+
+        matrices = []
+        for (sensor, data_type), distance_matrix in self.distance_matrices.items():
+            matrix = {"sensor": sensor, "data_type": data_type,
+                      "recordings": [recording_index[ds.exercise_recording] for ds in distance_matrix.data_sequences],
+                      "array": "distances/{}".format(len(matrices))}
+            arrays[matrix["array"]] = distance_matrix.condensed
+            matrices.append(matrix)
+
+        metadata = {"dtw_parameters": self.dtw_parameters,
+                    "recordings": [(er.tsID, er.exercise, er.mode, er.sample_number, er.timestamp) for er in recordings],
+                    "sequences": groups,
+                    "distance_matrices": matrices}
+        write_container(filepath, metadata, arrays)
+
+    @classmethod
+    def load(cls, filepath, sensors=None, data_types=None):
+        """
+        Load a data set saved with save(). Only the data sequences and distance matrices of the given sensors and data
+        types are read, as read-only views of the memory mapped file. Files that aren't containers are loaded as
+        pickles written by older versions, in full.
+
+        :param sensors: Sensors to load. If None or empty, load all.
+        :param data_types: Data types to load. If None or empty, load all.
+        """
+        container = read_container(filepath, names=[])
+        if container is None:
+            with open(filepath, 'rb') as f:
+                return pickle.load(f)
+        metadata = container[0]
+
+        def wanted(entry):
+            return ((not sensors or entry["sensor"] in sensors) and
+                    (not data_types or entry["data_type"] in data_types))
+
+        groups = [group for group in metadata["sequences"] if wanted(group)]
+        matrices = [matrix for matrix in metadata["distance_matrices"] if wanted(matrix)]
+        arrays = read_container(filepath, names=[entry["array"] for entry in groups + matrices])[1]
+
+        input_data_by_recording = {}
+        for group in groups:
+            data = arrays[group["array"]]
+            offset = 0
+            for n, (r, shape) in enumerate(zip(group["recordings"], group["shapes"])):
+                if shape is None:
+                    sequence = group["objects"][n]
+                else:
+                    size = int(np.prod(shape, dtype=np.int64))
+                    sequence = data[offset:offset+size].reshape(shape)
+                    offset += size
+                input_data_by_recording.setdefault(r, {}).setdefault(group["sensor"], {})[group["data_type"]] = sequence
+
+        recordings = {}
+        for r, input_data in sorted(input_data_by_recording.items()):
+            tsID, exercise, mode, sample_number, timestamp = metadata["recordings"][r]
+            recordings[r] = ExerciseRecording(tsID, exercise, mode, sample_number, timestamp, input_data)
+
+        data_set = cls(recordings.values())
+        data_set.dtw_parameters = metadata["dtw_parameters"]
+        for matrix in matrices:
+            data_sequences = [recordings[r].sensors[matrix["sensor"]][matrix["data_type"]]
+                              for r in matrix["recordings"]]
+            data_set.add_distance_matrix(DistanceMatrix(matrix["sensor"], matrix["data_type"], data_sequences,
+                                                        condensed=arrays[matrix["array"]]))
+        return data_set
+
+    def add_distance_matrix(self, distance_matrix):
+        """ Add a DistanceMatrix and point its data sequences' costs to it """
+        self.distance_matrices[(distance_matrix.sensor, distance_matrix.data_type)] = distance_matrix
+        for i, data_sequence in enumerate(distance_matrix.data_sequences):
+            data_sequence.distance_matrix = distance_matrix
+            data_sequence.distance_index = i
+            data_sequence._row_costs = None
+
     def add(self, exercise_recording, verbose=False):
         if exercise_recording is None:
             return
@@ -198,76 +565,84 @@ class ExerciseRecordingDataSet:
                 self.exercise_recordings[exercise_recording] = exercise_recording
         else:
             self.exercise_recordings[exercise_recording] = exercise_recording
+            self._index(exercise_recording)
 
     def get_exercise_recording_full_names(self):
         """ Return set of full names for all exercise recordings """
-        full_names = set()
-        for er in self.exercise_recordings:
-            full_names.add(er.full_name)
-        return full_names
+        return {er.full_name for er in self.exercise_recordings}
 
     def get_sensors(self):
         """ Return list of sensors in this data set """
-        sensors = set()
-        for er in self.exercise_recordings:
-            for sensor in er.sensors:
-                if sensor not in sensors:
-                    sensors.add(sensor)
-        return list(sensors)
+        return list(self._exercise_recording_index["sensor"])
 
     def get_exercises(self):
         """ Return list of exercises in this data set """
-        exercises = set()
-        for er in self.exercise_recordings:
-            if er.exercise not in exercises:
-                exercises.add(er.exercise)
-        return list(exercises)
+        return list(self._exercise_recording_index["exercise"])
 
     def get_modes(self):
         """ Return list of exercise modes in this data set """
-        modes = set()
-        for er in self.exercise_recordings:
-            if er.mode not in modes:
-                modes.add(er.mode)
-        return list(modes)
+        return list(self._exercise_recording_index["mode"])
 
     def get_tsIDs(self):
         """ Return list of test subjects in this data set """
-        tsIDs = set()
-        for er in self.exercise_recordings:
-            if er.tsID not in tsIDs:
-                tsIDs.add(er.tsID)
-        return list(tsIDs)
+        return list(self._exercise_recording_index["tsID"])
 
     def get_data_types(self):
         """ Return list of all data types in this data set. Note that not all sensors might have the same data types! """
-        data_types = set()
-        for er in self.exercise_recordings:
-            for data_type in er.data_types:
-                if data_type not in data_types:
-                    data_types.add(data_type)
-        return list(data_types)
+        return list(self._exercise_recording_index["data_type"])
+
+    def _any_of(self, name, values):
+        """ Return set of exercise recordings having any of the values for the attribute """
+        postings = self._exercise_recording_index[name]
+        matches = set()
+        for value in set(values):
+            matches.update(postings.get(value, ()))
+        return matches
+
+    def _all_of(self, name, values):
+        """ Return set of exercise recordings having all of the values for the attribute """
+        postings = self._exercise_recording_index[name]
+        posting_lists = sorted((postings.get(value, {}) for value in set(values)), key=len)
+        matches = set(posting_lists[0])
+        for posting_list in posting_lists[1:]:
+            matches.intersection_update(posting_list)
+        return matches
+
+    def _filter_exercise_recordings(self, tsIDs, exercises, modes):
+        """ Return set of exercise recordings matching tsIDs, exercises and modes, or None if not filtered """
+        candidates = None
+        for name, values in (("tsID", tsIDs), ("exercise", exercises), ("mode", modes)):
+            if len(values) == 0:
+                continue
+            matches = self._any_of(name, values)
+            candidates = matches if candidates is None else candidates & matches
+        return candidates
 
     def get_exercise_recordings(self, tsIDs=[], exercises=[], modes=[], sensors=[], data_types=[], has_costs=None):
         """ Returns a list of all exercise recordings filtered by the parameters given.  """
-        exercise_recordings = []
-        for er in self.exercise_recordings:
-            if not ((er.tsID in tsIDs or len(tsIDs) == 0)                                    and
-                    (er.exercise in exercises or len(exercises) == 0)                            and
-                    (er.mode in modes or len(modes) == 0)                                    and
-                    (len(set(sensors).intersection(set(er.sensors))) == len(sensors) or len(sensors) == 0) and
-                    (len(set(data_types).intersection(set(er.data_types))) == len(data_types) or len(data_types) == 0)):
+        candidates = self._filter_exercise_recordings(tsIDs, exercises, modes)
+        for name, values in (("sensor", sensors), ("data_type", data_types)):
+            if len(values) == 0:
                 continue
+            matches = self._all_of(name, values)
+            candidates = matches if candidates is None else candidates & matches
+
+        if candidates is None:
+            candidates = self.exercise_recordings
+        else:
+            candidates = sorted(candidates, key=self._exercise_recording_order.__getitem__)
 
+        exercise_recordings = []
+        for er in candidates:
             cont = False
             if has_costs is not None:
                 for ds in er.data_sequences:
                     if data_types is not None:
-                        if ds.data_type in data_types and has_costs != (ds.costs is not None):
+                        if ds.data_type in data_types and has_costs != ds.has_costs():
                             cont = True
                             break
                     elif data_types is None:
-                        if (ds.costs is not None) != has_costs:
+                        if ds.has_costs() != has_costs:
                             cont = True
                             break
 
@@ -279,20 +654,30 @@ class ExerciseRecordingDataSet:
 
     def get_data_sequences(self, tsIDs=[], exercises=[], modes=[], sensors=[], data_types=[], has_costs=None):
         """ Returns a list of all data sequences filtered by the parameters given. """
+        exercise_recordings = self._filter_exercise_recordings(tsIDs, exercises, modes)
+
+        if len(sensors) == 0 and len(data_types) == 0:
+            if exercise_recordings is None:
+                ordered = self.exercise_recordings
+            else:
+                ordered = sorted(exercise_recordings, key=self._exercise_recording_order.__getitem__)
+            candidates = [ds for er in ordered for ds in er.data_sequences]
+            # The candidates all belong to the filtered exercise recordings already
+            exercise_recordings = None
+        else:
+            candidates = []
+            for (sensor, data_type), posting_list in self._data_sequence_index.items():
+                if ((sensor in sensors or len(sensors) == 0) and
+                        (data_type in data_types or len(data_types) == 0)):
+                    candidates.extend(posting_list)
+            candidates.sort(key=self._data_sequence_order.__getitem__)
+
         data_sequences = []
-        for er in self.exercise_recordings:
-            if not ((er.tsID in tsIDs or len(tsIDs) == 0)                                    and
-                    (er.exercise in exercises or len(exercises) == 0)                            and
-                    (er.mode in modes or len(modes) == 0)                                    and
-                    (len(set(sensors).intersection(set(er.sensors))) > 0 or len(sensors) == 0) and
-                    (len(set(data_types).intersection(set(er.data_types))) > 0 or len(data_types) == 0)):
+        for ds in candidates:
+            if exercise_recordings is not None and ds.exercise_recording not in exercise_recordings:
                 continue
-
-            for ds in er.data_sequences:
-                if not ((ds.sensor in sensors or len(sensors) == 0) and
-                        (ds.data_type in data_types or len(data_types) == 0) and
-                        (has_costs is None or (has_costs == (ds.costs is not None)))):
-                    continue
-                data_sequences.append(ds)
+            if has_costs is not None and has_costs != ds.has_costs():
+                continue
+            data_sequences.append(ds)
 
         return data_sequences
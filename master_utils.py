@@ -1,9 +1,15 @@
 import ast
 import csv
+import hashlib
 import math
+import numpy as np
+import os
+import pickle
 import re
 import time
 
+from binary_container import read_container, write_container
+
 
 def dprint(*args, verbose=False, **kwargs):
     if verbose:
@@ -44,9 +50,9 @@ def show_progress(title, total, current, starting_time, verbose=False):
 
 def getParametersFromFilename(filename):
     try:
-        matches = re.search('(\A[^\W\d_]+)_([0-9]+)_([0-9]+) - (.+).csv$', filename)
+        matches = re.search(r'(\A[^\W\d_]+)_([0-9]+)_([0-9]+) - (.+).csv$', filename)
         matches = matches.groups() if matches else None
-        if not matches or len(matches) is not 4:
+        if not matches or len(matches) != 4:
             return False
         return {'exercise_name': matches[0],
                 'mode': matches[1],
@@ -58,7 +64,111 @@ def getParametersFromFilename(filename):
         return False
 
 
-def readExerciseCSV(file_info, verbose=False, sensor_id_category='id', data_types=None, quat_type=None, quat_order="WXYZ"):
+def parseColumn(cells):
+    """
+    Convert all cells of one CSV column to a numpy array at once, instead of evaluating every cell separately.
+
+    :param cells: List of strings. Bracketed vectors like '[a, b, c]' with the same number of values in every cell
+                  become an (n, dims) array, numbers become an array of length n.
+    :returns: The float64 array, or None if the cells have any other shape.
+    """
+    if not cells:
+        return None
+
+    try:
+        if cells[0][:1] == "[":
+            separators = cells[0].count(",")
+            for cell in cells:
+                if cell[:1] != "[" or cell[-1:] != "]" or cell.count(",") != separators:
+                    return None
+            values = np.array(",".join([cell[1:-1] for cell in cells]).split(","), dtype=np.float64)
+            return values.reshape(len(cells), separators + 1)
+
+        return np.array(cells, dtype=np.float64)
+    except ValueError:
+        return None
+
+
+def file_sha1(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_csv_sidecar(filepath, parameters):
+    """
+    Return the sensor data saved next to a CSV file by save_csv_sidecar, or None if there is no sidecar or it is out
+    of date. The sidecar is valid if it was saved with the same parameters and the CSV file has the same size and
+    modification time, or the same content hash if only the modification time changed (e.g. after copying). In that
+    case the sidecar is updated with the new modification time, so the file is only hashed once.
+    """
+    try:
+        stat = os.stat(filepath)
+        container = read_container(filepath + ".bin")
+    except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+        # A missing or broken sidecar, the CSV file is parsed instead
+        return None
+    if container is None:
+        return None
+    metadata, arrays = container
+
+    try:
+        source = metadata["source"]
+        size, mtime_ns, sha1 = source["size"], source["mtime_ns"], source["sha1"]
+        saved_parameters, columns = metadata["parameters"], metadata["columns"]
+    except (KeyError, TypeError):
+        # Saved without the metadata needed to tell if it's up to date
+        return None
+    if saved_parameters != parameters or size != stat.st_size:
+        return None
+    if mtime_ns != stat.st_mtime_ns:
+        if sha1 != file_sha1(filepath):
+            return None
+        source["mtime_ns"] = stat.st_mtime_ns
+        try:
+            write_container(filepath + ".bin", metadata, arrays)
+        except OSError:
+            pass
+
+    sensors = {}
+    for sensor, sensor_columns in columns.items():
+        sensors[sensor] = {}
+        for category, (kind, value) in sensor_columns.items():
+            sensors[sensor][category] = arrays[value] if kind == "array" else value
+    return sensors
+
+
+def save_csv_sidecar(filepath, parameters, sensors, stat, verbose=False):
+    """
+    Save parsed sensor data to a binary sidecar file next to the CSV file, see load_csv_sidecar.
+
+    :param stat: os.stat() of the CSV file from before it was parsed
+    """
+    columns = {}
+    arrays = {}
+    for sensor, data_by_category in sensors.items():
+        columns[sensor] = {}
+        for category, data in data_by_category.items():
+            if isinstance(data, np.ndarray):
+                name = str(len(arrays))
+                arrays[name] = data
+                columns[sensor][category] = ("array", name)
+            else:
+                columns[sensor][category] = ("object", data)
+
+    metadata = {"source": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_sha1(filepath)},
+                "parameters": parameters,
+                "columns": columns}
+    try:
+        write_container(filepath + ".bin", metadata, arrays)
+    except OSError as e:
+        dprint("Could not save sidecar for {}: {}".format(filepath, e), verbose=verbose)
+
+
+def readExerciseCSV(file_info, verbose=False, sensor_id_category='id', data_types=None, quat_type=None, quat_order="WXYZ",
+                    use_sidecar=True):
     """
     Parses an CSV file containing sensor data. The filename must be of the format "exercise_name_mode_num<arbitrary>.csv", where mode and num must be numbers. See the regex below for details.
 
@@ -68,13 +178,17 @@ def readExerciseCSV(file_info, verbose=False, sensor_id_category='id', data_type
     :param data_types: Which data types to save. If None (default), save all.
     :param quat_type: The name of the quaternion category. Used in conjunction with quat_order.
     :param quat_order: Quaternion order the input file uses. This will be used to re-order the quaternions to "WXYZ".
+    :param use_sidecar: Load the parsed data from the binary file <filepath>.bin if it is up to date, and save it
+                        there otherwise, so the CSV file is only parsed once.
     :returns: Returns a dict containing this file's parameters and sensor data index by sensorID or None if something went wrong.
+              Vector and number columns are numpy arrays of shape (samples, dims) and (samples,), any other column
+              is a list of the evaluated cells.
     """
 
     tsID     = file_info['tsID']
     filepath = file_info['filepath']
 
-    if quat_order.upper() is not "WXYZ" and quat_type is not None:
+    if quat_order.upper() != "WXYZ" and quat_type is not None:
         convert_quat = True
         quat_order = quat_order.upper()
         w_i = quat_order.index("W")
@@ -94,44 +208,89 @@ def readExerciseCSV(file_info, verbose=False, sensor_id_category='id', data_type
         print("Missing entries from required file_info argument.")
         return None
 
-    csvReader = None
+    if use_sidecar:
+        sidecar_parameters = {"sensor_id_category": sensor_id_category,
+                              "data_types": sorted(data_types) if data_types is not None else None,
+                              "quat_type": quat_type,
+                              "quat_order": quat_order,
+                              "file_info": [tsID, exercise_name, mode, sample_number, timestamp]}
+        sensors = load_csv_sidecar(filepath, sidecar_parameters)
+        if sensors is not None:
+            return {"tsID": tsID,
+                    "exercise_name": exercise_name,
+                    "mode" : mode,
+                    "sample_number" : sample_number,
+                    "timestamp": timestamp,
+                    "sensors" : sensors}
+
     try:
-        inputcsv = open(filepath, 'r')
-        csvReader = csv.DictReader(inputcsv,
-                                   skipinitialspace=True,
-                                   delimiter=',',
-                                   quotechar='|')
+        stat = os.stat(filepath)
+        with open(filepath, 'r') as inputcsv:
+            rows = [row for row in csv.reader(inputcsv,
+                                              skipinitialspace=True,
+                                              delimiter=',',
+                                              quotechar='|') if row]
 
-    except NameError as e:
+    except OSError as e:
         print("Error opening input file: {}".format( e))
         return None
 
+    if not rows:
+        return {"tsID": tsID,
+                "exercise_name": exercise_name,
+                "mode" : mode,
+                "sample_number" : sample_number,
+                "timestamp": timestamp,
+                "sensors" : {}}
+
+    header = rows[0]
+    if sensor_id_category not in header:
+        print("readExerciseCSV: No column {} in file {}".format(sensor_id_category, filepath))
+        return None
+    id_column = header.index(sensor_id_category)
+
+    # Rows of every sensor, in the order they were recorded
+    rows_by_sensor = {}
+    for row in rows[1:]:
+        if len(row) != len(header):
+            print("readExerciseCSV: Expected {} columns, got {} in file {}: {}".format(len(header), len(row), filepath, row))
+            return None
+        rows_by_sensor.setdefault(row[id_column], []).append(row)
+
     sensors = {}
 
-    for row in csvReader:
-        sensor_id = row[sensor_id_category]
-        if sensor_id not in sensors:
-            sensors[sensor_id] = {}
-        for category in row:
+    for sensor_id, sensor_rows in rows_by_sensor.items():
+        sensors[sensor_id] = {}
+        for column, category in enumerate(header):
             if category == sensor_id_category:
                 continue
+            if data_types is not None and category not in data_types:
+                continue
+
+            cells = [row[column] for row in sensor_rows]
+            data = parseColumn(cells)
 
-            try:
-                data = ast.literal_eval(row[category])
-            except:
-                print("readExerciseCSV: Failed to eval data {} in file {} on column {}"
-                      .format(filepath, row[category], category))
-                return None
+            if data is None:
+                # Unknown cell shape, evaluate every cell
+                data = []
+                for cell in cells:
+                    try:
+                        data.append(ast.literal_eval(cell))
+                    except:
+                        print("readExerciseCSV: Failed to eval data {} in file {} on column {}"
+                              .format(cell, filepath, category))
+                        return None
+                if convert_quat and category == quat_type:
+                    data = [ [d[w_i], d[x_i], d[y_i], d[z_i]] for d in data ]
 
-            if convert_quat and category == quat_type:
-                data = [ data[w_i], data[x_i], data[y_i], data[z_i] ]
+            elif convert_quat and category == quat_type:
+                data = data[:, [w_i, x_i, y_i, z_i]]
 
-            if category not in sensors[sensor_id]:
-                sensors[sensor_id][category] = []
+            sensors[sensor_id][category] = data
 
-            sensors[sensor_id][category].append(data)
+    if use_sidecar:
+        save_csv_sidecar(filepath, sidecar_parameters, sensors, stat, verbose=verbose)
 
-    inputcsv.close()
     return {"tsID": tsID,
             "exercise_name": exercise_name,
             "mode" : mode,
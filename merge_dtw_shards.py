@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+import argparse
+import pickle
+import sys
+
+
+def get_argument_parser():
+    """ Command line arguments of merge_dtw_shards.py """
+    parser = argparse.ArgumentParser(description='Merge the shards computed by calc_dtw.py --shard K/N into one '
+                                     'ExerciseRecordingDataSet')
+    parser.add_argument('shards', nargs='+', help="Shard files pickles/dtw_shard_K_of_N_*.pickle, one for every K")
+    parser.add_argument('-V', '--verbose', action="store_true", default=False, help="Be verbose")
+    return parser
+
+
+def load_dtw_shards(files, verbose=False):
+    """ Load the shard files written by calc_dtw.py --shard, sorted by shard number """
+    from master_utils import dprint
+
+    shards = []
+    for f in files:
+        with open(f, "rb") as pf:
+            shard = pickle.load(pf)
+        dprint("Loaded shard {}/{} from {}".format(shard["shard"][0], shard["shard"][1], f), verbose=verbose)
+        shards.append(shard)
+    shards.sort(key=lambda shard: shard["shard"])
+    return shards
+
+
+def check_dtw_shards(shards):
+    """ Return a list of reasons the shards can't be merged, empty if they can """
+    errors = []
+    num_shards = shards[0]["shard"][1]
+    numbers = [shard["shard"][0] for shard in shards]
+    if any(shard["shard"][1] != num_shards for shard in shards):
+        errors.append("Shards of different splits: {}".format(", ".join("{}/{}".format(*s["shard"]) for s in shards)))
+    missing = sorted(set(range(1, num_shards + 1)) - set(numbers))
+    if missing:
+        errors.append("Missing shards {} of {}".format(", ".join(str(k) for k in missing), num_shards))
+    duplicates = sorted(set(k for k in numbers if numbers.count(k) > 1))
+    if duplicates:
+        errors.append("Duplicate shards {}".format(", ".join(str(k) for k in duplicates)))
+
+    first = shards[0]
+    first_data_set = first["exercise_recording_data_set"]
+    for shard in shards[1:]:
+        data_set = shard["exercise_recording_data_set"]
+        if data_set.dtw_parameters != first_data_set.dtw_parameters:
+            errors.append("Shard {}/{} was computed with other DTW parameters: {} != {}"
+                          .format(shard["shard"][0], shard["shard"][1],
+                                  data_set.dtw_parameters, first_data_set.dtw_parameters))
+        if shard["sequence_keys_by_sensor"] != first["sequence_keys_by_sensor"]:
+            errors.append("Shard {}/{} was computed from other data files"
+                          .format(shard["shard"][0], shard["shard"][1]))
+    return errors
+
+
+def merge_distance_matrices(shards):
+    """
+    Merge the distance matrices of all shards into the ones of the first shard.
+
+    :returns: List of reasons the merged matrices are incomplete, empty if every distance was computed exactly once
+    """
+    import numpy as np
+
+    errors = []
+    data_sets = [shard["exercise_recording_data_set"] for shard in shards]
+    for key, distance_matrix in data_sets[0].distance_matrices.items():
+        condensed = np.array([data_set.distance_matrices[key].condensed for data_set in data_sets])
+        computed = np.isfinite(condensed).sum(axis=0)
+        if np.any(computed == 0):
+            errors.append("{} {}: {} distances missing".format(key[0], key[1], int(np.sum(computed == 0))))
+        if np.any(computed > 1):
+            errors.append("{} {}: {} distances in more than one shard".format(key[0], key[1],
+                                                                               int(np.sum(computed > 1))))
+        distance_matrix.condensed[:] = condensed.min(axis=0)
+    return errors
+
+
+def main():
+    args = get_argument_parser().parse_args()
+
+    from calc_dtw import save_exercise_recording_data_set
+
+    shards = load_dtw_shards(args.shards, verbose=args.verbose)
+
+    errors = check_dtw_shards(shards)
+    if not errors:
+        errors = merge_distance_matrices(shards)
+    if errors:
+        for error in errors:
+            print(error)
+        print("Could not merge shards")
+        sys.exit(1)
+
+    exercise_recording_data_set = shards[0]["exercise_recording_data_set"]
+    save_exercise_recording_data_set(exercise_recording_data_set, exercise_recording_data_set.dtw_parameters["dist_type"])
+
+
+if __name__ == "__main__":
+    main()
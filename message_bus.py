@@ -1,210 +1,546 @@
 #!/usr/bin/python3
-import errno
+import argparse
+import asyncio
+import collections
 import json
 import os
-import select
+import signal
 import socket
-import struct
-import sys
+import time
 
+import sample_protocol
+from sample_ring import SampleRing
 
-def message_bus():
-    """Start the message bus"""
+PRODUCER_ADDRESS = '/tmp/sensor_producer'
+CONSUMER_ADDRESS = '/tmp/sensor_consumer'
 
-    producer_address = '/tmp/sensor_producer'
-    consumer_address = '/tmp/sensor_consumer'
+OVERFLOW_POLICIES = ["drop-oldest", "drop-newest", "disconnect"]
 
-    # Make sure the sockets does not already exist
-    try:
-        os.unlink(producer_address)
-        os.unlink(consumer_address)
-    except OSError:
-        if os.path.exists(producer_address):
-            raise
-        if os.path.exists(consumer_address):
-            raise
-
-    producer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    producer_socket.bind(producer_address)
-    producer_socket.listen(1)
-
-    consumer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    consumer_socket.bind(consumer_address)
-    consumer_socket.listen(1)
-
-    # Select lists
-    inputs = {producer_socket, consumer_socket}
-    excepts = set()
-    outputs = set()
-
-    # Client and producer states
-    producers = set()
-
-    # producer_offsets = {}
-    consumers = set()
-
-    # Message queue for all sockets
-    # Contains a queue of messages to be sent, for each sock
-    # message_queues[<socket object>] = [ <list of messages to be sent to this socket object> ]
-    message_queues = {}
-
-    # Debugging timers
-    print("Starting message bus...")
-    while True:
-        try:
-            readable, writable, exceptional = select.select(inputs, outputs, excepts)
-        except KeyboardInterrupt:
-            print("\nCtrl+C caught.")
-            for sock in inputs:
-                sock.close()
-            break
-        except Exception as e:
-            print("\nExeption: {}".format(e))
-            exit(1)
+VALIDATION_MODES = ["none", "object", "json"]
 
-        # Handle inputs
-        for sock in readable:
-            # New producer
-            if sock is producer_socket:
-                connection, client_address = sock.accept()
+# Most frames written with one sendmsg call, two buffers each. Linux accepts at most 1024 buffers per call
+MAX_COALESCED_FRAMES = 256
 
-                print("New PRODUCER on {}".format(connection))
 
-                producers.add(connection)
-                inputs.add(connection)
-                message_queues[connection] = []
+def is_valid(payload, validate):
+    """
+    Check a message payload.
 
-            # New consumer
-            elif sock is consumer_socket:
-                connection, client_address = sock.accept()
+    :param validate: 'none' accepts every json payload, 'object' only checks that the payload is enclosed in braces like
+    a json object and 'json' parses it. The version and length of binary samples are always checked, since the bus
+    decodes them for json consumers
+    """
+    if sample_protocol.is_binary(payload):
+        return sample_protocol.check_sample(payload)
+    if validate == "object":
+        return payload[:1] == b'{' and payload.rstrip()[-1:] == b'}'
+    if validate == "json":
+        try:
+            json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return False
+    return True
 
-                print("New CONSUMER on {}".format(connection))
 
-                consumers.add(connection)
-                outputs.add(connection)
+async def wait_writable(sock):
+    loop = asyncio.get_running_loop()
+    writable = loop.create_future()
+    loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(sock.fileno())
 
-                message_queues[connection] = []
 
-            # A client has sent data
+async def send_buffers(sock, buffers):
+    """
+    Write a list of buffers to a non-blocking socket, as one sendmsg call if the socket takes them all.
+
+    :returns: Number of sendmsg calls
+    """
+    calls = 0
+    while buffers:
+        try:
+            sent = sock.sendmsg(buffers)
+            calls += 1
+        except BlockingIOError:
+            sent = 0
+        # Skip what was sent and wait for the socket to take the rest
+        n = 0
+        while n < len(buffers) and sent >= len(buffers[n]):
+            sent -= len(buffers[n])
+            n += 1
+        buffers = buffers[n:]
+        if buffers:
+            if sent > 0:
+                buffers[0] = memoryview(buffers[0])[sent:]
+            await wait_writable(sock)
+    return calls
+
+
+def make_frame(payload):
+    return sample_protocol.FRAME_HEADER.pack(len(payload)), payload
+
+
+def parse_control(payload):
+    """ Return a client's payload as a dict if it is a json object, else None """
+    if sample_protocol.is_binary(payload):
+        return None
+    try:
+        message = json.loads(payload.decode('utf-8'))
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def is_name_list(value):
+    """ Whether a field of a control message is missing or a list of strings, like the sensors and fields """
+    return value is None or (isinstance(value, list) and all(isinstance(item, str) for item in value))
+
+
+class Consumer:
+    """
+    A consumer connection with a bounded queue of frames to send to it.
+
+    Frames are written by a task of its own, so a slow consumer only fills its own queue instead of stalling the
+    producers and the other consumers. When the queue is full, the overflow policy decides what happens to a new
+    frame: 'drop-oldest' drops the oldest queued frame, 'drop-newest' drops the new frame and 'disconnect' closes the
+    connection. All frames queued when the socket is writable are written at once.
+
+    Consumers get binary samples converted to json, until they ask for binary samples with sample_protocol.hello(), and
+    all messages, until they subscribe to some sensors and fields with sample_protocol.subscribe().
+
+    :param sock: Non-blocking socket of the connection
+    :param queue_size: Maximum number of queued frames
+    :param overflow: One of OVERFLOW_POLICIES
+    """
+    def __init__(self, sock, queue_size=1000, overflow="drop-oldest"):
+        self.sock = sock
+        self.name = sock.fileno()
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.ready = asyncio.Event()
+        self.disconnect = asyncio.Event()
+        self.binary = False
+        self.subscription = None
+        # Reads the samples from the ring instead of the socket
+        self.ring = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.writes = 0
+
+    def put(self, frame, control=False):
+        """
+        Queue a frame. Returns False if the queue overflowed and the consumer has to be disconnected.
+
+        :param control: Frame of the protocol rather than a sample, queued even if the queue is full
+        """
+        if len(self.queue) >= self.queue_size and not control:
+            if self.overflow == "disconnect":
+                return False
+            self.dropped += 1
+            if self.overflow == "drop-newest":
+                return True
+            self.queue.popleft()
+        self.queue.append(frame)
+        self.ready.set()
+        return True
+
+    async def send_queue(self):
+        """ Write the queued frames until cancelled """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                frames = [self.queue.popleft() for _ in range(min(len(self.queue), MAX_COALESCED_FRAMES))]
+                # While this waits for the socket, new frames pile up in the bounded queue
+                self.writes += await send_buffers(self.sock, [buffer for frame in frames for buffer in frame])
+                self.sent += len(frames)
+
+    def __str__(self):
+        return "consumer {}{}: {} sent in {} writes, {} dropped, {} queued".format(
+            self.name, " (reads the ring)" if self.ring else "", self.sent, self.writes, self.dropped, len(self.queue))
+
+
+class MessageBus:
+    """
+    Forwards every message received from the producers to all consumers.
+
+    Frames are forwarded as they were received, the same header and payload bytes shared by all consumer queues. Binary
+    samples are converted to json, and messages are projected to the fields consumers subscribed to, once for all
+    consumers that need the same frame. See sample_protocol.
+
+    :param queue_size: Maximum number of messages queued for every consumer
+    :param overflow: What to do when a consumer's queue is full, one of OVERFLOW_POLICIES
+    :param validate: How producer messages are checked before they are forwarded, one of VALIDATION_MODES. See is_valid
+    :param stats_interval: Seconds between printing the counters of every consumer. 0 to disable
+    :param ring_slots: Number of slots of the SampleRing that local consumers can read the messages from instead of
+    their socket. 0 for no ring
+    :param ring_slot_size: Bytes per slot of the ring
+    """
+    def __init__(self, queue_size=1000, overflow="drop-oldest", validate="none", stats_interval=0, ring_slots=0,
+                 ring_slot_size=512):
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.validate = validate
+        self.stats_interval = stats_interval
+        self.consumers = set()
+        self.consumer_tasks = set()
+        self.producers = set()
+        self.received = 0
+        self.invalid = 0
+
+        # Indexes of the sensors in binary samples
+        self.sensors = {}
+        self.sensor_names = {}
+
+        self.ring_slots = ring_slots
+        self.ring_slot_size = ring_slot_size
+        self.ring = None
+        # Sequence numbers, frames and whether they are control frames, of the last messages in the ring and up to a
+        # consumer queue more, sent over the socket to consumers that lag behind the ring
+        self.ring_history = collections.deque(maxlen=max(ring_slots, queue_size))
+
+    def publish(self, frame, control=False):
+        """ Write a frame to the ring """
+        if self.ring is not None:
+            self.ring_history.append((self.ring.publish(frame[1]), frame, control))
+
+    def broadcast(self, frame):
+        """ Queue a frame for all consumers, disconnecting those that overflow with the 'disconnect' policy """
+        self.publish(frame)
+        # Sensor, decoded message and converted frames, computed once for all consumers that need them
+        cache = {"binary": sample_protocol.is_binary(frame[1])}
+        for consumer in list(self.consumers):
+            consumer_frame = self.get_consumer_frame(consumer, frame, cache)
+            if consumer_frame is None:
+                continue
+            if not consumer.put(consumer_frame):
+                print("Queue of consumer {} is full, disconnecting".format(consumer.name))
+                self.remove_consumer(consumer)
+
+    def get_message(self, payload, cache):
+        """ A payload as a dict, None if it isn't valid json """
+        if "message" not in cache:
+            if cache["binary"]:
+                cache["message"] = sample_protocol.decode_sample(payload, self.sensor_names)
             else:
-                try:
-                    tmp_size = sock.recv(struct.calcsize("!l"))
-                    if len(tmp_size) == 0:
-                        data = 0
+                cache["message"] = parse_control(payload)
+        return cache["message"]
+
+    def get_consumer_frame(self, consumer, frame, cache):
+        """ The frame as the consumer gets it, None if it didn't subscribe to the frame's sensor or reads the ring """
+        if consumer.ring:
+            return None
+        binary = cache["binary"] and consumer.binary
+        subscription = consumer.subscription
+        if subscription is None:
+            if binary or not cache["binary"]:
+                return frame
+            fields = None
+        else:
+            if subscription.sensors is not None:
+                if "sensor" not in cache:
+                    if cache["binary"]:
+                        cache["sensor"] = self.sensor_names.get(sample_protocol.get_sensor_index(frame[1]))
                     else:
-                        size = int(struct.unpack("!l", tmp_size)[0])
-                        data = sock.recv(size)
-                        while len(data) < size:
-                            data += sock.recv(size - len(data))
-
-                except OSError as e:
-                    if e.errno != errno.ECONNRESET:
-                        # raise
-                        # Handle socket reset/hangup
-                        print("Exception: {} -- Closing {}".format(e, sock))
-                        if sock in outputs:
-                            outputs.remove(sock)
-                        if sock in inputs:
-                            inputs.remove(sock)
-                        if sock in producers:
-                            producers.pop(sock)
-                        if sock in consumers:
-                            consumers.pop(sock)
-                        sock.close()
-                        del message_queues[sock]
-                except Exception as e:
-                    print("Exception:{} ::{}:: {}".format(
-                          repr(e), tmp_size, type(tmp_size).__name__))
-                    sys.exit(1)
-
-                # We have received data from an existing consumer or producer
+                        cache["sensor"] = (self.get_message(frame[1], cache) or {}).get("id")
+                if not subscription.wants(cache["sensor"]):
+                    return None
+            fields = subscription.fields
+
+        key = (binary, fields)
+        if key not in cache:
+            if fields is None and binary == cache["binary"]:
+                cache[key] = frame
+            elif binary:
+                cache[key] = make_frame(sample_protocol.project_sample(frame[1], fields))
+            else:
+                message = self.get_message(frame[1], cache)
+                if message is None:
+                    # Forwarded as it is if it can't be projected
+                    cache[key] = frame
                 else:
-                    # Data from producer
-                    if data and sock in producers:
-                        # Check valid json
-                        try:
-                            tmp = json.loads(data.decode('utf-8'))
-                        except Exception as e:
-                            print("Error: {}".format(e))
-                        # Broadcast to everyone
+                    if fields is not None:
+                        message = sample_protocol.project(message, fields)
+                    cache[key] = make_frame(json.dumps(message).encode('utf-8'))
+        return cache[key]
+
+    def register_sensors(self, names):
+        """ Give the sensors indexes, and send the new sensor table to the consumers of binary samples """
+        new = [name for name in names if name not in self.sensors]
+        for name in new:
+            self.sensors[name] = len(self.sensors)
+            self.sensor_names[self.sensors[name]] = name
+            print("Sensor {} has index {}".format(name, self.sensors[name]))
+        if new:
+            frame = make_frame(sample_protocol.sensor_table(self.sensors))
+            self.publish(frame, control=True)
+            for consumer in self.consumers:
+                if consumer.binary and not consumer.ring:
+                    consumer.put(frame, control=True)
+
+    def answer_hello(self, message, consumer=None):
+        """
+        Answer sample_protocol.hello(). A consumer gets binary samples from then on, from the ring if it asked for it.
+
+        :returns: Payload of the answer
+        """
+        if message.get("protocol") != "binary" or message.get("version") != sample_protocol.VERSION:
+            return json.dumps({"protocol": "json"}).encode('utf-8')
+        self.register_sensors(message.get("sensors", []))
+        ring = None
+        if consumer is not None:
+            consumer.binary = True
+            if message.get("ring") and self.ring is not None:
+                consumer.ring = True
+                ring = {"name": self.ring.name, "seq": self.ring.last_seq + 1}
+        return sample_protocol.sensor_table(self.sensors, ring)
+
+    def fall_back(self, consumer, seq):
+        """ Send a consumer that lagged behind the ring the frames from seq on over its socket, and all that follow """
+        consumer.ring = False
+        if self.ring_history and self.ring_history[0][0] > seq:
+            consumer.dropped += self.ring_history[0][0] - seq
+        print("Consumer {} lagged behind the ring, sending from message {} over its socket".format(consumer.name, seq))
+        for frame_seq, frame, control in self.ring_history:
+            if frame_seq < seq:
+                continue
+            if control:
+                consumer.put(frame, control=True)
+                continue
+            consumer_frame = self.get_consumer_frame(consumer, frame, {"binary": sample_protocol.is_binary(frame[1])})
+            if consumer_frame is not None and not consumer.put(consumer_frame):
+                print("Queue of consumer {} is full, disconnecting".format(consumer.name))
+                self.remove_consumer(consumer)
+                return
+
+    def fetch(self, consumer, seq):
+        """ Send a consumer reading the ring message seq, which didn't fit in a slot, over its socket """
+        first_seq = self.ring_history[0][0] if self.ring_history else self.ring.last_seq + 1
+        if first_seq <= seq <= self.ring.last_seq:
+            # As it is in the ring, to be filtered by the consumer like the rest
+            consumer.put(self.ring_history[seq - first_seq][1], control=True)
+        else:
+            consumer.put(make_frame(sample_protocol.fallback(seq)), control=True)
+            self.fall_back(consumer, seq)
+
+    def remove_consumer(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+            consumer.disconnect.set()
+
+    async def handle_producer(self, reader, writer):
+        name = writer.get_extra_info("socket").fileno()
+        print("New PRODUCER {}".format(name))
+        self.producers.add(writer)
+        try:
+            first = True
+            while True:
+                header = await reader.readexactly(sample_protocol.FRAME_HEADER.size)
+                length = sample_protocol.FRAME_HEADER.unpack(header)[0]
+                if length < 0:
+                    print("Warning: Invalid frame length {} from producer {}".format(length, name))
+                    break
+                payload = await reader.readexactly(length)
+
+                if first:
+                    first = False
+                    message = parse_control(payload)
+                    if message is not None and "protocol" in message:
+                        if is_name_list(message.get("sensors")):
+                            writer.write(b''.join(make_frame(self.answer_hello(message))))
                         else:
-                            tmp = json.dumps(tmp)
-
-                            for client in consumers:
-                                message_queues[client].append(tmp)
+                            print("Warning: Ignoring hello with invalid sensors from producer {}: {}"
+                                  .format(name, payload[:80]))
+                        continue
+                self.received += 1
+
+                if not is_valid(payload, self.validate):
+                    self.invalid += 1
+                    print("Error: Invalid message from producer {}: {}".format(name, payload[:80]))
+                # Broadcast to everyone
+                else:
+                    self.broadcast((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            print("Closing producer {}".format(name))
+            self.producers.discard(writer)
+            writer.close()
+
+    async def handle_consumer(self, sock):
+        consumer = Consumer(sock, self.queue_size, self.overflow)
+        print("New CONSUMER {}".format(consumer.name))
+        self.consumers.add(consumer)
 
-                    # Data from consumer
-                    elif data and sock in consumers:
-                        print("Received {} from CONSUMER {} ".format(data, sock))
-                        print("Warning: Receiving data from consumers is not supported! Doing nothing...")
+        try:
+            # Until the consumer hangs up, sending fails or the bus disconnects it
+            tasks = [asyncio.ensure_future(consumer.send_queue()),
+                     asyncio.ensure_future(self.receive_from_consumer(consumer)),
+                     asyncio.ensure_future(consumer.disconnect.wait())]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except OSError as e:
+                    print("Error \"{}\" while sending queue to consumer {}".format(e, consumer.name))
+        finally:
+            self.remove_consumer(consumer)
+            print("Closing {}".format(consumer))
+            sock.close()
 
-                    # Closed connection
+    async def receive_from_consumer(self, consumer):
+        """ Handle the consumer's hello, subscription and ring fallback. Return when the consumer closes the socket """
+        loop = asyncio.get_running_loop()
+        data = b''
+        try:
+            while True:
+                received = await loop.sock_recv(consumer.sock, 4096)
+                if not received:
+                    return
+                data += received
+                while len(data) >= sample_protocol.FRAME_HEADER.size:
+                    length = sample_protocol.FRAME_HEADER.unpack_from(data)[0]
+                    if length < 0:
+                        print("Warning: Invalid frame length {} from consumer {}".format(length, consumer.name))
+                        return
+                    size = sample_protocol.FRAME_HEADER.size + length
+                    if len(data) < size:
+                        break
+                    payload, data = data[sample_protocol.FRAME_HEADER.size:size], data[size:]
+                    message = parse_control(payload)
+                    if message is not None and "protocol" in message:
+                        if not is_name_list(message.get("sensors")):
+                            print("Warning: Ignoring hello with invalid sensors from consumer {}: {}"
+                                  .format(consumer.name, payload[:80]))
+                            continue
+                        consumer.put(make_frame(self.answer_hello(message, consumer)), control=True)
+                    elif message is not None and message.get("ring") in ("fallback", "fetch"):
+                        seq = message.get("seq")
+                        if not consumer.ring or not isinstance(seq, int) or isinstance(seq, bool) or seq < 1:
+                            print("Warning: Ignoring invalid ring message from consumer {}: {}"
+                                  .format(consumer.name, payload[:80]))
+                        elif message["ring"] == "fallback":
+                            self.fall_back(consumer, seq)
+                        else:
+                            self.fetch(consumer, seq)
+                    elif message is not None and "subscribe" in message:
+                        subscribe = message["subscribe"]
+                        if (not isinstance(subscribe, dict) or not is_name_list(subscribe.get("sensors")) or
+                                not is_name_list(subscribe.get("fields"))):
+                            print("Warning: Ignoring invalid subscription from consumer {}: {}"
+                                  .format(consumer.name, payload[:80]))
+                            continue
+                        consumer.subscription = sample_protocol.Subscription(subscribe.get("sensors"),
+                                                                             subscribe.get("fields"))
+                        print("Consumer {} subscribed to sensors {} and fields {}"
+                              .format(consumer.name, subscribe.get("sensors") or "all",
+                                      subscribe.get("fields") or "all"))
                     else:
-                        if sock in inputs:
-                            print("Removing from inputs")
-                            inputs.remove(sock)
-                        if sock in outputs:
-                            print("Removing from outputs")
-                            outputs.remove(sock)
-                        if sock in writable:
-                            print("Removing from writable")
-                            writable.remove(sock)
-
-                        if sock in producers:
-                            print("Closing producer {}".format(sock))
-                            # Broadcast disconnect
-                            producers.remove(sock)
-                        if sock in consumers:
-                            print("Closing consumer {}".format(sock))
-                            consumers.remove(sock)
-
-                        sock.close()
-                        del message_queues[sock]
-
-        for sock in writable:
-            if sock in producers:
-                print("Sending to producer!")
+                        print("Warning: Receiving data from consumers is not supported! Doing nothing...")
+        except ConnectionError:
+            pass
+
+    async def accept_consumers(self, listener):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _ = await loop.sock_accept(listener)
+            sock.setblocking(False)
+            task = asyncio.ensure_future(self.handle_consumer(sock))
+            self.consumer_tasks.add(task)
+            task.add_done_callback(self.consumer_tasks.discard)
+
+    async def print_stats(self):
+        """ Print the counters of the bus and every consumer every stats_interval seconds """
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            print("{}: {} messages received, {} invalid".format(time.strftime("%H:%M:%S"), self.received, self.invalid))
+            for consumer in self.consumers:
+                print("  {}".format(consumer))
+
+    async def run(self):
+        """ Serve producers and consumers until Ctrl+C """
+        # Make sure the sockets do not already exist
+        for address in [PRODUCER_ADDRESS, CONSUMER_ADDRESS]:
             try:
-                while len(message_queues[sock]) > 0:
-                    sock.sendall(struct.pack("!l", len(message_queues[sock][-1])))
-                    sock.sendall(bytearray(message_queues[sock].pop(), 'utf-8'))
-            except Exception as e:
-                print("Error \"{}\" while sending queue to {}".format(e.args, sock))
-                print("Closing socket {}".format(sock))
-                if sock in inputs:
-                    inputs.remove(sock)
-                if sock in outputs:
-                    outputs.remove(sock)
-                if sock in producers:
-                    producers.remove(sock)
-                if sock in consumers:
-                    consumers.remove(sock)
-                sock.close()
-                del message_queues[sock]
-
-        for sock in exceptional:
-            print("Handling exceptional condition for {}".format(sock))
-            if sock in inputs:
-                inputs.remove(sock)
-            if sock in outputs:
-                outputs.remove(sock)
-            if sock in producers:
-                producers.remove(sock)
-            if sock in consumers:
-                consumers.remove(sock)
-            sock.close()
-            del message_queues[sock]
-
-    print("Good bye!")
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+
+        producer_server = await asyncio.start_unix_server(self.handle_producer, path=PRODUCER_ADDRESS)
+
+        # Consumers are served on plain non-blocking sockets, to write the queued frames with sendmsg
+        consumer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        consumer_socket.bind(CONSUMER_ADDRESS)
+        consumer_socket.listen(8)
+        consumer_socket.setblocking(False)
+
+        if self.ring_slots > 0:
+            self.ring = SampleRing.create(self.ring_slots, self.ring_slot_size)
+            print("Publishing to sample ring {} with {} slots of {} bytes".format(self.ring.name, self.ring_slots,
+                                                                                self.ring_slot_size))
+
+        background = [asyncio.ensure_future(self.accept_consumers(consumer_socket))]
+        if self.stats_interval > 0:
+            background.append(asyncio.ensure_future(self.print_stats()))
+
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop.set)
+        print("Starting message bus...")
+        await stop.wait()
+
+        print("\nCtrl+C caught.")
+        for task in background:
+            task.cancel()
+        producer_server.close()
+        consumer_socket.close()
+        # Closing the connections ends their handlers
+        for writer in list(self.producers):
+            writer.close()
+        for consumer in list(self.consumers):
+            self.remove_consumer(consumer)
+        if self.consumer_tasks:
+            await asyncio.wait(list(self.consumer_tasks))
+        if self.ring is not None:
+            self.ring.close()
+            self.ring.unlink()
+        await asyncio.sleep(0)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        print("Usage:\n\n"
-              "This program will start a message bus. Producers and consumers "
-              "can connect on '/tmp/sensor_producer' and '/tmp/sensor_consumer'"
-              ", respectively. Messages are sent formatted in json. "
-              "Producers send messages to the message bus, which forwards them to all consumers.\n\n"
-              "This program takes no arguments.\n")
-
-    message_bus()
+    parser = argparse.ArgumentParser(description="Start a message bus. Producers and consumers can connect on '{}' and "
+                                     "'{}', respectively. Messages are sent formatted in json or as binary samples, "
+                                     "each preceded by its length. Producers send messages to the message bus, which "
+                                     "forwards them to all consumers.".format(PRODUCER_ADDRESS, CONSUMER_ADDRESS))
+    parser.add_argument('-q', '--queue-size', default=1000, type=int,
+                        help="Maximum number of messages queued for every consumer. Default is 1000")
+    parser.add_argument('-o', '--overflow', choices=OVERFLOW_POLICIES, default="drop-oldest",
+                        help="What to do with a new message when a consumer's queue is full: drop the oldest queued "
+                        "message (default), drop the new message, or disconnect the consumer")
+    parser.add_argument('--validate', choices=VALIDATION_MODES, default="none",
+                        help="Check the messages from producers before forwarding them: 'none' (default) forwards "
+                        "them unchecked, 'object' drops messages not enclosed in braces and 'json' drops messages that "
+                        "are not valid json. Binary samples of the wrong length are always dropped")
+    parser.add_argument('--ring-slots', default=0, type=int,
+                        help="Also publish the messages to a ring of this many slots in shared memory, which local "
+                        "consumers can read without system calls. Consumers that lag more than the ring behind get the "
+                        "rest over their socket. Default is 0, no ring")
+    parser.add_argument('--ring-slot-size', default=512, type=int,
+                        help="Bytes per slot of the ring. Consumers fetch longer messages over their socket. "
+                        "Default is 512")
+    parser.add_argument('--stats-interval', default=0, type=float,
+                        help="Seconds between printing the number of messages sent, dropped and queued for every "
+                        "consumer. Default is 0, never")
+    args = parser.parse_args()
+
+    asyncio.run(MessageBus(queue_size=args.queue_size, overflow=args.overflow, validate=args.validate,
+                           stats_interval=args.stats_interval, ring_slots=args.ring_slots,
+                           ring_slot_size=args.ring_slot_size).run())
+    print("Good bye!")
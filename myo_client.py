@@ -17,6 +17,7 @@ from gi.repository import GLib
 from timer_interval import Timer
 
 from myodbus import MyoDbus
+import sample_protocol
 
 
 def discover_available_myos():
@@ -75,9 +76,10 @@ def discover_available_myos():
 
 
 class MyoClient:
-    def __init__(self, wanted_myos=None, sleep=False, verbose=False):
+    def __init__(self, wanted_myos=None, sleep=False, verbose=False, binary=True, float64=True):
         self.sleep = sleep
         self.verbose = verbose
+        self.float64 = float64
 
         # Event loop and dbus
         DBusGMainLoop(set_as_default=True)
@@ -142,6 +144,12 @@ class MyoClient:
         else:
             print("Connected to message bus")
 
+        # Indexes of the sensors in binary samples, or None to send json
+        self.sensor_indexes = None
+        if binary:
+            self.sensor_indexes = sample_protocol.negotiate(self.sock, [myo.myo_name for myo in self.myos.itervalues()])
+            print("Sending {}".format("json" if self.sensor_indexes is None else "binary samples"))
+
         # Start main loop
         try:
             print("Running main loop!")
@@ -195,10 +203,13 @@ class MyoClient:
                    'gyr' : gyr,
                    'timestamp' : time.time()
                    }
-        json_payload = json.dumps( stringy )
+        if self.sensor_indexes is not None:
+            payload = sample_protocol.encode_sample(self.sensor_indexes[stringy['id']], stringy, float64=self.float64)
+        else:
+            payload = json.dumps( stringy )
         try:
-            self.sock.sendall(struct.pack("!l", len(json_payload) ))
-            self.sock.sendall(json_payload )
+            # Header and payload in one system call
+            sample_protocol.send_frame(self.sock, payload)
         except socket.error as se:
             print("Socket error in handleIMU: {}\nExiting...".format(se))
             self.sock.close()
@@ -221,6 +232,10 @@ if __name__ == "__main__":
     parser.add_argument('--myos', dest='addresses', default=None, nargs='+', help="Myo bluetooth addresses")
     parser.add_argument('-V', dest='verbose', default=False, action='store_true', help="Enable verbose output")
     parser.add_argument('-l', '--list', default=False, action='store_true', help="List available Myos and exit")
+    parser.add_argument('--json', default=False, action='store_true',
+                        help="Send json messages instead of binary samples")
+    parser.add_argument('--float32', default=False, action='store_true',
+                        help="Send the values of binary samples as float32 instead of float64")
     args = parser.parse_args()
 
     if args.list:
@@ -230,4 +245,5 @@ if __name__ == "__main__":
             print("  Name: {} Address: {}".format(connected[myo_addr]['name'], myo_addr))
         sys.exit(0)
 
-    myo_client = MyoClient(wanted_myos=args.addresses, sleep=args.sleep, verbose=args.verbose)
+    myo_client = MyoClient(wanted_myos=args.addresses, sleep=args.sleep, verbose=args.verbose,
+                           binary=not args.json, float64=not args.float32)
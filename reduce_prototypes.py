@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import multiprocessing as mp
+import os
+import sys
+
+
+def get_argument_parser():
+    """ Command line arguments of reduce_prototypes.py """
+    parser = argparse.ArgumentParser(description="Condense the exercise recordings of every exercise and mode into a few "
+                                     "prototypes, save them as a new data set and report the k-NN accuracy against "
+                                     "them compared to the whole data set")
+    parser.add_argument('inputfile', help="Data set file generated by calc_dtw.py, or pickle containing an "
+                        "ExerciseRecordingDataSet")
+    parser.add_argument('-n', '--prototypes', nargs='+', type=int, default=[1],
+                        help="Number of prototypes per exercise, mode and sensor. Several values save one data set "
+                        "each. Default is 1")
+    parser.add_argument('-m', '--method', choices=["medoid", "dba"], default="medoid",
+                        help="'medoid' (default) to keep the medoids of clusters of the recordings, or 'dba' to "
+                        "average the clusters with DTW barycenter averaging")
+    parser.add_argument('--dba-iterations', default=10, type=int, help="Iterations of DTW barycenter averaging. "
+                        "Default is 10")
+    parser.add_argument('-s', '--sensors', nargs='*', default=[],
+                        help="Sensors to use. If not specified, use all available")
+    parser.add_argument('-t', '--data-type', default="quat", help="Data type to use")
+    parser.add_argument('--class-type', default="exercise", choices=['exercise', 'mode'],
+                        help="Class the accuracy is reported for")
+    parser.add_argument('-k', '--k-neighbors', default=1, type=int, help="Number of neighbors to vote. Default is 1")
+    parser.add_argument('-l', '--leave-me-out', choices=['all'], default=None,
+                        help="'all' to classify the recordings of every tsID against prototypes built without that "
+                        "tsID. By default every recording is classified against prototypes built from all of them")
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int,
+                        help="Number of DTW computations to run concurrently")
+    parser.add_argument('-V', '--verbose', action="store_true", default=False, help="Be verbose")
+    return parser
+
+
+def k_medoids(distances, n, iterations=100):
+    """
+    Split the sequences of a square distance matrix into n clusters around medoids, by greedy initialization and
+    alternating assignment and medoid updates.
+
+    :returns: Tuple (medoids, labels) of the index of every cluster's medoid and the cluster of every sequence
+    """
+    import numpy as np
+
+    # Unknown distances count as very far, but not infinitely so that sums stay comparable
+    finite = distances[np.isfinite(distances)]
+    distances = np.where(np.isfinite(distances), distances, 2 * len(distances) * (finite.max() if finite.size else 1))
+    n = min(n, len(distances))
+
+    medoids = [int(np.argmin(distances.sum(axis=1)))]
+    while len(medoids) < n:
+        nearest = distances[:, medoids].min(axis=1)
+        gains = np.maximum(nearest[:, None] - distances, 0).sum(axis=0)
+        gains[medoids] = -1
+        medoids.append(int(np.argmax(gains)))
+    medoids = np.array(medoids)
+
+    for _ in range(iterations):
+        labels = np.argmin(distances[:, medoids], axis=1)
+        labels[medoids] = np.arange(n)
+        updated = medoids.copy()
+        for c in range(n):
+            members = np.flatnonzero(labels == c)
+            updated[c] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+
+    labels = np.argmin(distances[:, medoids], axis=1)
+    labels[medoids] = np.arange(n)
+    return medoids, labels
+
+
+def dba(sequences, initial, dist_type="quaternion", iterations=10):
+    """
+    DTW barycenter averaging (Petitjean et al. 2011): repeatedly align every sequence to the average and replace each
+    sample of the average by the mean of the samples aligned to it. Quaternions are sign aligned and normalized.
+    """
+    import numpy as np
+
+    from dtw_engines import COST_MATRIX_FUNCTIONS, dtw_path
+
+    cost_matrix_function = COST_MATRIX_FUNCTIONS[dist_type]
+    average = np.array(initial, dtype=np.float64)
+    for _ in range(iterations):
+        sums = np.zeros_like(average)
+        counts = np.zeros(len(average))
+        for sequence in sequences:
+            i, j = dtw_path(average, sequence, cost_matrix_function)
+            aligned = np.asarray(sequence, dtype=np.float64)[j]
+            if dist_type == "quaternion":
+                # q and -q are the same rotation
+                aligned = aligned * np.where(np.sum(average[i] * aligned, axis=1) < 0, -1, 1)[:, None]
+            np.add.at(sums, i, aligned)
+            np.add.at(counts, i, 1)
+        updated = sums / counts[:, None]
+        if dist_type == "quaternion":
+            updated /= np.linalg.norm(updated, axis=1)[:, None]
+        if np.allclose(updated, average):
+            break
+        average = updated
+    return average
+
+
+def build_prototypes(samples, distance_matrices, data_type, size, method="medoid", dist_type="quaternion",
+                     dba_iterations=10):
+    """
+    Condense the samples of every exercise and mode into at most size prototypes per sensor.
+
+    :returns: Tuple (prototypes, sources), where sources maps the id of every medoid prototype's data sequence to the
+              data sequence it was copied from, so its distances can be looked up instead of computed
+    """
+    import numpy as np
+
+    from exercise_recording_data import ExerciseRecording
+
+    samples_by_class = {}
+    for er in samples:
+        samples_by_class.setdefault((er.exercise, er.mode), []).append(er)
+
+    prototypes = []
+    sources = {}
+    for (exercise, mode), members in sorted(samples_by_class.items()):
+        n = min(size, len(members))
+        sequences_by_sensor = {}
+        for distance_matrix in distance_matrices:
+            index = {id(ds): i for i, ds in enumerate(distance_matrix.data_sequences)}
+            indices = np.array([index[id(er.sensors[distance_matrix.sensor][data_type])] for er in members])
+            distances = distance_matrix.rows(indices)[:, indices]
+            np.fill_diagonal(distances, 0)
+            medoids, labels = k_medoids(distances, n)
+
+            sequences = sequences_by_sensor.setdefault(distance_matrix.sensor, [])
+            for c, medoid in enumerate(medoids):
+                source = distance_matrix.data_sequences[indices[medoid]]
+                if method == "dba":
+                    cluster = [distance_matrix.data_sequences[indices[i]].data for i in np.flatnonzero(labels == c)]
+                    sequences.append((dba(cluster, source.data, dist_type, dba_iterations), None))
+                else:
+                    sequences.append((source.data, source))
+
+        for p in range(n):
+            input_data = {sensor: {data_type: sequences[p][0]} for sensor, sequences in sequences_by_sensor.items()}
+            prototype = ExerciseRecording("prototype", exercise, mode, str(p + 1), None, input_data)
+            for sensor, sequences in sequences_by_sensor.items():
+                if sequences[p][1] is not None:
+                    sources[id(prototype.sensors[sensor][data_type])] = sequences[p][1]
+            prototypes.append(prototype)
+    return prototypes, sources
+
+
+def get_prototype_distances(data_sequences, prototype_sequences, sources, distance_matrix, dtw, pool):
+    """
+    Distances between every data sequence and every prototype, as a (len(data_sequences), len(prototype_sequences))
+    array. Distances to medoids are looked up in distance_matrix, the others are computed with dtw in the pool. The
+    distance of a medoid's source data sequence to the medoid is Inf, so no recording is classified by a copy of itself.
+    """
+    import numpy as np
+
+    index = {id(ds): i for i, ds in enumerate(distance_matrix.data_sequences)}
+    distances = np.full((len(data_sequences), len(prototype_sequences)), float('Inf'))
+    pairs = []
+    for j, prototype in enumerate(prototype_sequences):
+        source = sources.get(id(prototype))
+        for i, ds in enumerate(data_sequences):
+            if ds is prototype:
+                distances[i, j] = 0.0
+            elif ds is source:
+                distances[i, j] = float('Inf')
+            elif source is not None and id(ds) in index:
+                distances[i, j] = distance_matrix.get(index[id(ds)], index[id(source)])
+            elif id(ds) in sources and source is not None:
+                distances[i, j] = distance_matrix.get(index[id(sources[id(ds)])], index[id(source)])
+            else:
+                pairs.append((i, j))
+    if pairs:
+        costs = pool.starmap(dtw, [(data_sequences[i].data, prototype_sequences[j].data) for i, j in pairs],
+                             chunksize=max(1, len(pairs) // (4 * (os.cpu_count() or 1))))
+        i, j = zip(*pairs)
+        distances[list(i), list(j)] = costs
+    return distances
+
+
+def evaluate_prototypes(samples, prototypes, sources, distance_matrices, data_type, classify_by, k, dtw, pool):
+    """ Return the number of samples classified correctly with k-NN against the prototypes only """
+    import numpy as np
+
+    from create_confusion_matrix import nearest_neighbours
+    from exercise_recording_data import DistanceMatrix
+
+    matrices = []
+    for distance_matrix in distance_matrices:
+        data_sequences = [er.sensors[distance_matrix.sensor][data_type] for er in samples]
+        prototype_sequences = [p.sensors[distance_matrix.sensor][data_type] for p in prototypes]
+        distances = get_prototype_distances(data_sequences, prototype_sequences, sources, distance_matrix, dtw, pool)
+
+        # Distances between the samples stay unknown, so only prototypes can be neighbours
+        matrix = DistanceMatrix(distance_matrix.sensor, data_type, data_sequences + prototype_sequences)
+        i, j = np.meshgrid(np.arange(len(samples)), len(samples) + np.arange(len(prototypes)), indexing='ij')
+        matrix.set(i.ravel(), j.ravel(), distances.ravel())
+        matrices.append(matrix)
+
+    predictions = nearest_neighbours(samples, matrices, classify_by, k_values=[k])[k]
+    return sum(predicted == getattr(er, classify_by) for er, predicted in zip(samples, predictions))
+
+
+def save_prototypes(prototypes, sources, distance_matrices, dtw_parameters, data_type, method, size, dtw, pool,
+                    pickledir="pickles"):
+    """ Save the prototypes with the distances between them as a new data set and return the name of the file """
+    import numpy as np
+
+    from exercise_recording_data import DistanceMatrix, ExerciseRecordingDataSet
+    from master_utils import dprint
+
+    data_set = ExerciseRecordingDataSet(prototypes)
+    data_set.dtw_parameters = dict(dtw_parameters, prototypes={"method": method, "size": size})
+    for distance_matrix in distance_matrices:
+        prototype_sequences = [p.sensors[distance_matrix.sensor][data_type] for p in prototypes]
+        distances = get_prototype_distances(prototype_sequences, prototype_sequences, sources, distance_matrix, dtw,
+                                            pool)
+        matrix = DistanceMatrix(distance_matrix.sensor, data_type, prototype_sequences,
+                                dtype=distance_matrix.condensed.dtype)
+        i, j = np.triu_indices(len(prototype_sequences), 1)
+        matrix.set(i, j, distances[i, j])
+        data_set.add_distance_matrix(matrix)
+
+    if not os.path.exists(pickledir):
+        os.makedirs(pickledir)
+    isotime = datetime.datetime.now().isoformat()
+    prototypes_file = "{}/exercise_recording_data_set_{}_prototypes_{}_n={}_{}.dataset".format(
+        pickledir, dtw_parameters.get("dist_type", "quaternion"), method, size, isotime)
+    data_set.save(prototypes_file)
+    dprint("Saved {}".format(prototypes_file), verbose=True)
+    return prototypes_file
+
+
+def main():
+    parser = get_argument_parser()
+    args = parser.parse_args()
+    if args.k_neighbors < 1:
+        parser.error("-k/--k-neighbors must be at least 1")
+
+    # Only imported once the arguments are parsed, so --help and usage errors don't wait for numpy, fastdtw and the
+    # data modules
+    from calc_dtw import make_dtw_function
+    from create_confusion_matrix import get_distance_matrices, nearest_neighbours
+    from exercise_recording_data import ExerciseRecordingDataSet
+    from master_utils import dprint
+
+    data_set = ExerciseRecordingDataSet.load(args.inputfile, sensors=args.sensors, data_types=[args.data_type])
+    sensors = args.sensors if len(args.sensors) > 0 else sorted(data_set.get_sensors())
+    samples = data_set.get_exercise_recordings(sensors=sensors, data_types=[args.data_type], has_costs=True)
+    if len(samples) < 3:
+        print("Error: Too few samples. Have {} samples.".format(len(samples)))
+        sys.exit(1)
+
+    # Data sets saved before the DTW engine was recorded were all computed with fastdtw
+    dtw_parameters = dict(getattr(data_set, "dtw_parameters", {}))
+    dtw_parameters.setdefault("dist_type", "quaternion")
+    dtw_parameters.setdefault("dtw_engine", "fastdtw")
+    dtw = make_dtw_function(dtw_parameters["dist_type"], dtw_parameters["dtw_engine"],
+                            window=dtw_parameters.get("window"),
+                            band=dtw_parameters.get("band", "sakoe-chiba"),
+                            max_slope=dtw_parameters.get("max_slope", 2.0))
+
+    distance_matrices = get_distance_matrices(data_set, sensors, args.data_type)
+
+    # Accuracy of the whole data set as reference
+    predictions = nearest_neighbours(samples, distance_matrices, args.class_type, leave_me_out=args.leave_me_out,
+                                     k_values=[args.k_neighbors])[args.k_neighbors]
+    correct = sum(predicted == getattr(er, args.class_type) for er, predicted in zip(samples, predictions))
+    validation = "leave-1-out" if args.leave_me_out is None else args.leave_me_out
+    report = [("all recordings", len(samples), correct, validation)]
+
+    with mp.Pool(processes=args.jobs) as pool:
+        for size in args.prototypes:
+            prototypes, sources = build_prototypes(samples, distance_matrices, args.data_type, size,
+                                                   method=args.method, dist_type=dtw_parameters["dist_type"],
+                                                   dba_iterations=args.dba_iterations)
+            dprint("Built {} prototypes with {} per exercise, mode and sensor".format(len(prototypes), size),
+                   verbose=args.verbose)
+
+            if args.leave_me_out == "all":
+                correct = 0
+                for tsID in sorted(set(er.tsID for er in samples)):
+                    test = [er for er in samples if er.tsID == tsID]
+                    train = [er for er in samples if er.tsID != tsID]
+                    fold_prototypes, fold_sources = build_prototypes(train, distance_matrices, args.data_type, size,
+                                                                     method=args.method,
+                                                                     dist_type=dtw_parameters["dist_type"],
+                                                                     dba_iterations=args.dba_iterations)
+                    correct += evaluate_prototypes(test, fold_prototypes, fold_sources, distance_matrices,
+                                                   args.data_type, args.class_type, args.k_neighbors, dtw, pool)
+            else:
+                correct = evaluate_prototypes(samples, prototypes, sources, distance_matrices, args.data_type,
+                                              args.class_type, args.k_neighbors, dtw, pool)
+            # Medoids leave the recording they were copied from out, but DBA prototypes average the recordings they
+            # classify in, unless their whole tsID is left out
+            prototype_validation = validation
+            if args.leave_me_out is None and args.method == "dba":
+                prototype_validation = "resubstitution"
+            report.append(("{} n={}".format(args.method, size), len(prototypes), correct, prototype_validation))
+
+            save_prototypes(prototypes, sources, distance_matrices, dtw_parameters, args.data_type, args.method, size,
+                            dtw, pool)
+
+        pool.close()
+        pool.join()
+
+    print("\nAccuracy by {}, k={}, against all {} recordings:".format(args.class_type, args.k_neighbors,
+                                                                     len(samples)))
+    print("{:<20} {:>10} {:>10} {:>10}  {}".format("Reference set", "Size", "Fraction", "Accuracy", "Validation"))
+    for name, size, correct, validation in report:
+        print("{:<20} {:>10} {:>9.1f}% {:>9.2f}%  {}".format(name, size, 100 * size / len(samples),
+                                                             100 * correct / len(samples), validation))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import fnmatch
+import json
+import select
+import socket
+import struct
+import time
+
+# Every frame is a payload preceded by its length. A payload is either a json object or a binary sample
+FRAME_HEADER = struct.Struct("!l")
+
+MAGIC = 0xb5
+VERSION = 1
+
+# Magic, version, flags, data type mask, sensor index, 2 bytes padding and timestamp, followed by the values of the data
+# types in the mask in the order of DATA_TYPES. Binary samples carry a sensor index instead of the sensor name: a client
+# asks the message bus for binary samples by sending hello(), and the bus answers with sensor_table(), the names and
+# indexes of the sensors, and sends it again whenever sensors are added. Clients that don't send hello() only get json.
+# This module also runs on Python 2, for myo_client.py and visualizer.py
+SAMPLE_HEADER = struct.Struct("<BBBBHxxd")
+
+FLAG_FLOAT64 = 0x01
+
+# Data types a binary sample can carry, with the number of values of each
+DATA_TYPES = (("quat", 4), ("acc", 3), ("gyr", 3))
+
+_value_structs = {}
+
+# Fields of the messages sent to consumers subscribed to only some fields, besides those
+KEPT_FIELDS = {"id", "iid", "timestamp"}
+
+
+def _get_value_struct(mask, flags):
+    key = (mask, flags)
+    if key not in _value_structs:
+        count = sum(size for bit, (_, size) in enumerate(DATA_TYPES) if mask & (1 << bit))
+        _value_structs[key] = struct.Struct("<{}{}".format(count, "d" if flags & FLAG_FLOAT64 else "f"))
+    return _value_structs[key]
+
+
+def is_binary(payload):
+    return payload[:1] == struct.pack("B", MAGIC)
+
+
+def encode_sample(sensor_index, sample, float64=True):
+    """
+    Pack a sample as a binary payload.
+
+    :param sample: Dict with 'timestamp' and lists of values for some of the DATA_TYPES, like the json messages. Other
+    keys are left out
+    :param float64: Pack the values as float64 instead of float32
+    """
+    mask = 0
+    values = []
+    for bit, (data_type, size) in enumerate(DATA_TYPES):
+        if data_type in sample:
+            mask |= 1 << bit
+            values.extend(sample[data_type][:size])
+    flags = FLAG_FLOAT64 if float64 else 0
+    return (SAMPLE_HEADER.pack(MAGIC, VERSION, flags, mask, sensor_index, sample["timestamp"]) +
+            _get_value_struct(mask, flags).pack(*values))
+
+
+def decode_sample(payload, sensor_names):
+    """
+    Unpack a binary payload into a dict like the json messages.
+
+    :param sensor_names: Dict of sensor index to name. Unknown indexes are given as the index
+    """
+    magic, version, flags, mask, sensor_index, timestamp = SAMPLE_HEADER.unpack_from(payload)
+    values = _get_value_struct(mask, flags).unpack_from(payload, SAMPLE_HEADER.size)
+    sample = {'id': sensor_names.get(sensor_index, str(sensor_index)), 'timestamp': timestamp}
+    offset = 0
+    for bit, (data_type, size) in enumerate(DATA_TYPES):
+        if mask & (1 << bit):
+            sample[data_type] = list(values[offset:offset+size])
+            offset += size
+    return sample
+
+
+def get_sensor_index(payload):
+    return SAMPLE_HEADER.unpack_from(payload)[4]
+
+
+def project_sample(payload, fields):
+    """ Binary payload with only the data types of a binary payload that are in fields """
+    magic, version, flags, mask, sensor_index, timestamp = SAMPLE_HEADER.unpack_from(payload)
+    values = _get_value_struct(mask, flags).unpack_from(payload, SAMPLE_HEADER.size)
+    projected_mask = 0
+    projected = []
+    offset = 0
+    for bit, (data_type, size) in enumerate(DATA_TYPES):
+        if mask & (1 << bit):
+            if data_type in fields:
+                projected_mask |= 1 << bit
+                projected.extend(values[offset:offset+size])
+            offset += size
+    return (SAMPLE_HEADER.pack(magic, version, flags, projected_mask, sensor_index, timestamp) +
+            _get_value_struct(projected_mask, flags).pack(*projected))
+
+
+def check_sample(payload):
+    """ Cheap check of a binary payload: version and length """
+    if len(payload) < SAMPLE_HEADER.size:
+        return False
+    magic, version, flags, mask, _, _ = SAMPLE_HEADER.unpack_from(payload)
+    return version == VERSION and len(payload) == SAMPLE_HEADER.size + _get_value_struct(mask, flags).size
+
+
+def hello(sensors=None, ring=False):
+    """
+    Payload asking the message bus for binary samples, registering the names of the sensors a producer sends.
+
+    :param ring: Ask to read the samples from the bus' sample ring in shared memory, see sample_ring.py
+    """
+    message = {"protocol": "binary", "version": VERSION}
+    if sensors is not None:
+        message["sensors"] = list(sensors)
+    if ring:
+        message["ring"] = True
+    return json.dumps(message).encode('utf-8')
+
+
+def sensor_table(sensors, ring=None):
+    """
+    Payload answering hello(), with the dict of sensor names to indexes.
+
+    :param ring: Dict of the name of the sample ring and the sequence number of the first payload the consumer reads
+    from it, if the consumer reads the ring from now on
+    """
+    message = {"protocol": "binary", "version": VERSION, "sensors": sensors}
+    if ring is not None:
+        message["ring"] = ring
+    return json.dumps(message).encode('utf-8')
+
+
+def fallback(seq):
+    """ Payload telling the message bus that a consumer lagged behind the ring, to send it payload seq on instead """
+    return json.dumps({"ring": "fallback", "seq": seq}).encode('utf-8')
+
+
+def fetch(seq):
+    """
+    Payload asking the message bus for payload seq of the ring, which didn't fit in a slot. The bus answers with the
+    payload, or with fallback(seq) if it is gone, and then sends everything from seq on over the socket
+    """
+    return json.dumps({"ring": "fetch", "seq": seq}).encode('utf-8')
+
+
+def subscribe(sensors=None, fields=None):
+    """
+    Payload subscribing a consumer to some of the messages and fields.
+
+    :param sensors: Patterns of the sensor ids to receive, like 'myo*'. None for all sensors
+    :param fields: Data fields to receive, like 'quat'. None for all fields. The sensor id and timestamp are always sent
+    """
+    return json.dumps({"subscribe": {"sensors": sensors, "fields": fields}}).encode('utf-8')
+
+
+def project(message, fields):
+    """ Copy of a json message with only the fields and KEPT_FIELDS, also in the nested 'data' of LPMS messages """
+    projected = {key: value for key, value in message.items() if key in fields or key in KEPT_FIELDS}
+    if isinstance(message.get("data"), dict):
+        projected["data"] = project(message["data"], fields)
+    return projected
+
+
+class Subscription(object):
+    """
+    The sensors and fields a consumer subscribed to with sample_protocol.subscribe().
+
+    :param sensors: List of fnmatch patterns of the sensor ids, or None for all sensors
+    :param fields: List of the data fields, or None for all fields
+    """
+    def __init__(self, sensors=None, fields=None):
+        self.sensors = sensors
+        self.fields = frozenset(fields) if fields is not None else None
+        self.matches = {}
+
+    def wants(self, sensor):
+        """ Whether messages from a sensor are sent to the consumer """
+        if self.sensors is None:
+            return True
+        if sensor not in self.matches:
+            self.matches[sensor] = sensor is not None and any(fnmatch.fnmatchcase(str(sensor), pattern)
+                                                              for pattern in self.sensors)
+        return self.matches[sensor]
+
+
+def send_frame(sock, payload):
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def receive(sock, size):
+    data = b''
+    while len(data) < size:
+        tmp = sock.recv(size - len(data))
+        if len(tmp) == 0:
+            return None
+        data += tmp
+    return data
+
+
+def receive_frame(sock):
+    """ Return the next payload, or None if the connection was closed """
+    header = receive(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    return receive(sock, FRAME_HEADER.unpack(header)[0])
+
+
+def negotiate(sock, sensors, timeout=1.0):
+    """
+    Register a producer's sensors with the message bus and ask to send binary samples.
+
+    :returns: Dict of sensor names to indexes, or None if the bus didn't answer within timeout and only takes json
+    """
+    send_frame(sock, hello(sensors))
+    sock.settimeout(timeout)
+    try:
+        payload = receive_frame(sock)
+    except socket.timeout:
+        payload = None
+    finally:
+        sock.settimeout(None)
+    if payload is None:
+        return None
+    answer = json.loads(payload.decode('utf-8'))
+    if answer.get("protocol") != "binary" or answer.get("version") != VERSION:
+        return None
+    return answer["sensors"]
+
+
+class SampleReader(object):
+    """
+    Reads the samples the message bus sends to a consumer, json or binary.
+
+    With ring, the samples are read from the bus' sample ring in shared memory once the bus answers the hello, without
+    a system call per sample. The ring holds the samples of all sensors, so the subscription is applied here. If the
+    reader lags so far behind that the samples it is about to read were overwritten, it tells the bus and reads the rest
+    from the socket. Messages too long for a slot are fetched from the bus one by one. Python 3 only.
+
+    :param sock: Socket connected to the consumer address of the message bus
+    :param binary: Ask the bus for binary samples. A bus that doesn't support them keeps sending json
+    :param sensors: Only receive the messages of the sensors matching these patterns. See subscribe()
+    :param fields: Only receive these data fields. See subscribe()
+    :param ring: Read the samples from the ring of a message bus started with --ring-slots. Implies binary
+    :param poll_interval: Seconds to sleep between polls of the ring while it has no new samples
+    """
+    def __init__(self, sock, binary=True, sensors=None, fields=None, ring=False, poll_interval=0.001):
+        self.sock = sock
+        self.sensor_names = {}
+        self.subscription = None
+        self.ring = None
+        self.ring_seq = None
+        self.poll_interval = poll_interval
+        if binary or ring:
+            send_frame(sock, hello(ring=ring))
+        if sensors is not None or fields is not None:
+            send_frame(sock, subscribe(sensors, fields))
+            self.subscription = Subscription(sensors, fields)
+
+    def read(self):
+        """ Return the next sample as a dict like the json messages, or None if the connection was closed """
+        while True:
+            if self.ring is not None:
+                payload = self.read_ring()
+            else:
+                payload = receive_frame(self.sock)
+            if payload is None:
+                return None
+            if is_binary(payload):
+                message = decode_sample(payload, self.sensor_names)
+            else:
+                message = json.loads(payload.decode('utf-8'))
+                if "protocol" in message:
+                    self.sensor_names.update((index, name) for name, index in message.get("sensors", {}).items())
+                    if "ring" in message:
+                        self.attach_ring(message["ring"])
+                    continue
+            if self.ring is not None and self.subscription is not None:
+                # The bus only applies the subscription to the samples it sends over the socket
+                if not self.subscription.wants(message.get("id")):
+                    continue
+                if self.subscription.fields is not None:
+                    message = project(message, self.subscription.fields)
+            return message
+
+    def attach_ring(self, ring):
+        from sample_ring import SampleRing
+        self.ring = SampleRing.attach(ring["name"])
+        self.ring_seq = ring["seq"]
+
+    def read_ring(self):
+        """ Return the next payload in the ring, or from the socket if the reader lagged behind the ring """
+        from sample_ring import PayloadTooLarge, RingLagged
+        polls = 0
+        while True:
+            try:
+                payload = self.ring.read(self.ring_seq)
+            except RingLagged as e:
+                print("Lagged behind the sample ring ({}), reading from the socket".format(e))
+                send_frame(self.sock, fallback(self.ring_seq))
+                return self.leave_ring()
+            except PayloadTooLarge:
+                send_frame(self.sock, fetch(self.ring_seq))
+                payload = receive_frame(self.sock)
+                if payload is None:
+                    return None
+                if payload == fallback(self.ring_seq):
+                    print("Lagged behind the sample ring (payload {} is gone), reading from the socket"
+                          .format(self.ring_seq))
+                    return self.leave_ring()
+            if payload is not None:
+                self.ring_seq += 1
+                return payload
+            polls += 1
+            # Spin a little before sleeping, as the next sample is often just being written
+            if polls > 100:
+                if polls % 100 == 0 and self.is_closed():
+                    return None
+                time.sleep(self.poll_interval)
+
+    def leave_ring(self):
+        """ Stop reading the ring, and return the next payload from the socket """
+        self.ring.close()
+        self.ring = None
+        return receive_frame(self.sock)
+
+    def is_closed(self):
+        """ Whether the bus closed the socket. The bus sends nothing else on it while the reader reads the ring """
+        if not select.select([self.sock], [], [], 0)[0]:
+            return False
+        return len(self.sock.recv(1, socket.MSG_PEEK)) == 0
@@ -0,0 +1,112 @@
+import struct
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = b"MCSR"
+VERSION = 1
+
+# Magic, version, number of slots, slot size and sequence number of the last published payload, padded to 64 bytes
+RING_HEADER = struct.Struct("<4sIIIQ")
+RING_HEADER_SIZE = 64
+
+# Sequence number of the payload in the slot, 0 while it is written, followed by the payload's length, padded to 16
+# bytes. They are packed separately, so that the length is written before and read after the sequence number
+SLOT_SEQ = struct.Struct("<Q")
+SLOT_LENGTH = struct.Struct("<I")
+SLOT_HEADER_SIZE = 16
+
+# Length of a slot whose payload didn't fit
+TOO_LARGE = 0xffffffff
+
+# The resource tracker keeps a set of names, so concurrent attaches in one process must not interleave their register
+# and unregister calls
+_attach_lock = threading.Lock()
+
+
+class RingLagged(Exception):
+    """ The payload to read was overwritten """
+
+
+class PayloadTooLarge(Exception):
+    """ The payload to read didn't fit in a slot, and has to be fetched from the writer """
+
+
+class SampleRing:
+    """
+    Fixed-size ring of payloads in shared memory, written by the message bus and read by local consumers without
+    system calls.
+
+    Payload n is written to slot n % slots. The writer clears the slot's sequence number, writes the payload and then
+    sets the sequence number to n, so a reader that sees the sequence number n both before and after copying the
+    payload knows the copy is whole. A reader that finds another sequence number has fallen more than a ring behind.
+    Payloads longer than a slot are only marked as such, for the reader to fetch them from the writer some other way.
+
+    Create the ring with SampleRing.create() in the message bus and attach to it with SampleRing.attach(name).
+    """
+    def __init__(self, shm, slots, slot_size):
+        self.shm = shm
+        self.name = shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = shm.buf
+        self.last_seq = RING_HEADER.unpack_from(self.buffer)[4]
+
+    @classmethod
+    def create(cls, slots=4096, slot_size=512):
+        """ :param slot_size: Bytes per slot. Payloads longer than slot_size - 16 bytes don't fit """
+        shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + slots * slot_size)
+        RING_HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slots, slot_size, 0)
+        return cls(shm, slots, slot_size)
+
+    @classmethod
+    def attach(cls, name):
+        with _attach_lock:
+            shm = shared_memory.SharedMemory(name=name)
+            # Only the message bus unlinks the ring, not the resource tracker of a consumer when it exits
+            resource_tracker.unregister(shm._name, "shared_memory")
+        magic, version, slots, slot_size, _ = RING_HEADER.unpack_from(shm.buf)
+        if magic != MAGIC or version != VERSION:
+            shm.close()
+            raise ValueError("{} is not a version {} sample ring".format(name, VERSION))
+        return cls(shm, slots, slot_size)
+
+    def publish(self, payload):
+        """ Write the next payload, overwriting the oldest. Returns its sequence number """
+        seq = self.last_seq + 1
+        offset = RING_HEADER_SIZE + (seq % self.slots) * self.slot_size
+        SLOT_SEQ.pack_into(self.buffer, offset, 0)
+        if len(payload) <= self.slot_size - SLOT_HEADER_SIZE:
+            self.buffer[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + len(payload)] = payload
+            SLOT_LENGTH.pack_into(self.buffer, offset + SLOT_SEQ.size, len(payload))
+        else:
+            SLOT_LENGTH.pack_into(self.buffer, offset + SLOT_SEQ.size, TOO_LARGE)
+        SLOT_SEQ.pack_into(self.buffer, offset, seq)
+        RING_HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, self.slots, self.slot_size, seq)
+        self.last_seq = seq
+        return seq
+
+    def read(self, seq):
+        """ Return payload seq, or None if it isn't published yet. Raises RingLagged if it can't be read anymore """
+        offset = RING_HEADER_SIZE + (seq % self.slots) * self.slot_size
+        slot_seq = SLOT_SEQ.unpack_from(self.buffer, offset)[0]
+        if slot_seq != seq:
+            # An older payload, or 0 while payload seq is written, unless the writer is a whole ring further
+            if slot_seq > seq or (slot_seq == 0 and RING_HEADER.unpack_from(self.buffer)[4] >= seq + self.slots):
+                raise RingLagged("payload {} was overwritten".format(seq))
+            return None
+        length = SLOT_LENGTH.unpack_from(self.buffer, offset + SLOT_SEQ.size)[0]
+        if length == TOO_LARGE:
+            if SLOT_SEQ.unpack_from(self.buffer, offset)[0] != seq:
+                raise RingLagged("payload {} was overwritten while it was read".format(seq))
+            raise PayloadTooLarge("payload {} is larger than a slot".format(seq))
+        payload = bytes(self.buffer[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + length])
+        if SLOT_SEQ.unpack_from(self.buffer, offset)[0] != seq:
+            raise RingLagged("payload {} was overwritten while it was read".format(seq))
+        return payload
+
+    def close(self):
+        self.buffer = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
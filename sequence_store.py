@@ -0,0 +1,75 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SequenceStore:
+    """
+    Data sequences of every sensor packed into one contiguous float64 array in shared memory.
+
+    The owner creates the store with SequenceStore.create() and worker processes attach to it by name using the
+    tuple returned by attach_info(), so only a few integers per job need to be sent to the workers.
+
+    :param name: Name of the shared memory block
+    :param offsets_by_sensor: For every sensor, an array where sequence i occupies elements offsets[i]..offsets[i+1]-1
+    :param dims_by_sensor: For every sensor, the number of values per sample
+    """
+    def __init__(self, name, offsets_by_sensor, dims_by_sensor, create=False, size=0):
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.offsets_by_sensor = offsets_by_sensor
+        self.dims_by_sensor = dims_by_sensor
+        total = max([int(offsets[-1]) for offsets in offsets_by_sensor] + [0])
+        self.data = np.ndarray((total,), dtype=np.float64, buffer=self.shm.buf)
+
+    @classmethod
+    def create(cls, sequences_by_sensor):
+        """ Create a store from a list of lists of sequences, one list per sensor """
+        arrays_by_sensor = [[np.asarray(sequence, dtype=np.float64) for sequence in sequences]
+                            for sequences in sequences_by_sensor]
+
+        offsets_by_sensor = []
+        dims_by_sensor = []
+        start = 0
+        for arrays in arrays_by_sensor:
+            offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+            np.cumsum([array.size for array in arrays], out=offsets[1:])
+            offsets += start
+            start = int(offsets[-1])
+            offsets_by_sensor.append(offsets)
+            dims_by_sensor.append(arrays[0].reshape(len(arrays[0]), -1).shape[1] if arrays else 1)
+
+        # Shared memory blocks can't be empty
+        store = cls(None, offsets_by_sensor, dims_by_sensor, create=True, size=max(start, 1) * 8)
+        for s, arrays in enumerate(arrays_by_sensor):
+            offsets = offsets_by_sensor[s]
+            for i, array in enumerate(arrays):
+                store.data[offsets[i]:offsets[i+1]] = array.ravel()
+        return store
+
+    @classmethod
+    def attach(cls, name, offsets_by_sensor, dims_by_sensor):
+        return cls(name, offsets_by_sensor, dims_by_sensor)
+
+    def attach_info(self):
+        """ Arguments for SequenceStore.attach() in another process """
+        return (self.shm.name, self.offsets_by_sensor, self.dims_by_sensor)
+
+    def get(self, s, i):
+        """ Return sequence i of sensor s as a (samples, dims) view into shared memory """
+        offsets = self.offsets_by_sensor[s]
+        return self.data[offsets[i]:offsets[i+1]].reshape(-1, self.dims_by_sensor[s])
+
+    def length(self, s, i):
+        offsets = self.offsets_by_sensor[s]
+        return int(offsets[i+1] - offsets[i]) // self.dims_by_sensor[s]
+
+    def num_sequences(self, s):
+        return len(self.offsets_by_sensor[s]) - 1
+
+    def close(self):
+        # Views into the buffer must be released before it can be closed
+        self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
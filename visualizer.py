@@ -4,16 +4,16 @@ from __future__ import print_function
 import argparse
 import ast
 import csv
-import json
 import numpy
 import socket
-import struct
 import sys
 import threading
 import time
 import visual
 import visual.text as vt
 
+from sample_protocol import SampleReader
+
 
 def axisAngleFromQuaternion(quat):
     v = visual.vector(0,0,0)
@@ -121,12 +121,11 @@ class Graphics (threading.Thread):
                                      quat_data[3]]
 
 
-def read_from_socket():
+def read_from_socket(binary=True):
     # Create UDS socket
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     server_address = '/tmp/sensor_consumer'
     print("Connecting to {}... ".format( server_address ), end='')
-    header_length = struct.calcsize("!l")
 
     try:
         sock.connect(server_address)
@@ -137,26 +136,14 @@ def read_from_socket():
         print("connected")
 
     try:
+        # Only the data that is shown
+        reader = SampleReader(sock, binary=binary, fields=["quat", "acc"])
         while True:
-            data = None
-            tmp_sz = sock.recv( header_length )
-            if len(tmp_sz) == 0:
+            r = reader.read()
+            if r is None:
                 print("Connection dropped! Exiting")
                 sys.exit(1)
 
-            size = struct.unpack("!l", tmp_sz)[0]
-            data = sock.recv( size )
-
-            while size-len(data) > 0:
-                tmp = sock.recv(size-len(data))
-                if len(tmp) > 0:
-                    data += tmp
-                else:
-                    print("Connection dropped!")
-                    sys.exit(1)
-
-            r = json.loads(data)
-
             sensor_id = r['id']
             acc_data = r['acc']
             acc_data = [ a/10000000 for a in acc_data]
@@ -253,6 +240,7 @@ if __name__ == "__main__":
     parser.add_argument('-b','--bus', help='use message bus', action='store_true')
     parser.add_argument('-c','--csv', help='use csv file', default="")
     parser.add_argument('-s','--speed', type=float, help='Speed multiplier to apply when playing back a csv file', default="1")
+    parser.add_argument('--json', help='receive json messages from the message bus instead of binary samples', action='store_true')
     args = parser.parse_args()
 
     args.speed = args.speed if args.speed > 0 else 1
@@ -261,7 +249,7 @@ if __name__ == "__main__":
         print("Specify either bus or csv")
         sys.exit(-1)
 
-    lots_of_data = read_from_socket() if args.bus else read_from_log(args.csv, float(args.speed))
+    lots_of_data = read_from_socket(binary=not args.json) if args.bus else read_from_log(args.csv, float(args.speed))
 
     graphics = Graphics(4, ["00","01","10","11"])
     graphics.daemon = True